@@ -15,6 +15,8 @@ class Post(TimestampCreatorMixin):
 	"""
 	ACTIVE = 'Active'
 	INACTIVE = 'Inactive'
+	# The fields the blogs report can be sorted by, see get_table_data()
+	REPORT_SORT_FIELDS = ['updated_at', 'created_at']
 	title = models.CharField(default='', max_length=100)
 	preview_text = models.TextField(default='', max_length=500)
 	content = RichTextField(default='')
@@ -53,3 +55,8 @@ class Post(TimestampCreatorMixin):
 	class Meta:
 		verbose_name = 'Post'
 		verbose_name_plural = 'Posts'
+		indexes = [
+			# Used by the blogs report, see REPORT_SORT_FIELDS
+			models.Index(fields=['updated_at', 'id'], name='post_updated_at_idx'),
+			models.Index(fields=['created_at', 'id'], name='post_created_at_idx'),
+		]
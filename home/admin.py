@@ -1,11 +1,16 @@
 from django.contrib import admin
-from .models import Product, ProductImage, ShippingAddress, Cart, CartItem, Order, OrderHistory
+from .models import Product, ProductImage, ProductImageVariant, ShippingAddress, Cart, CartItem, StockReservation, Order, OrderHistory, OrderDailyStats, QueuedEmail, StripeEvent
 
 
 admin.site.register(Product)
 admin.site.register(ProductImage)
+admin.site.register(ProductImageVariant)
 admin.site.register(ShippingAddress)
 admin.site.register(Cart)
 admin.site.register(CartItem)
+admin.site.register(StockReservation)
 admin.site.register(Order)
 admin.site.register(OrderHistory)
+admin.site.register(OrderDailyStats)
+admin.site.register(QueuedEmail)
+admin.site.register(StripeEvent)
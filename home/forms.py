@@ -1,7 +1,7 @@
 from django import forms
 from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator
-from senior_project.utils import get_allowed_cities
+from senior_project.utils import get_allowed_cities, decode_cursor
 from senior_project import constants
 from home.models import Product, ProductImage, CartItem, ShippingAddress, Order
 
@@ -12,6 +12,23 @@ class ContactForm(forms.Form):
 	message = forms.CharField(widget=forms.Textarea)
 
 
+class CatalogFilterForm(forms.Form):
+	"""Filters and paginates the products on the home page."""
+	min_price = forms.DecimalField(required=False, min_value=0, decimal_places=2, label='Min price')
+	max_price = forms.DecimalField(required=False, min_value=0, decimal_places=2, label='Max price')
+	in_stock = forms.BooleanField(required=False, label='In stock only')
+	cursor = forms.CharField(required=False, widget=forms.HiddenInput)
+
+	def clean_cursor(self):
+		cursor = self.cleaned_data.get('cursor')
+		if cursor:
+			try:
+				decode_cursor(cursor)
+			except ValueError:
+				raise ValidationError("Invalid cursor.")
+		return cursor
+
+
 class ProductForm(forms.ModelForm):
 	# If stock_overflow > 0 then display this field so the admin can deal with it
 	def __init__(self, *args, **kwargs):
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from senior_project.utils import email_num_dummy_users
+
+
+class Command(BaseCommand):
+	help = 'Emails the admin when few demo accounts are available. Ran by the Heroku Scheduler addon every 10 minutes.'
+
+	def handle(self, *args, **options):
+		if email_num_dummy_users():
+			self.stdout.write("Few demo accounts are available, the admin was emailed.")
+		else:
+			self.stdout.write("No email sent.")
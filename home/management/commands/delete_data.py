@@ -1,7 +1,7 @@
 from django.core.management.base import BaseCommand
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
-from home.models import Product, ShippingAddress, Cart, CartItem, Order, OrderHistory
+from home.models import Product, ProductImage, ShippingAddress, Cart, CartItem, Order, OrderHistory
 from blog.models import Post
 
 User = get_user_model()
@@ -13,10 +13,9 @@ class Command(BaseCommand):
 	def handle(self, *args, **options):
 		self.stdout.write("Deleting objects: Post, Product, ProductImage, ShippingAddress, Cart, CartItem, Order, Contact, OrderHistory, Groups, Users (not superusers)")
 		Post.objects.all().delete()
-		# Delete ProductImages and Products
-		for product in Product.objects.all():
-			product.delete_images()
-			product.delete()
+		# Delete ProductImages and Products, the image files are deleted from S3 in batches
+		ProductImage.bulk_delete(ProductImage.objects.all())
+		Product.objects.all().delete()
 		ShippingAddress.objects.all().delete()
 		Cart.objects.all().delete()
 		CartItem.objects.all().delete()
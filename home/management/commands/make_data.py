@@ -1,5 +1,6 @@
 from django.contrib.sites.models import Site
 from django.core.management.base import BaseCommand
+from django.core.management import call_command
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.files import File
@@ -222,7 +223,6 @@ class Command(BaseCommand):
 			)
 			product.created_at = date(YEAR, 1, i+1)
 			product.save()
-			product.create_stripe_product_and_price_objs()
 			products.append(product)
 		self.stdout.write("Products created.")
 		return products
@@ -382,4 +382,6 @@ class Command(BaseCommand):
 		self.create_cartitems(carts, products)
 		self.create_orders(carts)
 		self.update_site_model()
+		# Create the products on stripe all at once, after the site's domain is set for their URLs
+		call_command('sync_stripe_catalog')
 		self.stdout.write("----- Finished. -----")
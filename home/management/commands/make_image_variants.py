@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from home.models import ProductImage
+
+
+class Command(BaseCommand):
+	help = "Makes the WebP and JPEG variants of the product images that don't have any, such as images uploaded before variants existed."
+
+	def handle(self, *args, **options):
+		images = ProductImage.objects.filter(variants__isnull=True).order_by('pk')
+		count = 0
+		for image in images.iterator():
+			image.create_variants()
+			count += 1
+		self.stdout.write(f"Made the variants of {count} product images.")
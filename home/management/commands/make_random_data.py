@@ -1,4 +1,5 @@
 from django.core.management.base import BaseCommand
+from django.core.management import call_command
 from django.contrib.auth import get_user_model
 from django.core.files import File
 from faker import Faker
@@ -51,7 +52,6 @@ class Command(BaseCommand):
 		product.created_at = get_random_date()
 		product.updated_at = get_random_date()
 		product.save()
-		product.create_stripe_product_and_price_objs()
 		return product
 
 	@staticmethod
@@ -154,6 +154,8 @@ class Command(BaseCommand):
 			product = self.create_random_product(superuser, i)
 			self.create_random_product_image(product, superuser)
 			self.stdout.write(f"{i+1}/{count*2} count of product objects created.")
+		# Create the products on stripe all at once
+		call_command('sync_stripe_catalog')
 
 		all_products = list(Product.objects.all())
 		# Make users, addresses, carts, cart items, orders,
@@ -164,8 +166,9 @@ class Command(BaseCommand):
 			self.create_random_blog_posts(user, i)
 
 			# Make cart items
-			for _ in range(random.randrange(4)):  # 0-3 (not including 4)
-				self.create_random_cart_item(cart, random.choice(all_products), user)
+			# A cart can only have 1 cart item per product, so pick distinct products
+			for product in random.sample(all_products, min(random.randrange(4), len(all_products))):  # 0-3 (not including 4)
+				self.create_random_cart_item(cart, product, user)
 			self.create_random_order(cart, user)
 			self.stdout.write(f"{i+1}/{count} count of other objects created.")
 
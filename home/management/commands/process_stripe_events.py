@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from home.models import StripeEvent
+from senior_project.constants import STRIPE_EVENT_BATCH_SIZE
+import time
+
+
+class Command(BaseCommand):
+	help = 'Processes stripe webhook events in batches, such as creating orders. Ran by the stripe_worker dyno with --loop.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--batch-size', type=int, default=STRIPE_EVENT_BATCH_SIZE, help='The max number of events processed per batch.')
+		parser.add_argument('--loop', action='store_true', help='Keep processing events as they are received.')
+		parser.add_argument('--sleep', type=float, default=1, help='Seconds to wait when there are no events to process (with --loop).')
+
+	def handle(self, *args, **options):
+		while True:
+			processed, failed = StripeEvent.process_pending_events(options['batch_size'])
+			if processed or failed:
+				self.stdout.write(f"Processed {processed} events, {failed} failed.")
+
+			if not options['loop']:
+				break
+			# Process the next batch right away if this batch was full
+			if processed + failed < options['batch_size']:
+				time.sleep(options['sleep'])
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from home.models import OrderDailyStats
+
+
+class Command(BaseCommand):
+	help = 'Rebuilds the OrderDailyStats table, used by the report charts, from the orders. Ran by reset_db.'
+
+	def handle(self, *args, **options):
+		rows = OrderDailyStats.rebuild()
+		self.stdout.write(f"OrderDailyStats rebuilt, {rows} rows created.")
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from home.models import Product
+
+
+class Command(BaseCommand):
+	help = "Recalculates each product's units_sold from the purchased carts and reports the products that were wrong. Ran by reset_db."
+
+	def add_arguments(self, parser):
+		parser.add_argument('--dry-run', action='store_true', help="Only report the products, don't update them.")
+
+	def handle(self, *args, **options):
+		drift = Product.reconcile_units_sold(fix=not options['dry_run'])
+		for product, saved, recalculated in drift:
+			self.stdout.write(f"{product.name} (ID {product.pk}): units_sold was {saved}, recalculated {recalculated}.")
+		action = 'found' if options['dry_run'] else 'fixed'
+		self.stdout.write(f"{len(drift)} products with the wrong units_sold {action}.")
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from home.models import StockReservation
+
+
+class Command(BaseCommand):
+	help = 'Deletes expired stock reservations. Ran by the Heroku Scheduler addon every 10 minutes.'
+
+	def handle(self, *args, **options):
+		deleted = StockReservation.delete_expired_reservations()
+		self.stdout.write(f"Deleted {deleted} expired stock reservations.")
@@ -9,3 +9,5 @@ class Command(BaseCommand):
         call_command('delete_data')
         call_command('make_dummy_users')
         call_command('make_data')
+        call_command('rebuild_order_daily_stats')
+        call_command('reconcile_units_sold')
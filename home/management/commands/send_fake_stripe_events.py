@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.shortcuts import reverse
+from home.models import Cart
+from senior_project.fake_stripe import make_checkout_session_completed_event, get_signed_event
+from senior_project.utils import get_full_url
+from collections import Counter
+import requests
+
+
+class Command(BaseCommand):
+	help = 'Posts signed fake checkout.session.completed events for active carts to the stripe webhook. Used for load tests.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--count', type=int, default=10, help='The max number of carts to send events for.')
+		parser.add_argument('--repeat', type=int, default=1, help='How many times each event is sent, stripe can send an event more than once.')
+		parser.add_argument('--url', default=None, help='The webhook URL. The site\'s stripe-webhook URL by default.')
+
+	def handle(self, *args, **options):
+		url = options['url'] or get_full_url(reverse('home:stripe-webhook'))
+		carts = Cart.objects.filter(status=Cart.ACTIVE, cartitem__isnull=False, order__isnull=True).distinct()[:options['count']]
+		status_codes = Counter()
+		with requests.Session() as session:
+			for cart in carts:
+				amount_total = int(cart.get_total_cart_price() * 100)
+				event = make_checkout_session_completed_event(cart.uuid, amount_total)
+				payload, signature = get_signed_event(event)
+				for _ in range(options['repeat']):
+					response = session.post(url, data=payload, headers={'Stripe-Signature': signature, 'Content-Type': 'application/json'})
+					status_codes[response.status_code] += 1
+		self.stdout.write(f"Sent {sum(status_codes.values())} events to {url}. Responses: {dict(status_codes)}")
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from home.models import QueuedEmail
+from senior_project.constants import EMAIL_BATCH_SIZE
+import time
+
+
+class Command(BaseCommand):
+	help = 'Sends queued emails in batches over 1 SMTP connection. Ran by the worker dyno with --loop.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--batch-size', type=int, default=EMAIL_BATCH_SIZE, help='The max number of emails sent per batch.')
+		parser.add_argument('--loop', action='store_true', help='Keep sending emails as they are queued.')
+		parser.add_argument('--sleep', type=float, default=5, help='Seconds to wait when there are no emails to send (with --loop).')
+
+	def handle(self, *args, **options):
+		while True:
+			try:
+				sent, failed = QueuedEmail.send_queued_emails(options['batch_size'])
+			except Exception as e:
+				# Likely the SMTP server is down, the batch is left as is and retried
+				if not options['loop']:
+					raise
+				self.stderr.write(f"Could not send emails: {e!r}")
+				sent, failed = 0, 0
+			if sent or failed:
+				self.stdout.write(f"Sent {sent} emails, {failed} failed.")
+
+			if not options['loop']:
+				break
+			# Send the next batch right away if this batch was full
+			if sent + failed < options['batch_size']:
+				time.sleep(options['sleep'])
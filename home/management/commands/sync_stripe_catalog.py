@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from senior_project.stripe_catalog import sync_stripe_catalog
+from senior_project.constants import STRIPE_SYNC_WORKERS, STRIPE_SYNC_REQUESTS_PER_SECOND
+from collections import Counter
+
+
+class Command(BaseCommand):
+	help = (
+		"Syncs the products to stripe. Creates the products that aren't on stripe, reactivates the inactive ones, "
+		'creates prices for changed prices and deactivates stripe products that no product uses. '
+		'To run it without stripe, set STRIPE_GATEWAY=senior_project.stripe_gateway.FakeStripeGateway (kept in memory) '
+		'or STRIPE_API_BASE to a local fake stripe server such as stripe-mock.'
+	)
+
+	def add_arguments(self, parser):
+		parser.add_argument('--workers', type=int, default=STRIPE_SYNC_WORKERS, help='The number of threads calling stripe.')
+		parser.add_argument('--requests-per-second', type=float, default=STRIPE_SYNC_REQUESTS_PER_SECOND, help='The max number of stripe requests a second.')
+		parser.add_argument('--dry-run', action='store_true', help='Only show the changes.')
+
+	def handle(self, *args, **options):
+		changes, errors = sync_stripe_catalog(options['workers'], options['requests_per_second'], options['dry_run'])
+		if options['dry_run']:
+			self.stdout.write(
+				f"Products to create: {len(changes['create'])}. Products to reactivate: {len(changes['reactivate'])}. "
+				f"Prices to update: {len(changes['update_price'])}. "
+				f"Stripe products to deactivate: {len(changes['deactivate'])}."
+			)
+		else:
+			failed = Counter(task for (task, item), error in errors)
+			self.stdout.write(
+				f"Created {len(changes['create']) - failed['create']} products, "
+				f"reactivated {len(changes['reactivate']) - failed['reactivate']} products, "
+				f"updated {len(changes['update_price']) - failed['update_price']} prices and "
+				f"deactivated {len(changes['deactivate']) - failed['deactivate']} stripe products."
+			)
+		for (task, item), error in errors:
+			self.stderr.write(f"Could not {task} {item}: {error!r}")
+		if errors:
+			self.stderr.write(f"{len(errors)} changes failed, run the command again to retry them.")
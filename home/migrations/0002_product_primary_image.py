@@ -0,0 +1,28 @@
+# Generated by Django 4.2 on 2026-10-18 20:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def set_primary_images(apps, schema_editor):
+    """Points each existing product at its first image."""
+    Product = apps.get_model('home', 'Product')
+    ProductImage = apps.get_model('home', 'ProductImage')
+    first_image = ProductImage.objects.filter(product=models.OuterRef('pk')).order_by('pk').values('pk')[:1]
+    Product.objects.update(primary_image=models.Subquery(first_image))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='primary_image',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='home.productimage'),
+        ),
+        migrations.RunPython(set_primary_images, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2 on 2026-10-18 20:26
+
+from django.db import migrations, models
+
+
+def merge_duplicate_cart_items(apps, schema_editor):
+    """Merges CartItems of the same product in the same cart into 1 CartItem so the constraint can be added."""
+    CartItem = apps.get_model('home', 'CartItem')
+    duplicates = CartItem.objects.values('cart', 'product').annotate(total=models.Count('id')).filter(total__gt=1)
+    for duplicate in duplicates:
+        cart_items = list(CartItem.objects.filter(cart=duplicate['cart'], product=duplicate['product']).order_by('pk'))
+        kept = cart_items[0]
+        kept.quantity = sum(cart_item.quantity for cart_item in cart_items)
+        kept.save()
+        CartItem.objects.filter(pk__in=[cart_item.pk for cart_item in cart_items[1:]]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0003_product_catalog_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_cart_items, migrations.RunPython.noop),
+    ]
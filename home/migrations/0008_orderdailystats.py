@@ -0,0 +1,58 @@
+# Generated by Django 4.2 on 2026-10-18 20:37
+
+from django.db import migrations, models
+from django.db.models.functions import TruncDate
+
+
+def build_order_daily_stats(apps, schema_editor):
+    """Fills OrderDailyStats from the existing orders, the same as OrderDailyStats.rebuild()."""
+    Order = apps.get_model('home', 'Order')
+    CartItem = apps.get_model('home', 'CartItem')
+    OrderDailyStats = apps.get_model('home', 'OrderDailyStats')
+    orders = Order.objects.annotate(date=TruncDate('created_at')).values('date', 'status').annotate(
+        order_count=models.Count('id'), revenue=models.Sum('total_price')
+    ).order_by()
+    units = CartItem.objects.filter(cart__order__isnull=False).annotate(date=TruncDate('cart__order__created_at')).values(
+        'date', 'cart__order__status'
+    ).annotate(units=models.Sum('quantity')).order_by()
+    units = {(row['date'], row['cart__order__status']): row['units'] for row in units}
+    OrderDailyStats.objects.bulk_create([
+        OrderDailyStats(
+            date=row['date'],
+            status=row['status'],
+            order_count=row['order_count'],
+            revenue=row['revenue'],
+            units=units.get((row['date'], row['status']), 0),
+        )
+        for row in orders
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0007_queuedemail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('status', models.CharField(choices=[('Placed', 'Placed'), ('Shipped', 'Shipped'), ('Delivered', 'Delivered'), ('Canceled', 'Canceled')], max_length=50)),
+                ('order_count', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('units', models.IntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Order daily stats',
+                'verbose_name_plural': 'Order daily stats',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='orderdailystats',
+            constraint=models.UniqueConstraint(fields=('date', 'status'), name='unique_order_daily_stats'),
+        ),
+        migrations.RunPython(build_order_daily_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2 on 2026-10-18 20:39
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def set_units_sold(apps, schema_editor):
+    """Sets each product's units_sold from the CartItems of purchased (inactive) carts."""
+    Product = apps.get_model('home', 'Product')
+    CartItem = apps.get_model('home', 'CartItem')
+    units_sold = CartItem.objects.filter(product=models.OuterRef('pk'), cart__status='Inactive').values('product').annotate(
+        total=models.Sum('quantity')
+    ).values('total')
+    Product.objects.update(units_sold=Coalesce(models.Subquery(units_sold), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0009_product_units_sold'),
+    ]
+
+    operations = [
+        migrations.RunPython(set_units_sold, migrations.RunPython.noop),
+    ]
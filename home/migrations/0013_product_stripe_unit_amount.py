@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 21:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0012_stripeevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='stripe_unit_amount',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
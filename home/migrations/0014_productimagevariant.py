@@ -0,0 +1,29 @@
+# Generated by Django 4.2 on 2026-10-18 21:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0013_product_stripe_unit_amount'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductImageVariant',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('width', models.PositiveIntegerField()),
+                ('height', models.PositiveIntegerField()),
+                ('format', models.CharField(choices=[('WEBP', 'WEBP'), ('JPEG', 'JPEG')], max_length=10)),
+                ('file', models.ImageField(upload_to='product_images/variants/')),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='variants', to='home.productimage')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='productimagevariant',
+            constraint=models.UniqueConstraint(fields=('image', 'format', 'width'), name='unique_product_image_variant'),
+        ),
+    ]
@@ -1,22 +1,34 @@
-from django.core.mail import send_mail
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.core.validators import RegexValidator, MinValueValidator
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.conf import settings
 from django.shortcuts import reverse
-from django.db.models.functions import ExtractYear, Coalesce
-from django.db.models import Count, Sum, Q
+from django.core.files.base import ContentFile
+from django.utils import timezone
+from django.db.models.functions import ExtractYear, Coalesce, Greatest, TruncDate
+from django.db.models import Count, Sum, Q, F, Value, Subquery, OuterRef, ExpressionWrapper, Prefetch
 from django.contrib import messages
 from ckeditor.fields import RichTextField
-from senior_project.utils import format_datetime, get_protocol, get_domain, get_full_url
-from senior_project.exceptions import MoreThanOneActiveCartError, MoreThanOneCartItemError, ErrorCreatingAStripeProduct, ErrorUpdatingAStripeProduct, ErrorDeletingAStripeProduct, ErrorCreatingStripeCheckoutSession, MultipleOrdersForCart
-from senior_project.constants import MONTHS
+from senior_project.stripe_gateway import get_stripe_gateway
+from senior_project.storage import delete_files
+from senior_project.images import make_image_variants, clean_image, get_image_variant_root, get_image_variant_name
+from senior_project.utils import format_datetime, get_protocol, get_domain, get_full_url, encode_cursor, decode_cursor, get_year_monthly_counts, get_local_date, invalidate_reports_cache
+from senior_project.exceptions import MoreThanOneActiveCartError, NotEnoughStockError, ErrorCreatingAStripeProduct, ErrorUpdatingAStripeProduct, ErrorDeletingAStripeProduct, ErrorCreatingStripeCheckoutSession, MultipleOrdersForCart
+from senior_project.constants import MONTHS, CATALOG_PAGE_SIZE, STOCK_RESERVATION_MINUTES, EMAIL_BATCH_SIZE, EMAIL_MAX_ATTEMPTS, EMAIL_RETRY_BACKOFF_SECONDS, EMAIL_LEASE_SECONDS, EXPORT_CHUNK_SIZE, STRIPE_EVENT_BATCH_SIZE, STRIPE_EVENT_MAX_ATTEMPTS, STRIPE_EVENT_RETRY_BACKOFF_SECONDS, STRIPE_EVENT_LEASE_SECONDS, IMAGE_UPLOAD_WORKERS
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from decimal import Decimal
 import uuid
 import stripe
 import environ
 import csv
+import os
+import itertools
+import logging
 
 
+logger = logging.getLogger(__name__)
+
 env = environ.Env(
 	# set casting, default value
 	DEBUG=(bool, False)
@@ -80,9 +92,18 @@ class Product(TimestampCreatorMixin):
 			for stripe payments to work.
 	stripe_price_id: the price ID on stripe.
 		- Stores the price object ID that's on stripe.
+	stripe_unit_amount: the unit_amount (price in cents) of the stripe price object.
+		- Saved whenever a stripe price is created, so updating a product doesn't have to retrieve the price from stripe
+			to know if it changed. Null if it's not known yet.
+	primary_image: the image displayed for the product on listing pages such as the home page.
+		- Points to the first image uploaded for the product, so listing pages don't have to query every product's images.
+	units_sold: the number of units of the product that have been purchased.
+		- Incremented by Cart.handle_cart_purchase(). The reconcile_units_sold command recalculates it from the carts.
 	"""
 	ACTIVE = 'Active'
 	INACTIVE = 'Inactive'
+	# The fields the products report can be sorted by, see get_table_data()
+	REPORT_SORT_FIELDS = ['stock', 'price', 'estimated_delivery_date']
 	name = models.CharField(default='', max_length=50)
 	description = models.TextField(default='', max_length=500, blank=True, null=True)
 	extra_description = RichTextField(default='', blank=True, null=True)
@@ -93,6 +114,9 @@ class Product(TimestampCreatorMixin):
 	stock_overflow = models.PositiveIntegerField(default=0)
 	stripe_product_id = models.CharField(default='', max_length=50)
 	stripe_price_id = models.CharField(default='', max_length=50)
+	stripe_unit_amount = models.PositiveIntegerField(null=True, blank=True)
+	primary_image = models.ForeignKey('ProductImage', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+	units_sold = models.PositiveIntegerField(default=0)
 
 	def __str__(self):
 		return self.name
@@ -122,121 +146,237 @@ class Product(TimestampCreatorMixin):
 
 	def get_images(self):
 		"""
-		An abstraction for productimage_set.all()
+		An abstraction for productimage_set.all(). The images' variants are prefetched for get_srcsets().
 		@return: a QuerySet of ProductImages associated with the Product.
 		"""
-		images = self.productimage_set.all()
+		images = self.productimage_set.prefetch_related('variants')
 		return images
 
 	def get_first_image_url(self):
-		if self.productimage_set.first():
-			return self.productimage_set.first().image.url
+		"""
+		Uses the primary_image pointer instead of querying productimage_set.
+		get_active_products() selects the primary image in the same query as the products.
+		@return: the URL of the product's primary image, None if the product has no images.
+		"""
+		if self.primary_image:
+			return self.primary_image.image.url
 
 	def save_images(self, files: list):
 		"""
 		Saves a list of images and associates them with the product.
+		The images and their variants are uploaded from IMAGE_UPLOAD_WORKERS threads at the same time, large files are
+		uploaded in parts (see AWS_S3_TRANSFER_CONFIG). Then the ProductImages and their variants are saved with 1
+		bulk_create each. If an upload or the bulk_create fails, the uploaded files are deleted and nothing is saved.
 		@param files: a list.
-		@return: nothing.
-		"""
+		@return: a list of the new ProductImages. The exception is raised if an upload failed.
+		"""
+		if not files:
+			return []
+		field = ProductImage._meta.get_field('image')
+		# The names are chosen here, 2 threads uploading files with the same name could choose the same available name
+		names = []
+		variant_roots = []
 		for file in files:
-			ProductImage.objects.create(
-				product=self,
-				image=file,
-				creator=self.creator,
-				updater=self.creator,
-			)
+			name = field.generate_filename(None, os.path.basename(file.name))
+			while name in names:
+				root, ext = os.path.splitext(name)
+				name = field.storage.get_alternative_name(root, ext)
+			names.append(name)
+			variant_root = get_image_variant_root(name)
+			while variant_root in variant_roots:
+				variant_root = field.storage.get_alternative_name(variant_root, '')
+			variant_roots.append(variant_root)
+
+		uploaded = []
+		try:
+			executor = ThreadPoolExecutor(max_workers=IMAGE_UPLOAD_WORKERS)
+			try:
+				results = list(executor.map(ProductImage.upload_files, files, names, variant_roots, itertools.repeat(uploaded)))
+			finally:
+				# Waits for the running uploads, so every uploaded file is in `uploaded`
+				executor.shutdown(cancel_futures=True)
+
+			with transaction.atomic():
+				images = ProductImage.objects.bulk_create([
+					ProductImage(product=self, image=name, creator=self.creator, updater=self.creator)
+					for name, variants in results
+				])
+				# The first image uploaded for a product becomes its primary image
+				if Product.objects.filter(pk=self.pk, primary_image__isnull=True).update(primary_image=images[0]):
+					self.primary_image = images[0]
+				ProductImageVariant.objects.bulk_create([
+					ProductImageVariant(image=image, **variant)
+					for image, (name, variants) in zip(images, results)
+					for variant in variants
+				])
+		except Exception:
+			delete_files(uploaded)
+			raise
+		return images
 
-	def delete_images(self):
+	def delete_images(self, keep=()):
 		"""
-		Deletes the images associated with the product by calling the overridden delete() method directly.
+		Deletes the images associated with the product, see ProductImage.bulk_delete().
+		@param keep: ProductImages to not delete.
 		@return: nothing.
 		"""
-		for image in self.get_images():
-			image.delete()
+		ProductImage.bulk_delete(self.get_images().exclude(pk__in=[image.pk for image in keep]))
 
 	@classmethod
 	def get_active_products(cls):
 		"""
-		@return: a QuerySet of products with status=ACTIVE.
+		@return: a QuerySet of products with status=ACTIVE. Each product's primary image is fetched in the same query,
+			and the primary images' variants in 1 more query.
 		"""
-		products = cls.objects.filter(status=cls.ACTIVE).order_by('-created_at')
+		products = cls.objects.filter(status=cls.ACTIVE).select_related('primary_image').prefetch_related('primary_image__variants').order_by('-created_at')
 		return products
 
+	@classmethod
+	def get_catalog_page(cls, cursor=None, min_price=None, max_price=None, in_stock=False, page_size=CATALOG_PAGE_SIZE):
+		"""
+		Gets a page of active products for the home page.
+		Uses keyset pagination on (created_at, id) so every page costs the same no matter how deep it is.
+		@param cursor: the next_cursor returned with the previous page. None for the first page.
+		@param min_price: only include products that cost at least this much.
+		@param max_price: only include products that cost at most this much.
+		@param in_stock: only include products that are in stock.
+		@param page_size: the number of products in a page.
+		@return: a tuple of (a list of products, the cursor for the next page or None if it's the last page).
+		"""
+		products = cls.get_active_products().order_by('-created_at', '-id')
+		if min_price is not None:
+			products = products.filter(price__gte=min_price)
+		if max_price is not None:
+			products = products.filter(price__lte=max_price)
+		if in_stock:
+			products = products.filter(stock__gt=0)
+		if cursor:
+			created_at, pk = decode_cursor(cursor)
+			products = products.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+
+		# Get 1 extra product to know if there's a next page
+		products = list(products[:page_size + 1])
+		next_cursor = None
+		if len(products) > page_size:
+			products = products[:page_size]
+			next_cursor = encode_cursor(products[-1].created_at, products[-1].pk)
+		return products, next_cursor
+
+	def get_stripe_idempotency_key(self, action):
+		"""
+		Stripe remembers idempotency keys for 24 hours. IDs restart when the DB is reset, so the key also has when the
+		product was created.
+		@param action: what the key is for. Ex: 'create'
+		@return: an idempotency key for a stripe call about the product.
+		"""
+		created_at = int(self.created_at.timestamp() * 1000000) if self.created_at else 0
+		return f'product-{self.pk}-{created_at}-{action}'
+
+	def get_stripe_unit_amount(self):
+		"""
+		@return: the price in cents, how stripe stores prices.
+		"""
+		return int(self.price * 100)
+
+	def push_stripe_product_and_price(self, gateway, url=None):
+		"""
+		Creates a stripe product and price object for the product. Doesn't save the product.
+		The idempotency keys are made from the product's ID, so a retried call doesn't create 2 stripe products.
+		@param gateway: the StripeGateway.
+		@param url: the product page's full URL. Found from the Site by default.
+		@return: a tuple of (stripe product ID, stripe price ID). Raises a stripe.error.StripeError if a call fails.
+		"""
+		# Create product on stripe
+		stripe_product = gateway.create_product(
+			name=self.name,
+			url=url or get_full_url(self.get_read_url()),
+			idempotency_key=self.get_stripe_idempotency_key('create'),
+		)
+
+		# Associate a price with that stripe product
+		stripe_price = gateway.create_price(
+			product_id=stripe_product.id,
+			unit_amount=self.get_stripe_unit_amount(),
+			idempotency_key=self.get_stripe_idempotency_key('create-price'),
+		)
+		return stripe_product.id, stripe_price.id
+
+	def push_stripe_price(self, gateway, **product_params):
+		"""
+		Creates a stripe price object for the product's current price and makes it the stripe product's default price.
+		The old stripe price object is set as inactive. Doesn't save the product.
+		@param gateway: the StripeGateway.
+		@param product_params: other stripe product fields to update in the same call. Ex: name='...'
+		@return: the new stripe price ID. Raises a stripe.error.StripeError if a call fails.
+		"""
+		# Create a new stripe price obj. The key includes the old price, so changing the price back later
+		# creates another price.
+		unit_amount = self.get_stripe_unit_amount()
+		stripe_price = gateway.create_price(
+			product_id=self.stripe_product_id,
+			unit_amount=unit_amount,
+			idempotency_key=self.get_stripe_idempotency_key(f'price-{self.stripe_price_id}-{unit_amount}'),
+		)
+
+		# Update the stripe product obj and set the newly created price as the default
+		gateway.modify_product(
+			self.stripe_product_id,
+			default_price=stripe_price.id,
+			**product_params
+		)
+
+		# This is performed after creating a new stripe price obj and updating the product price obj
+		# Because if it were the default price, then it would cause an error.
+		if self.stripe_price_id:
+			gateway.modify_price(
+				self.stripe_price_id,
+				active=False
+			)
+		return stripe_price.id
+
 	def create_stripe_product_and_price_objs(self):
 		"""
 		Creates a stripe product and price object. And associates them with the product.
+		Use the sync_stripe_catalog command to create many products on stripe at once.
 		@return: nothing, ErrorCreatingAStripeProduct() exception otherwise.
 		"""
 		try:
-			# Create product on stripe
-			stripe_product = stripe.Product.create(
-				name=self.name,
-				url=get_full_url(self.get_read_url())
-			)
-
-			# Associate a price with that stripe product
-			stripe_price = stripe.Price.create(
-				unit_amount=int(self.price * 100),
-				currency="usd",
-				product=stripe_product.id,
-			)
-
-			# Add the product and price ID's to the new product instance
-			self.stripe_product_id = stripe_product.id
-			self.stripe_price_id = stripe_price.id
-			self.save()
-		except:
+			stripe_product_id, stripe_price_id = self.push_stripe_product_and_price(get_stripe_gateway())
+		except stripe.error.StripeError as e:
 			self.delete()
-			raise ErrorCreatingAStripeProduct("An error occurred with creating a product on stripe. The product was deleted to avoid confusion and further errors.")
+			raise ErrorCreatingAStripeProduct("An error occurred with creating a product on stripe. The product was deleted to avoid confusion and further errors.") from e
+
+		# Add the product and price ID's to the new product instance
+		self.stripe_product_id = stripe_product_id
+		self.stripe_price_id = stripe_price_id
+		self.stripe_unit_amount = self.get_stripe_unit_amount()
+		self.save()
 
 	def update_stripe_product_and_price_objs(self):
 		"""
 		Updates the stripe product and stripe price objects.
-		Will not update the price if no price change has occurred.
+		Will not update the price if no price change has occurred, the last price sent to stripe is saved in
+		stripe_unit_amount so it's only retrieved from stripe when it's not known.
 		Will not update the product from the DB if an exception happens.
 		@return: nothing, ErrorUpdatingAStripeProduct() exception otherwise.
 		"""
+		gateway = get_stripe_gateway()
+		product_params = {'name': self.name, 'url': get_full_url(self.get_read_url())}
 		try:
-			# Update product on stripe
-			stripe_product = stripe.Product.modify(
-				self.stripe_product_id,
-				name=self.name,
-				url=get_full_url(self.get_read_url())
-			)
+			if self.stripe_unit_amount is None:
+				self.stripe_unit_amount = gateway.retrieve_price(self.stripe_price_id).unit_amount
 
-			# Mark the old stripe price object as inactive.
-			# You can't delete a price object.
+			# If the price has changed, create a new price obj and update the product in the same call.
 			# You cannot modify the unit_amount (price) of a price object, you have to create a new one.
-			old_stripe_price = stripe.Price.retrieve(self.stripe_price_id)
-			# If the price has not changed, do nothing.
-			if (old_stripe_price.unit_amount / 100) == self.price:
-				pass
+			if self.stripe_unit_amount != self.get_stripe_unit_amount():
+				self.stripe_price_id = self.push_stripe_price(gateway, **product_params)
+				self.stripe_unit_amount = self.get_stripe_unit_amount()
 			else:
-				# Create a new stripe price obj
-				stripe_price = stripe.Price.create(
-					unit_amount=int(self.price * 100),
-					currency="usd",
-					product=stripe_product.id
-				)
-
-				# Update the stripe product obj and set the newly created price as the default
-				stripe_product = stripe.Product.modify(
-					self.stripe_product_id,
-					default_price=stripe_price.id
-				)
-
-				# This is performed after creating a new stripe price obj and updating the product price obj
-				# Because if it were the default price, then it would cause an error.
-				stripe.Price.modify(
-					self.stripe_price_id,
-					active=False
-				)
-				self.stripe_price_id = stripe_price.id
-			self.stripe_product_id = stripe_product.id
-			self.save()  # only save the newly creating product when the stripe product was successfully updated
-		except:
+				gateway.modify_product(self.stripe_product_id, **product_params)
+		except stripe.error.StripeError as e:
 			raise ErrorUpdatingAStripeProduct(
-				"An error occurred with updating a product on stripe. The product was not saved to avoid confusion and further errors.")
+				"An error occurred with updating a product on stripe. The product was not saved to avoid confusion and further errors.") from e
+		self.save()  # only save the newly creating product when the stripe product was successfully updated
 
 	def delete_product_and_set_stripe_product_as_inactive(self):
 		"""
@@ -248,16 +388,16 @@ class Product(TimestampCreatorMixin):
 		try:
 			# Stripe products cannot be deleted if they have price object references, which also can't be deleted.
 			# Therefor the only way to "delete" them is to set them as inactive.
-			stripe.Product.modify(
+			get_stripe_gateway().modify_product(
 				self.stripe_product_id,
 				active=False
 			)
-
-			self.delete_images()
-			self.delete()
-		except:
+		except stripe.error.StripeError as e:
 			raise ErrorDeletingAStripeProduct(
-				"An error occurred with deleting a product on stripe. The product was not deleted.")
+				"An error occurred with deleting a product on stripe. The product was not deleted.") from e
+
+		self.delete_images()
+		self.delete()
 
 	@classmethod
 	def get_top_10_selling_products(cls):
@@ -265,49 +405,70 @@ class Product(TimestampCreatorMixin):
 		Gets the top 10 setting products and how many of each were sold.
 		@return: a tuple of 2 lists. (product names, total sold).
 		"""
-		top_products = cls.objects.annotate(
-			total_sold=Coalesce(Sum('cartitem__quantity', filter=Q(cartitem__cart__status=Cart.INACTIVE)), 0)
-		).order_by('-total_sold')[:10]
-		product_names = [product.name for product in top_products]
-		total_solds = [product.total_sold if product.total_sold else 0 for product in top_products]
+		top_products = cls.objects.order_by('-units_sold', 'id').values_list('name', 'units_sold')[:10]
+		product_names = [name for name, units_sold in top_products]
+		total_solds = [units_sold for name, units_sold in top_products]
 		return product_names, total_solds
 
+	@classmethod
+	def reconcile_units_sold(cls, fix=True):
+		"""
+		Recalculates each product's units_sold from the CartItems of purchased (inactive) carts.
+		@param fix: if True, products whose units_sold is wrong are updated.
+		@return: a list of tuples of (product, the saved units_sold, the recalculated units_sold) for the products
+			whose units_sold was wrong.
+		"""
+		products = cls.objects.annotate(
+			recalculated_units_sold=Coalesce(Sum('cartitem__quantity', filter=Q(cartitem__cart__status=Cart.INACTIVE)), 0)
+		).exclude(units_sold=F('recalculated_units_sold')).order_by('pk')
+		drift = []
+		for product in products:
+			drift.append((product, product.units_sold, product.recalculated_units_sold))
+			product.units_sold = product.recalculated_units_sold
+		if fix and drift:
+			cls.objects.bulk_update([product for product, saved, recalculated in drift], ['units_sold'])
+			invalidate_reports_cache()
+		return drift
+
 	def add_product_to_cart(self, user, cart, quantity):
 		"""
 		Adds a product to a cart.
 		If the Product is already in the cart, it adds to the existing quantity of that product.
+		Safe to call concurrently, the unique_cart_product constraint prevents duplicate CartItems.
 		@param user: the User the CartItems will be associated with.
 		@param cart: the cart to add the Product to.
 		@param quantity: the number of units of the product to add to the cart.
-		@return: nothing.
+		@return: the CartItem.
 		"""
-		# Check if a CartItem for the Product is already in the Cart
 		cart_items = CartItem.objects.filter(cart=cart, product=self)
 
-		# A Cart cannot have more than 1 CartItem of the same product.
-		if cart_items.count() > 1:
-			raise MoreThanOneCartItemError(
-				"More than 1 cart items for a product within a cart were found. A Cart cannot have more than 1 CartItem of the same product."
-			)
+		# If the Product has a CartItem associated with it in the Cart, increment the quantity in a single UPDATE
+		# so concurrent adds can't overwrite each other.
+		if cart_items.update(quantity=F('quantity') + quantity, updater=user, updated_at=timezone.now()):
+			return cart_items.get()
+
 		# If the Product has not been added to the Cart, create a CartItem for it
-		elif cart_items.count() < 1:
-			cart_item = CartItem.objects.create(
-				cart=cart,
-				product=self,
-				quantity=quantity,
-				creator=user,
-				updater=user,
-			)
-			return cart_item
-		# If the Product has a CartItem associated with it in the Cart, increment the quantity
-		elif cart_items.count() == 1:
-			cart_item = cart_items.first()
-			cart_item.quantity += quantity
-			cart_item.updater = user
-			cart_item.save()
-			return cart_item
-		else:
-			raise ValueError("Unexpected cart_items model count encountered")
+		try:
+			with transaction.atomic():
+				return CartItem.objects.create(
+					cart=cart,
+					product=self,
+					quantity=quantity,
+					creator=user,
+					updater=user,
+				)
+		except IntegrityError:
+			# Another request created the CartItem first (a Cart can only have 1 CartItem per Product)
+			cart_items.update(quantity=F('quantity') + quantity, updater=user, updated_at=timezone.now())
+			return cart_items.get()
+
+	def get_available_stock(self, exclude_cart=None):
+		"""
+		@param exclude_cart: a cart whose reservations should not count, such as the user's own cart.
+		@return: the stock minus the units held by active stock reservations.
+		"""
+		reserved = StockReservation.get_reserved_quantities([self.pk], exclude_cart=exclude_cart).get(self.pk, 0)
+		return max(self.stock - reserved, 0)
 
 	def get_associated_orders(self):
 		orders = Order.objects.filter(cart__cartitem__product=self)
@@ -316,6 +477,15 @@ class Product(TimestampCreatorMixin):
 	class Meta:
 		verbose_name = 'Product'
 		verbose_name_plural = 'Products'
+		indexes = [
+			# Used by get_catalog_page()
+			models.Index(fields=['status', '-created_at', '-id'], name='product_catalog_idx'),
+			# Used by get_top_10_selling_products()
+			models.Index(fields=['-units_sold', 'id'], name='product_units_sold_idx'),
+			# Used by the products report, see REPORT_SORT_FIELDS
+			models.Index(fields=['stock', 'id'], name='product_stock_idx'),
+			models.Index(fields=['price', 'id'], name='product_price_idx'),
+		]
 
 
 class ProductImage(TimestampCreatorMixin):
@@ -333,11 +503,142 @@ class ProductImage(TimestampCreatorMixin):
 		verbose_name = 'Product image'
 		verbose_name_plural = 'Product images'
 
+	def save(self, *args, **kwargs):
+		is_new = self._state.adding
+		# The variants are made before the upload, so the image is read from the uploaded file instead of from S3
+		variants = make_image_variants(self.image) if is_new else None
+		# The stored image is public, so it's stored without the upload's metadata, such as GPS coordinates
+		if is_new and not self.image._committed:
+			self.image = ContentFile(clean_image(self.image), name=os.path.basename(self.image.name))
+		super(ProductImage, self).save(*args, **kwargs)
+		# The first image uploaded for a product becomes its primary image
+		if is_new:
+			updated = Product.objects.filter(pk=self.product_id, primary_image__isnull=True).update(primary_image=self)
+			if updated:
+				self.product.primary_image = self
+			self.create_variants(variants)
+
 	def delete(self, *args, **kwargs):
-		# Delete the image file associated with this object
+		product_id = self.product_id
+		# Delete the image files associated with this object
+		delete_files(self.variants.values_list('file', flat=True))
 		self.image.delete(save=False)
 		# Call the parent class's delete method to delete the object itself
 		super(ProductImage, self).delete(*args, **kwargs)
+		# If this was the primary image, the product's next image becomes the primary image
+		next_image = ProductImage.objects.filter(product_id=product_id).order_by('pk').values('pk')[:1]
+		Product.objects.filter(pk=product_id, primary_image__isnull=True).update(primary_image=Subquery(next_image))
+
+	def create_variants(self, variants=None):
+		"""
+		Saves the image's ProductImageVariants.
+		@param variants: the output of make_image_variants(). Made from the stored image by default.
+		@return: a list of the ProductImageVariants.
+		"""
+		if variants is None:
+			with self.image.open('rb'):
+				variants = make_image_variants(self.image)
+		return ProductImageVariant.objects.bulk_create([
+			ProductImageVariant(
+				image=self,
+				width=variant['width'],
+				height=variant['height'],
+				format=variant['format'],
+				file=ContentFile(variant['content'], name=get_image_variant_name(get_image_variant_root(self.image.name), variant)),
+			)
+			for variant in variants
+		])
+
+	@classmethod
+	def upload_files(cls, file, name, variant_root, uploaded):
+		"""
+		Uploads an image and its variants without saving any rows, so it can run in a thread. See Product.save_images().
+		The image is stored as clean_image() makes it, without its metadata.
+		@param file: the image file.
+		@param name: the image's file name, with the upload_to directory.
+		@param variant_root: the output of get_image_variant_root(), unique among the files uploaded at the same time.
+		@param uploaded: a list the name of each uploaded file is added to, so they can be deleted if another upload fails.
+		@return: a tuple of (the image's file name, the output of make_image_variants() with the variant's file name
+			as 'file' instead of 'content').
+		"""
+		variants = make_image_variants(file)
+		field = cls._meta.get_field('image')
+		name = field.storage.save(name, ContentFile(clean_image(file)), max_length=field.max_length)
+		uploaded.append(name)
+		variant_field = ProductImageVariant._meta.get_field('file')
+		for variant in variants:
+			variant_name = variant_field.generate_filename(None, get_image_variant_name(variant_root, variant))
+			variant['file'] = variant_field.storage.save(variant_name, ContentFile(variant.pop('content')), max_length=variant_field.max_length)
+			uploaded.append(variant['file'])
+		return name, variants
+
+	def get_srcsets(self):
+		"""
+		Uses variants.all(), so prefetch the variants when getting the srcsets of many images.
+		@return: a dictionary of {format: srcset}. Ex: {'WEBP': 'https://.../image_300.webp 300w, https://.../image_600.webp 600w'}
+		"""
+		srcsets = {}
+		for variant in sorted(self.variants.all(), key=lambda variant: variant.width):
+			srcsets.setdefault(variant.format, []).append(f"{variant.file.url} {variant.width}w")
+		return {format: ', '.join(urls) for format, urls in srcsets.items()}
+
+	@classmethod
+	def bulk_delete(cls, images):
+		"""
+		Deletes many images with 1 SQL delete, then deletes their files with delete_files() which sends 1 S3 request
+		per 1000 files instead of 1 per file. Products whose primary image was deleted get their next image as their
+		primary image. The files are deleted once the caller's transaction commits, and a failed S3 request is logged
+		instead of raised, since it only leaves unused files behind.
+		@param images: a QuerySet of ProductImages.
+		@return: nothing.
+		"""
+		rows = list(images.values_list('pk', 'product_id', 'image'))
+		if not rows:
+			return
+		pks, product_ids, names = zip(*rows)
+		names = list(names) + list(ProductImageVariant.objects.filter(image_id__in=pks).values_list('file', flat=True))
+		with transaction.atomic():
+			# The products' primary_image is set to null by the delete
+			cls.objects.filter(pk__in=pks).delete()
+			next_image = cls.objects.filter(product_id=OuterRef('pk')).order_by('pk').values('pk')[:1]
+			Product.objects.filter(pk__in=set(product_ids), primary_image__isnull=True).update(primary_image=Subquery(next_image))
+
+		def delete_image_files():
+			try:
+				delete_files(names)
+			except Exception:
+				logger.exception("Couldn't delete the files of %s product images.", len(pks))
+
+		transaction.on_commit(delete_image_files)
+
+
+class ProductImageVariant(models.Model):
+	"""
+	A smaller, compressed copy of a ProductImage, made when the image is uploaded. See make_image_variants().
+	Templates list the variants in srcset attributes, so browsers download the smallest image that fits the page.
+	image: the original image.
+	width: the width in pixels.
+	height: the height in pixels.
+	format: the image format.
+		- WEBP: smaller, used by browsers that support it.
+		- JPEG: used by the other browsers.
+	file: the image file.
+	"""
+	WEBP = 'WEBP'
+	JPEG = 'JPEG'
+	image = models.ForeignKey(ProductImage, on_delete=models.CASCADE, related_name='variants')
+	width = models.PositiveIntegerField()
+	height = models.PositiveIntegerField()
+	format = models.CharField(max_length=10, choices=[(WEBP, WEBP), (JPEG, JPEG)])
+	file = models.ImageField(upload_to='product_images/variants/')
+
+	def __str__(self):
+		return f"{self.image} {self.width}w {self.format}"
+
+	class Meta:
+		constraints = [
+			models.UniqueConstraint(fields=['image', 'format', 'width'], name='unique_product_image_variant'),
+		]
 
 
 class ShippingAddress(TimestampCreatorMixin):
@@ -385,6 +686,8 @@ class Cart(TimestampCreatorMixin):
 	"""
 	ACTIVE = 'Active'
 	INACTIVE = 'Inactive'
+	# The session key the active cart's ID is cached under. Used by the navbar's cart_url tag.
+	SESSION_KEY = 'active_cart_id'
 	status = models.CharField(max_length=50, choices=[(ACTIVE, ACTIVE), (INACTIVE, INACTIVE)])
 	uuid = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
 	shipping_address = models.ForeignKey(ShippingAddress, on_delete=models.SET_NULL, null=True, blank=True)
@@ -419,18 +722,26 @@ class Cart(TimestampCreatorMixin):
 	def get_cartitems(self):
 		"""
 		An abstraction for cartitem_set.all()
+		Each CartItem's product is fetched in the same query, so looping over the CartItems and their products
+		doesn't query the DB per CartItem.
+		Each CartItem is annotated with available_stock, the product's stock minus what other carts have reserved.
 		@return: a QuerySet of CartItems associated with the cart.
 		"""
-		items = self.cartitem_set.all()
+		reserved = StockReservation.get_active_reservations().filter(product=OuterRef('product_id')).exclude(cart=self)
+		reserved = reserved.values('product').annotate(total=Sum('quantity')).values('total')
+		items = self.cartitem_set.select_related('product').annotate(
+			available_stock=Greatest(F('product__stock') - Coalesce(Subquery(reserved), 0, output_field=models.IntegerField()), 0, output_field=models.IntegerField())
+		)
 		return items
 
 	def get_total_cart_price(self):
 		"""
+		Calculated by the DB in a single query.
 		@return: a number representing the total price of all items in the cart.
 		"""
-		total = 0
-		for item in self.get_cartitems():
-			total += item.get_total_price()
+		total = self.cartitem_set.aggregate(
+			total=Coalesce(Sum(CartItem.get_total_price_expression()), Value(Decimal('0')), output_field=models.DecimalField(max_digits=10, decimal_places=2))
+		)['total']
 		return total
 
 	def set_shipping_address(self, shipping_address):
@@ -438,27 +749,53 @@ class Cart(TimestampCreatorMixin):
 		self.save()
 
 	@classmethod
-	def get_active_cart_or_create_new_cart(cls, user):
+	def get_active_cart_or_create_new_cart(cls, user, session=None):
 		"""
 		Gets the active cart of creates a new cart. Raises an error if there's more than 1 cart.
 		@param user: the User.
+		@param session: the request's session. If given, the active cart's ID is cached in it.
 		@return: a cart instance. Or raises exceptions if an unexpected cart count occurred.
 		"""
 		cart = cls.objects.filter(status=cls.ACTIVE, creator=user)
 		if cart.count() > 1:  # a user shouldn't have multiple active carts
 			raise MoreThanOneActiveCartError("More than 1 active carts were found.")
 		elif cart.count() == 1:  # there's an active cart associated with the user
-			return cart.first()
+			cart = cart.first()
 		else:  # no active cart associated with the user exists
-			return cls.objects.create(status=cls.ACTIVE, creator=user, updater=user)
+			cart = cls.objects.create(status=cls.ACTIVE, creator=user, updater=user)
+		# Only assign when it changed, assigning marks the session as modified which saves it
+		if session is not None and session.get(cls.SESSION_KEY) != cart.pk:
+			session[cls.SESSION_KEY] = cart.pk
+		return cart
 
 	@classmethod
-	def set_cart_as_inactive(cls, user):
+	def get_cached_active_cart_id(cls, session):
+		"""
+		@param session: the request's session.
+		@return: the active cart ID cached by get_active_cart_or_create_new_cart(), None if nothing is cached.
+		"""
+		return session.get(cls.SESSION_KEY)
+
+	@classmethod
+	def clear_cached_active_cart_id(cls, session):
+		"""
+		Removes the cached active cart ID. Used when the cart is no longer the active cart.
+		@param session: the request's session.
+		@return: nothing.
+		"""
+		session.pop(cls.SESSION_KEY, None)
+
+	@classmethod
+	def set_cart_as_inactive(cls, user, session=None):
 		"""
 		Sets the active cart associated with the user as inactive.
 		@param user: the User.
+		@param session: the request's session. If given, the cached active cart ID is removed from it.
 		@return: nothing. Or raises exceptions if an unexpected cart count occurred.
 		"""
+		if session is not None:
+			cls.clear_cached_active_cart_id(session)
+
 		# First check if there are an unexpected number of active Carts associated with the user
 		carts = cls.objects.filter(status=cls.ACTIVE, creator=user)
 		if carts.count() > 1:  # a user shouldn't have multiple active carts
@@ -478,9 +815,51 @@ class Cart(TimestampCreatorMixin):
 		So set the original price for each cart item in the cart to the current product price.
 		@return: nothing.
 		"""
-		for cart_item in self.get_cartitems():
-			cart_item.original_price = cart_item.product.price
-			cart_item.save()
+		# Copy every product price in a single UPDATE
+		product_price = Product.objects.filter(pk=OuterRef('product_id')).values('price')[:1]
+		self.cartitem_set.update(original_price=Subquery(product_price), updated_at=timezone.now())
+
+	def reserve_stock(self):
+		"""
+		Reserves the stock of the cart's products for STOCK_RESERVATION_MINUTES while the user pays on stripe.
+		Replaces the cart's previous reservations.
+		The products are locked (in primary key order) so concurrent checkouts can't reserve the same units.
+		@return: the datetime the reservations expire. Raises NotEnoughStockError if a product doesn't have enough
+			available stock, nothing is reserved if that happens.
+		"""
+		expires_at = timezone.now() + timedelta(minutes=STOCK_RESERVATION_MINUTES)
+		with transaction.atomic():
+			cart_items = list(self.cartitem_set.all())
+			product_ids = [item.product_id for item in cart_items]
+			products = Product.objects.select_for_update().filter(pk__in=product_ids).order_by('pk')
+			products = {product.pk: product for product in products}
+			reserved = StockReservation.get_reserved_quantities(product_ids, exclude_cart=self)
+
+			for item in cart_items:
+				product = products[item.product_id]
+				if item.quantity > product.stock - reserved.get(product.pk, 0):
+					raise NotEnoughStockError(f"Not enough stock to reserve {item.quantity} of '{product.name}'.")
+
+			self.release_stock()
+			StockReservation.objects.bulk_create([
+				StockReservation(
+					cart=self,
+					product_id=item.product_id,
+					quantity=item.quantity,
+					expires_at=expires_at,
+					creator=self.creator,
+					updater=self.creator,
+				)
+				for item in cart_items
+			])
+		return expires_at
+
+	def release_stock(self):
+		"""
+		Deletes the cart's stock reservations.
+		@return: nothing.
+		"""
+		StockReservation.objects.filter(cart=self).delete()
 
 	def has_out_of_stock_or_inactive_products(self):
 		"""
@@ -507,9 +886,10 @@ class Cart(TimestampCreatorMixin):
 		full_canceled_url = f"{get_protocol()}://{get_domain()}{cancel}"
 		return full_success_url, full_canceled_url
 
-	def create_stripe_checkout_session(self):
+	def create_stripe_checkout_session(self, expires_at=None):
 		"""
 		Creates a stripe checkout session.
+		@param expires_at: when the checkout session should expire. Must be at least 30 minutes from now.
 		@return: a stripe checkout session URL, an ErrorCreatingStripeCheckoutSession() exception otherwise.
 		"""
 		success_url, canceled_url = self.get_payment_success_and_payment_cancel_url()
@@ -525,16 +905,25 @@ class Cart(TimestampCreatorMixin):
 			)
 
 		# Stripe checkout session
+		session_options = {}
+		if expires_at:
+			session_options['expires_at'] = int(expires_at.timestamp())
+		# Each checkout attempt has its own reservation expiry, so it gets its own key
+		attempt = int((expires_at or timezone.now()).timestamp() * 1000000)
 		try:
-			checkout_session = stripe.checkout.Session.create(
+			checkout_session = get_stripe_gateway().create_checkout_session(
+				idempotency_key=f'cart-{self.uuid}-checkout-{attempt}',
 				line_items=line_items,
 				mode='payment',
 				success_url=success_url,
 				cancel_url=canceled_url,
+				# The checkout.session.completed webhook event finds the cart with this
+				client_reference_id=str(self.uuid),
+				**session_options,
 			)
-			return checkout_session.url
-		except:
-			raise ErrorCreatingStripeCheckoutSession("Error creating a stripe checkout session.")
+		except stripe.error.StripeError as e:
+			raise ErrorCreatingStripeCheckoutSession("Error creating a stripe checkout session.") from e
+		return checkout_session.url
 
 	def create_order(self):
 		"""
@@ -550,6 +939,29 @@ class Cart(TimestampCreatorMixin):
 		)
 		return order
 
+	def complete_purchase(self, request=None):
+		"""
+		Turns the paid cart into an order. Creates the order, updates product stock, saves the prices the user paid,
+		queues the order confirmation email and sets the cart as inactive.
+		Called by StripeEvent.process() for the paid checkout session webhook events. The cart is locked and its
+		order is checked first, so an event stripe sends more than once only creates 1 order.
+		@param request: the incoming request, used to show warnings to the user. None when called by the webhook worker.
+		@return: the cart's order.
+		"""
+		with transaction.atomic():
+			# Lock the cart so concurrent calls wait, then see the order made by the first call
+			list(Cart.objects.select_for_update().filter(pk=self.pk))
+			order = self.get_order()
+			if order is not None:
+				return order
+			order = self.create_order()
+			self.handle_cart_purchase(request, order)
+			self.set_original_price_for_all_cart_items()
+			order.send_order_confirmation_email()
+			self.status = Cart.INACTIVE
+			self.save(update_fields=['status', 'updated_at'])
+		return order
+
 	def has_errors(self):
 		"""
 		Uses has_out_of_stock_or_inactive_products() to check if cart has errors.
@@ -590,41 +1002,63 @@ class Cart(TimestampCreatorMixin):
 		Handles what happens if a product became inactive or had its stock reduced while the user was inputting
 		their payment info on the stripe gateway page.
 		Handles updating product stock.
-		@param request: the incoming request.
+		The products are locked while their stock is updated so concurrent checkouts can't sell the same units twice.
+		They're locked in primary key order so concurrent checkouts can't deadlock, and updated in a single query.
+		@param request: the incoming request, used to show warnings to the user. None if there's no request.
 		@param order: the order associated with the cart.
 		@return: nothing.
 		"""
-		for item in self.get_cartitems():
-			product = item.product
-
-			# If item is inactive
-			if item.is_product_inactive():
-				order.has_errors = True
-				order.save()
-				send_mail("Order ERROR", f"An order has been made with an error, it has a product that is inactive. Order ID: {order.pk}", env('ADMIN_EMAIL'), [env('ADMIN_EMAIL')])
-				messages.warning(request, f"'{product.name}' is an inactive product. Contact us regarding this issue. An admin has been notified.")
-
-			# If item quantity > stock
-			if item.is_quantity_gt_stock():
-				order.has_errors = True
-				order.save()
-				product.stock = 0
-				product.stock_overflow = item.quantity - product.stock
-				product.status = Product.INACTIVE
-				product.save()
-				send_mail("Order ERROR", f"An order has been made with an error, the amount of a product ordered is greater than what is in stock. Order ID: {order.pk}", env('ADMIN_EMAIL'), [env('ADMIN_EMAIL')])
-				messages.warning(request, f"The quantity for '{product.name}' exceeds available stock! Contact us regarding this issue. An admin has been notified.")
-
-			# If item quantity <= stock
-			if item.is_quantity_lte_stock():
-				# If product stock is now 0
-				if (product.stock - item.quantity) == 0:
-					product.stock = 0
+		error_emails = []
+		with transaction.atomic():
+			cart_items = list(self.cartitem_set.all())
+			product_ids = [item.product_id for item in cart_items]
+			products = Product.objects.select_for_update().filter(pk__in=product_ids).order_by('pk')
+			products = {product.pk: product for product in products}
+			# Units reserved by other carts that are still paying can't be sold to this cart
+			reserved = StockReservation.get_reserved_quantities(product_ids, exclude_cart=self)
+
+			for item in cart_items:
+				# Use the locked product so the stock is current
+				product = products[item.product_id]
+				item.product = product
+				item.available_stock = max(product.stock - reserved.get(product.pk, 0), 0)
+				product.units_sold += item.quantity
+
+				# If item is inactive
+				if item.is_product_inactive():
+					error_emails.append(f"An order has been made with an error, it has a product that is inactive. Order ID: {order.pk}")
+					if request is not None:
+						messages.warning(request, f"'{product.name}' is an inactive product. Contact us regarding this issue. An admin has been notified.")
+
+				# If item quantity > stock. Only happens if the cart's reservation expired before the payment finished.
+				if item.is_quantity_gt_stock():
+					product.stock_overflow += item.quantity - item.available_stock
+					product.stock -= item.available_stock
 					product.status = Product.INACTIVE
-					product.save()
+					error_emails.append(f"An order has been made with an error, the amount of a product ordered is greater than what is in stock. Order ID: {order.pk}")
+					if request is not None:
+						messages.warning(request, f"The quantity for '{product.name}' exceeds available stock! Contact us regarding this issue. An admin has been notified.")
+				# If item quantity <= stock
 				else:
 					product.stock -= item.quantity
-					product.save()
+					# If product stock is now 0
+					if product.stock == 0:
+						product.status = Product.INACTIVE
+				product.updated_at = timezone.now()
+
+			Product.objects.bulk_update(products.values(), ['stock', 'stock_overflow', 'status', 'units_sold', 'updated_at'])
+			# bulk_update doesn't send signals, the top selling products chart uses units_sold
+			invalidate_reports_cache()
+			# The purchased units are no longer reserved, they're sold
+			self.release_stock()
+
+			if error_emails:
+				order.has_errors = True
+				order.save(update_fields=['has_errors', 'updated_at'])
+
+			# Queued in the same transaction, so the emails are only sent if the purchase is saved
+			for error_email in error_emails:
+				QueuedEmail.queue_mail("Order ERROR", error_email, env('ADMIN_EMAIL'), [env('ADMIN_EMAIL')])
 
 	class Meta:
 		verbose_name = 'Cart'
@@ -649,17 +1083,26 @@ class CartItem(TimestampCreatorMixin):
 	def __str__(self):
 		return self.product.name
 
+	def get_available_stock(self):
+		"""
+		Cart.get_cartitems() annotates available_stock, otherwise it's queried.
+		@return: the Product's stock minus the units reserved by other carts.
+		"""
+		if hasattr(self, 'available_stock'):
+			return self.available_stock
+		return self.product.get_available_stock(exclude_cart=self.cart_id)
+
 	def is_quantity_gt_stock(self):
 		"""
-		@return: a boolean, is CartItem quantity > Product stock?
+		@return: a boolean, is CartItem quantity > Product stock that isn't reserved by other carts?
 		"""
-		return self.quantity > self.product.stock
+		return self.quantity > self.get_available_stock()
 
 	def is_quantity_lte_stock(self):
 		"""
-		@return: a boolean, is CartItem quantity <= Product stock?
+		@return: a boolean, is CartItem quantity <= Product stock that isn't reserved by other carts?
 		"""
-		return self.quantity <= self.product.stock
+		return self.quantity <= self.get_available_stock()
 
 	def is_quantity_zero(self):
 		return self.quantity == 0
@@ -670,12 +1113,83 @@ class CartItem(TimestampCreatorMixin):
 	def get_total_price(self):
 		return self.product.price * self.quantity
 
+	@staticmethod
+	def get_total_price_expression():
+		"""
+		The DB equivalent of get_total_price(). Used to calculate totals in a query instead of in Python.
+		@return: an expression for the product price * quantity.
+		"""
+		return ExpressionWrapper(F('product__price') * F('quantity'), output_field=models.DecimalField(max_digits=10, decimal_places=2))
+
 	def get_total_original_price(self):
 		return self.original_price * self.quantity
 
 	class Meta:
 		verbose_name = 'Cart Item'
 		verbose_name_plural = 'Cart Items'
+		constraints = [
+			# A Cart cannot have more than 1 CartItem of the same product.
+			models.UniqueConstraint(fields=['cart', 'product'], name='unique_cart_product'),
+		]
+
+
+class StockReservation(TimestampCreatorMixin):
+	"""
+	Holds a product's stock for a cart while the user pays on stripe, so other carts can't buy the same units.
+	cart: the cart the stock is reserved for.
+	product: the reserved product.
+	quantity: the number of units reserved.
+	expires_at: when the reservation stops holding stock.
+		- Expired reservations are ignored, and deleted by the release_expired_reservations command.
+	"""
+	cart = models.ForeignKey(Cart, on_delete=models.CASCADE)
+	product = models.ForeignKey(Product, on_delete=models.CASCADE)
+	quantity = models.PositiveIntegerField()
+	expires_at = models.DateTimeField(db_index=True)
+
+	def __str__(self):
+		return f"{self.quantity} of {self.product.name}, expires: {format_datetime(self.expires_at)}"
+
+	def is_expired(self):
+		return self.expires_at <= timezone.now()
+
+	@classmethod
+	def get_active_reservations(cls):
+		"""
+		@return: a QuerySet of reservations that haven't expired.
+		"""
+		return cls.objects.filter(expires_at__gt=timezone.now())
+
+	@classmethod
+	def get_reserved_quantities(cls, product_ids, exclude_cart=None):
+		"""
+		@param product_ids: a list of product IDs.
+		@param exclude_cart: a cart whose reservations should not count.
+		@return: a dictionary of {product ID: the number of units held by active reservations}.
+		"""
+		reservations = cls.get_active_reservations().filter(product_id__in=product_ids)
+		if exclude_cart is not None:
+			reservations = reservations.exclude(cart=exclude_cart)
+		return dict(reservations.values('product').annotate(total=Sum('quantity')).values_list('product', 'total'))
+
+	@classmethod
+	def delete_expired_reservations(cls):
+		"""
+		@return: the number of expired reservations deleted.
+		"""
+		deleted, _ = cls.objects.filter(expires_at__lte=timezone.now()).delete()
+		return deleted
+
+	class Meta:
+		verbose_name = 'Stock reservation'
+		verbose_name_plural = 'Stock reservations'
+		constraints = [
+			models.UniqueConstraint(fields=['cart', 'product'], name='unique_reservation_cart_product'),
+		]
+		indexes = [
+			# Used by get_reserved_quantities()
+			models.Index(fields=['product', 'expires_at'], name='reservation_product_idx'),
+		]
 
 
 class Order(TimestampCreatorMixin):
@@ -700,6 +1214,8 @@ class Order(TimestampCreatorMixin):
 	DELIVERED = 'Delivered'
 	CANCELED = 'Canceled'
 	CHOICES = [(PLACED, PLACED), (SHIPPED, SHIPPED), (DELIVERED, DELIVERED), (CANCELED, CANCELED)]
+	# The fields the orders report can be sorted by, see get_table_data()
+	REPORT_SORT_FIELDS = ['created_at', 'total_price']
 
 	cart = models.OneToOneField(Cart, on_delete=models.CASCADE)
 	total_price = models.DecimalField(max_digits=10, decimal_places=2)
@@ -732,33 +1248,42 @@ class Order(TimestampCreatorMixin):
 		return self.status == Order.CANCELED
 
 	@staticmethod
-	def get_export_data(http_response):
+	def get_export_rows():
 		"""
-		Gets all Order and OrderHistory data and writes it to a TSV file.
+		Gets all Order and OrderHistory data, one row at a time.
 		OrderHistory data is Order data that was saved before a user deletes their account.
-		@param http_response: HttpResponse()
-		@return: a .tsv file with order data.
+		Orders are loaded EXPORT_CHUNK_SIZE at a time, with their user, shipping address and products, so memory use
+		doesn't grow with the number of orders. That's 2 queries per chunk.
+		@return: a generator of rows (lists), starting with the header.
 		"""
-		writer = csv.writer(http_response, delimiter='\t')
-
 		# TSV file header
-		writer.writerow([
+		yield [
 			'Order ID', 'Order date', 'Order total price', 'Order status', 'User email',
 			'Shipping address', 'Ordered products'
-		])
+		]
 
+		cart_items = CartItem.objects.select_related('product').order_by('pk')
+		orders = Order.objects.select_related('creator', 'cart__shipping_address').prefetch_related(
+			Prefetch('cart__cartitem_set', queryset=cart_items)
+		).order_by('pk')
 		# Loop through every Order
-		for order in Order.objects.all():
-			products = []
-			# Loop through every CartItem associated to the order
-			for cart_item in order.cart.get_cartitems():
-				products.append(cart_item.product.name)
-			writer.writerow([order.pk, order.created_at, order.total_price, order.status, order.creator.email, order.cart.shipping_address, products])
+		for order in orders.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+			products = [cart_item.product.name for cart_item in order.cart.cartitem_set.all()]
+			yield [order.pk, order.created_at, order.total_price, order.status, order.creator.email, order.cart.shipping_address, products]
 
 		# Loop through every OrderHistory
-		for order in OrderHistory.objects.all():
-			writer.writerow([order.order_number, order.created_at, order.total_price, order.status, "account deleted", "account deleted", "account deleted"])
+		for order in OrderHistory.objects.order_by('pk').iterator(chunk_size=EXPORT_CHUNK_SIZE):
+			yield [order.order_number, order.created_at, order.total_price, order.status, "account deleted", "account deleted", "account deleted"]
 
+	@staticmethod
+	def get_export_data(http_response):
+		"""
+		Writes all Order and OrderHistory data to a TSV file.
+		@param http_response: HttpResponse(), or any file-like object.
+		@return: a .tsv file with order data.
+		"""
+		writer = csv.writer(http_response, delimiter='\t')
+		writer.writerows(Order.get_export_rows())
 		return writer
 
 	@classmethod
@@ -772,8 +1297,8 @@ class Order(TimestampCreatorMixin):
 
 	def send_order_confirmation_email(self):
 		"""
-		Sends the order confirmation email to the customer.
-		@return: nothing, just sends an email.
+		Queues the order confirmation email to the customer.
+		@return: nothing, the email is sent by the send_queued_emails command.
 		"""
 		subject = 'Order Confirmation'
 		from_email = env('ADMIN_EMAIL')
@@ -800,7 +1325,7 @@ class Order(TimestampCreatorMixin):
 					</body>
 					</html>
 				"""
-		send_mail(subject, html_message, from_email, recipient_list, html_message=html_message)
+		QueuedEmail.queue_mail(subject, html_message, from_email, recipient_list, html_message=html_message)
 
 	@classmethod
 	def get_year_months_total_orders(cls, year):
@@ -809,10 +1334,7 @@ class Order(TimestampCreatorMixin):
 		@return: A tuple of 2 lists. The first list represents the months in a year. The second year is the total orders
 			in that month.
 		"""
-		months_order_totals = []
-		for i, month in enumerate(MONTHS):
-			total = cls.objects.filter(created_at__year=year, created_at__month=i + 1).count()
-			months_order_totals.append(total)
+		months_order_totals = get_year_monthly_counts(OrderDailyStats.objects.all(), 'date', year, total=Sum('order_count'))
 		return MONTHS, months_order_totals
 
 	@classmethod
@@ -820,7 +1342,7 @@ class Order(TimestampCreatorMixin):
 		"""
 		@return: a QuerySet of the years in which an order was created.
 		"""
-		orders = cls.objects.annotate(year=ExtractYear('created_at')).values_list('year', flat=True).distinct().order_by('year')
+		orders = OrderDailyStats.objects.filter(order_count__gt=0).annotate(year=ExtractYear('date')).values_list('year', flat=True).distinct().order_by('year')
 		return orders
 
 	@classmethod
@@ -829,12 +1351,18 @@ class Order(TimestampCreatorMixin):
 		@return: a QuerySet of order statuses and counts.
 			Ex: QuerySet [{'status': 'Canceled', 'total': 2}, {'status': 'Delivered', 'total': 1}]
 		"""
-		order_statuses = cls.objects.values('status').annotate(total=Count('id'))
+		order_statuses = OrderDailyStats.objects.values('status').annotate(total=Sum('order_count')).filter(total__gt=0).order_by('status')
 		return order_statuses
 
 	class Meta:
 		verbose_name = 'Order'
 		verbose_name_plural = 'Orders'
+		indexes = [
+			# Used by the orders report, see REPORT_SORT_FIELDS.
+			# With a status filter the DB scans the index until it finds a page of matching orders.
+			models.Index(fields=['created_at', 'id'], name='order_created_at_idx'),
+			models.Index(fields=['total_price', 'id'], name='order_total_price_idx'),
+		]
 
 
 # If a user deletes their account, OrderHistory is a backup for their orders
@@ -865,3 +1393,377 @@ class OrderHistory(models.Model):
 	class Meta:
 		verbose_name = "Order History"
 		verbose_name_plural = "Order Histories"
+
+
+# The number of orders, revenue and units sold per day and order status. Read by the report charts.
+class OrderDailyStats(models.Model):
+	"""
+	Kept up to date when orders are created, changed or deleted, see home/signals.py.
+	Can be rebuilt from the orders with the rebuild_order_daily_stats command.
+	date: the day the orders were created, in the TIME_ZONE timezone.
+	status: the orders' status.
+	order_count: the number of orders.
+	revenue: the sum of the orders' total_price.
+	units: the number of products sold, the sum of the orders' CartItem quantities.
+	"""
+	date = models.DateField()
+	status = models.CharField(max_length=50, choices=Order.CHOICES)
+	order_count = models.IntegerField(default=0)
+	revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+	units = models.IntegerField(default=0)
+
+	def __str__(self):
+		return f"{self.date} - Status: {self.status}, Orders: {self.order_count}"
+
+	@staticmethod
+	def get_order_units(order):
+		"""
+		@param order: the order.
+		@return: the number of products in the order.
+		"""
+		return CartItem.objects.filter(cart_id=order.cart_id).aggregate(total=Coalesce(Sum('quantity'), 0))['total']
+
+	@classmethod
+	def add(cls, date, status, order_count, revenue, units):
+		"""
+		Adds to the row for the date and status, creating it if it doesn't exist. Negative values subtract.
+		@return: nothing.
+		"""
+		values = {
+			'order_count': F('order_count') + order_count,
+			'revenue': F('revenue') + revenue,
+			'units': F('units') + units,
+		}
+		if cls.objects.filter(date=date, status=status).update(**values):
+			return
+		try:
+			with transaction.atomic():
+				cls.objects.create(date=date, status=status, order_count=order_count, revenue=revenue, units=units)
+		except IntegrityError:
+			# Another request created the row first
+			cls.objects.filter(date=date, status=status).update(**values)
+
+	@staticmethod
+	def get_order_key(order):
+		"""
+		@param order: the order, or a dictionary of the order's created_at, status and total_price.
+		@return: a tuple of (date, status, total_price).
+		"""
+		if isinstance(order, Order):
+			order = {'created_at': order.created_at, 'status': order.status, 'total_price': order.total_price}
+		return get_local_date(order['created_at']), order['status'], Decimal(order['total_price'])
+
+	@classmethod
+	def add_order(cls, order, units, sign=1):
+		"""
+		Adds an order to its date and status row. sign=-1 removes it.
+		@param order: the order, or a dictionary of the order's created_at, status and total_price.
+		@param units: the number of products in the order.
+		@return: nothing.
+		"""
+		date, status, total_price = cls.get_order_key(order)
+		cls.add(date, status, sign, sign * total_price, sign * units)
+
+	@classmethod
+	def get_daily_order_counts(cls):
+		"""
+		@return: a QuerySet of the number of orders per day, in date order.
+			Ex: QuerySet [{'date': date(2023, 1, 2), 'order_count': 3}, {'date': date(2023, 1, 5), 'order_count': 1}]
+		"""
+		return cls.objects.values('date').annotate(order_count=Sum('order_count')).filter(order_count__gt=0).order_by('date')
+
+	@classmethod
+	def rebuild(cls):
+		"""
+		Deletes every row and recalculates them from the orders.
+		@return: the number of rows created.
+		"""
+		orders = Order.objects.annotate(date=TruncDate('created_at')).values('date', 'status').annotate(
+			order_count=Count('id'), revenue=Sum('total_price')
+		).order_by()
+		units = CartItem.objects.filter(cart__order__isnull=False).annotate(date=TruncDate('cart__order__created_at')).values(
+			'date', 'cart__order__status'
+		).annotate(units=Sum('quantity')).order_by()
+		units = {(row['date'], row['cart__order__status']): row['units'] for row in units}
+
+		with transaction.atomic():
+			cls.objects.all().delete()
+			rows = cls.objects.bulk_create([
+				cls(
+					date=row['date'],
+					status=row['status'],
+					order_count=row['order_count'],
+					revenue=row['revenue'],
+					units=units.get((row['date'], row['status']), 0),
+				)
+				for row in orders
+			])
+		return len(rows)
+
+	class Meta:
+		verbose_name = 'Order daily stats'
+		verbose_name_plural = 'Order daily stats'
+		constraints = [
+			models.UniqueConstraint(fields=['date', 'status'], name='unique_order_daily_stats'),
+		]
+
+
+# An email waiting to be sent, so requests don't wait on the SMTP server.
+class QueuedEmail(models.Model):
+	"""
+	subject, message, from_email, recipient_list, html_message: the same as send_mail()'s arguments.
+	status: the email status.
+		- PENDING: waiting to be sent, or waiting to be retried after a failure.
+		- SENT: the email was sent.
+		- FAILED: the email failed to send EMAIL_MAX_ATTEMPTS times, it won't be retried.
+	attempts: the number of times sending the email failed.
+	next_attempt_at: the email isn't sent before this datetime.
+		- Pushed back after each failure, see EMAIL_RETRY_BACKOFF_SECONDS.
+		- Pushed back by EMAIL_LEASE_SECONDS while a worker sends it, so other workers skip it.
+	last_error: the error from the last failed attempt.
+	sent_at: when the email was sent.
+	"""
+	PENDING = 'Pending'
+	SENT = 'Sent'
+	FAILED = 'Failed'
+	CHOICES = [(PENDING, PENDING), (SENT, SENT), (FAILED, FAILED)]
+
+	subject = models.CharField(max_length=255)
+	message = models.TextField()
+	html_message = models.TextField(blank=True, default='')
+	from_email = models.CharField(max_length=255)
+	recipient_list = models.JSONField(default=list)
+	status = models.CharField(max_length=50, choices=CHOICES, default=PENDING)
+	attempts = models.PositiveIntegerField(default=0)
+	next_attempt_at = models.DateTimeField(default=timezone.now)
+	last_error = models.TextField(blank=True, default='')
+	sent_at = models.DateTimeField(null=True, blank=True)
+	created_at = models.DateTimeField(auto_now_add=True)
+	updated_at = models.DateTimeField(auto_now=True)
+
+	def __str__(self):
+		return f"{self.subject} - Status: {self.status}"
+
+	@classmethod
+	def queue_mail(cls, subject, message, from_email, recipient_list, html_message=None):
+		"""
+		Use instead of send_mail(). Saved in the caller's transaction, so the email is only sent if the transaction commits.
+		@return: the QueuedEmail.
+		"""
+		return cls.objects.create(
+			subject=subject,
+			message=message,
+			html_message=html_message or '',
+			from_email=from_email,
+			recipient_list=list(recipient_list),
+		)
+
+	def get_email_message(self, connection):
+		"""
+		@param connection: the email backend connection the message is sent with.
+		@return: an EmailMultiAlternatives built from the QueuedEmail.
+		"""
+		email = EmailMultiAlternatives(self.subject, self.message, self.from_email, self.recipient_list, connection=connection)
+		if self.html_message:
+			email.attach_alternative(self.html_message, 'text/html')
+		return email
+
+	def set_as_sent(self):
+		self.status = QueuedEmail.SENT
+		self.sent_at = timezone.now()
+		self.last_error = ''
+
+	def set_as_failed_attempt(self, error):
+		"""
+		Retries the email later, waiting twice as long after each failure. Gives up after EMAIL_MAX_ATTEMPTS.
+		@param error: the exception raised while sending the email.
+		"""
+		self.attempts += 1
+		self.last_error = repr(error)
+		if self.attempts >= EMAIL_MAX_ATTEMPTS:
+			self.status = QueuedEmail.FAILED
+		else:
+			self.next_attempt_at = timezone.now() + timedelta(seconds=EMAIL_RETRY_BACKOFF_SECONDS * 2 ** (self.attempts - 1))
+
+	@classmethod
+	def send_queued_emails(cls, batch_size=EMAIL_BATCH_SIZE):
+		"""
+		Sends a batch of pending emails over 1 SMTP connection.
+		The batch is claimed in a short transaction (skipping rows locked by another worker) by leasing it for
+		EMAIL_LEASE_SECONDS, so 2 workers don't send the same email. The emails are sent outside of the transaction
+		and each email's result is saved right after it's sent, so a slow SMTP server doesn't hold any DB locks.
+		If the SMTP connection can't be opened the lease is released, the exception is raised.
+		@param batch_size: the max number of emails to send.
+		@return: a tuple of (number of emails sent, number of emails that failed).
+		"""
+		sent, failed = 0, 0
+		now = timezone.now()
+		with transaction.atomic():
+			emails = cls.objects.select_for_update(skip_locked=True).filter(
+				status=cls.PENDING, next_attempt_at__lte=now
+			).order_by('next_attempt_at', 'pk')[:batch_size]
+			emails = list(emails)
+			if not emails:
+				return sent, failed
+			cls.objects.filter(pk__in=[email.pk for email in emails]).update(next_attempt_at=now + timedelta(seconds=EMAIL_LEASE_SECONDS))
+
+		try:
+			connection = get_connection()
+			connection.open()
+		except Exception:
+			cls.objects.filter(pk__in=[email.pk for email in emails]).update(next_attempt_at=now)
+			raise
+
+		with connection:
+			for email in emails:
+				try:
+					email.get_email_message(connection).send()
+				except Exception as e:
+					email.set_as_failed_attempt(e)
+					failed += 1
+					# The connection may be broken, the next email reopens it
+					connection.close()
+				else:
+					email.set_as_sent()
+					sent += 1
+				email.save(update_fields=['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at', 'updated_at'])
+		return sent, failed
+
+	class Meta:
+		verbose_name = 'Queued email'
+		verbose_name_plural = 'Queued emails'
+		indexes = [
+			# Used by send_queued_emails()
+			models.Index(fields=['status', 'next_attempt_at'], name='queuedemail_pending_idx'),
+		]
+
+
+class StripeEvent(models.Model):
+	"""
+	A stripe webhook event. Saved by the stripe_webhook view, then processed by the process_stripe_events command.
+	stripe_id: the stripe event ID. Unique, so an event stripe sends more than once is only saved once.
+	type: the event type, ex: checkout.session.completed
+	data: the event's JSON.
+	status: the event status.
+		- PENDING: waiting to be processed, or waiting to be retried after a failure.
+		- PROCESSED: the event was processed.
+		- FAILED: processing the event failed STRIPE_EVENT_MAX_ATTEMPTS times, it won't be retried.
+	attempts: the number of times processing the event failed.
+	next_attempt_at: the event isn't processed before this datetime.
+		- Pushed back after each failure, see STRIPE_EVENT_RETRY_BACKOFF_SECONDS.
+		- Pushed back by STRIPE_EVENT_LEASE_SECONDS while a worker processes it, so other workers skip it.
+	last_error: the error from the last failed attempt.
+	processed_at: when the event was processed.
+	"""
+	PENDING = 'Pending'
+	PROCESSED = 'Processed'
+	FAILED = 'Failed'
+	CHOICES = [(PENDING, PENDING), (PROCESSED, PROCESSED), (FAILED, FAILED)]
+
+	CHECKOUT_SESSION_COMPLETED = 'checkout.session.completed'
+	CHECKOUT_SESSION_ASYNC_PAYMENT_SUCCEEDED = 'checkout.session.async_payment_succeeded'
+	# The event types that are saved, the others are ignored
+	HANDLED_TYPES = [CHECKOUT_SESSION_COMPLETED, CHECKOUT_SESSION_ASYNC_PAYMENT_SUCCEEDED]
+	# The checkout session payment statuses of a cart that can become an order
+	PAID_STATUSES = ['paid', 'no_payment_required']
+
+	stripe_id = models.CharField(max_length=255, unique=True)
+	type = models.CharField(max_length=255)
+	data = models.JSONField()
+	status = models.CharField(max_length=50, choices=CHOICES, default=PENDING)
+	attempts = models.PositiveIntegerField(default=0)
+	next_attempt_at = models.DateTimeField(default=timezone.now)
+	last_error = models.TextField(blank=True, default='')
+	processed_at = models.DateTimeField(null=True, blank=True)
+	created_at = models.DateTimeField(auto_now_add=True)
+	updated_at = models.DateTimeField(auto_now=True)
+
+	def __str__(self):
+		return f"{self.type} {self.stripe_id} - Status: {self.status}"
+
+	@classmethod
+	def store_event(cls, event):
+		"""
+		Saves a webhook event, unless it was already saved.
+		@param event: the event's JSON as a dictionary.
+		@return: a tuple of (StripeEvent, True if the event is new).
+		"""
+		return cls.objects.get_or_create(stripe_id=event['id'], defaults={'type': event['type'], 'data': event})
+
+	def process(self):
+		"""
+		Does the work for the event.
+		checkout.session.completed and checkout.session.async_payment_succeeded: turns the paid cart into an order,
+		see Cart.complete_purchase().
+		@return: nothing. Raises an exception if the event couldn't be processed.
+		"""
+		if self.type in StripeEvent.HANDLED_TYPES:
+			session = self.data['data']['object']
+			# Payment methods that finish later (ex: bank debits) complete the session unpaid, then send
+			# checkout.session.async_payment_succeeded once the payment succeeds
+			if session.get('payment_status') not in StripeEvent.PAID_STATUSES:
+				return
+			cart = Cart.objects.get(uuid=session['client_reference_id'])
+			cart.complete_purchase()
+
+	def set_as_processed(self):
+		self.status = StripeEvent.PROCESSED
+		self.processed_at = timezone.now()
+		self.last_error = ''
+
+	def set_as_failed_attempt(self, error):
+		"""
+		Retries the event later, waiting twice as long after each failure. Gives up after STRIPE_EVENT_MAX_ATTEMPTS.
+		@param error: the exception raised while processing the event.
+		"""
+		self.attempts += 1
+		self.last_error = repr(error)
+		if self.attempts >= STRIPE_EVENT_MAX_ATTEMPTS:
+			self.status = StripeEvent.FAILED
+		else:
+			self.next_attempt_at = timezone.now() + timedelta(seconds=STRIPE_EVENT_RETRY_BACKOFF_SECONDS * 2 ** (self.attempts - 1))
+
+	@classmethod
+	def process_pending_events(cls, batch_size=STRIPE_EVENT_BATCH_SIZE):
+		"""
+		Processes a batch of pending events, oldest first.
+		The batch is claimed in a short transaction (skipping rows locked by another worker) by leasing it for
+		STRIPE_EVENT_LEASE_SECONDS, so 2 workers don't process the same event. Then each event is processed and saved
+		in its own transaction, so the carts and products it locks are released right after, and a failed event
+		doesn't undo the rest of the batch.
+		@param batch_size: the max number of events to process.
+		@return: a tuple of (number of events processed, number of events that failed).
+		"""
+		processed, failed = 0, 0
+		now = timezone.now()
+		with transaction.atomic():
+			events = cls.objects.select_for_update(skip_locked=True).filter(
+				status=cls.PENDING, next_attempt_at__lte=now
+			).order_by('next_attempt_at', 'pk')[:batch_size]
+			events = list(events)
+			cls.objects.filter(pk__in=[event.pk for event in events]).update(next_attempt_at=now + timedelta(seconds=STRIPE_EVENT_LEASE_SECONDS))
+
+		fields = ['status', 'attempts', 'next_attempt_at', 'last_error', 'processed_at', 'updated_at']
+		for event in events:
+			try:
+				with transaction.atomic():
+					event.process()
+					event.set_as_processed()
+					event.save(update_fields=fields)
+			except Exception as e:
+				# Undo set_as_processed() if saving the event failed
+				event.status, event.processed_at = cls.PENDING, None
+				event.set_as_failed_attempt(e)
+				event.save(update_fields=fields)
+				failed += 1
+			else:
+				processed += 1
+		return processed, failed
+
+	class Meta:
+		verbose_name = 'Stripe event'
+		verbose_name_plural = 'Stripe events'
+		indexes = [
+			# Used by process_pending_events()
+			models.Index(fields=['status', 'next_attempt_at'], name='stripeevent_pending_idx'),
+		]
@@ -0,0 +1,54 @@
+from django.conf import settings
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from django.dispatch import receiver
+from home.models import Product, Order, CartItem, OrderDailyStats
+from senior_project.utils import invalidate_reports_cache
+
+
+@receiver(pre_save, sender=Order)
+def remember_order_stats(sender, instance, raw=False, **kwargs):
+	"""
+	Remembers the order's saved created_at, status and total_price, so update_order_daily_stats() can tell what changed.
+	"""
+	instance._saved_stats = None
+	if instance.pk and not raw:
+		instance._saved_stats = Order.objects.filter(pk=instance.pk).values('created_at', 'status', 'total_price').first()
+
+
+@receiver(post_save, sender=Order)
+def update_order_daily_stats(sender, instance, created, raw=False, **kwargs):
+	"""
+	Adds a new order to OrderDailyStats. If an order's date, status or total price changed, moves it to the new row.
+	"""
+	if raw:
+		return
+	saved = getattr(instance, '_saved_stats', None)
+	if saved and (OrderDailyStats.get_order_key(saved) == OrderDailyStats.get_order_key(instance)):
+		return
+	units = OrderDailyStats.get_order_units(instance)
+	if saved:
+		OrderDailyStats.add_order(saved, units, sign=-1)
+	OrderDailyStats.add_order(instance, units)
+
+
+@receiver(pre_delete, sender=Order)
+def remove_order_daily_stats(sender, instance, **kwargs):
+	"""
+	Removes a deleted order from OrderDailyStats.
+	Runs before the delete (and before cascade deletes) so the order's CartItems can still be counted.
+	"""
+	OrderDailyStats.add_order(instance, OrderDailyStats.get_order_units(instance), sign=-1)
+
+
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=Order)
+@receiver([post_save, post_delete], sender=CartItem)
+@receiver([post_save, post_delete], sender=settings.AUTH_USER_MODEL)
+def clear_reports_cache(sender, update_fields=None, **kwargs):
+	"""
+	The reports dashboard data is made from products, orders, cart items and users, recalculate it when they change.
+	"""
+	# Logging in only updates last_login, which the reports don't use
+	if update_fields and set(update_fields) == {'last_login'}:
+		return
+	invalidate_reports_cache()
@@ -1,4 +1,5 @@
 from django import template
+from django.shortcuts import reverse
 from home.models import Cart
 
 register = template.Library()
@@ -6,5 +7,11 @@ register = template.Library()
 
 @register.simple_tag(takes_context=True)
 def cart_url(context):
-	cart = Cart.get_active_cart_or_create_new_cart(context['request'].user)
-	return cart.get_read_url()
+	"""
+	Uses the active cart ID cached in the session so rendering the navbar doesn't query or create carts.
+	If nothing is cached, links to the cart-active page which finds (or creates) the active cart.
+	"""
+	cart_id = Cart.get_cached_active_cart_id(context['request'].session)
+	if cart_id:
+		return reverse('home:cart-read', kwargs={'pk': cart_id})
+	return reverse('home:cart-active')
@@ -2,7 +2,9 @@ from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser, Group
 from django.contrib.sites.models import Site
 from django.conf import settings
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from senior_project.stripe_gateway import get_stripe_gateway
 import environ
 
 
@@ -16,6 +18,13 @@ User = get_user_model()
 
 class BaseTestCase(TestCase):
 	def setUp(self):
+		# The cache isn't reset between tests
+		cache.clear()
+		# Stripe is kept in memory instead of calling the Stripe API, with a new fake for each test
+		fake_stripe = override_settings(STRIPE_GATEWAY='senior_project.stripe_gateway.FakeStripeGateway')
+		fake_stripe.enable()
+		self.addCleanup(fake_stripe.disable)
+		self.stripe_gateway = get_stripe_gateway()
 		admin_group = Group.objects.create(name='ADMIN')
 
 		# The default password
@@ -1,19 +1,26 @@
 from django.shortcuts import reverse
 from django.urls import resolve
 from home.tests.base import BaseTestCase
-from home.models import Product, Cart, CartItem
+from home.models import Product, Cart, CartItem, StripeEvent
 from home.views import carts
+from senior_project.fake_stripe import make_checkout_session_completed_event
 
 
 class TestCartCreate(BaseTestCase):
 	def setUp(self):
 		super().setUp()
 		self.client.login(username=self.user1.username, password=self.user1_password)
-		# visit the home page, this should create a new cart for the user
+		# visit the cart page through the navbar link, this should create a new cart for the user
+		self.client.get(reverse('home:cart-active'))
+
+	def test_cart_not_created_by_navbar(self):
+		"""Rendering the navbar should not create a cart."""
+		self.client.login(username=self.user2.username, password=self.password)
 		self.client.get('/')
+		self.assertFalse(Cart.objects.filter(creator=self.user2).exists())
 
 	def test_cart_created_on_signup(self):
-		"""When a user first signs up, an active cart is created for them (if they visit any page with the navbar)."""
+		"""When a user first signs up, an active cart is created for them (when they open their cart)."""
 		cart_count = Cart.objects.filter(creator=self.user1).count()
 		first_cart = Cart.objects.filter(creator=self.user1).first()
 		self.assertEqual(cart_count, 1)
@@ -26,7 +33,9 @@ class TestCartCreate(BaseTestCase):
 		cart_count = Cart.objects.filter(creator=self.user1).count()
 		carts = Cart.objects.filter(creator=self.user1)
 
-		# Visit /payment-success/ to simulate a successful stripe payment
+		# Process stripe's checkout.session.completed event, then visit /payment-success/ like stripe redirects to
+		StripeEvent.store_event(make_checkout_session_completed_event(cart.uuid))
+		StripeEvent.process_pending_events()
 		response = self.client.get(reverse('home:payment-success', kwargs={'cart_uuid': cart.uuid}))
 
 		self.assertEqual(response.status_code, 302)
@@ -34,6 +43,19 @@ class TestCartCreate(BaseTestCase):
 		self.assertTrue(carts[0].is_inactive())
 		self.assertTrue(carts[1].is_active())
 
+		# The navbar links to the new cart
+		self.assertEqual(self.client.session[Cart.SESSION_KEY], carts[1].pk)
+
+	def test_stale_cached_cart(self):
+		"""If the cached cart is no longer active, the cart page redirects to the active cart."""
+		cart = Cart.objects.get(creator=self.user1)
+		cart.status = Cart.INACTIVE
+		cart.save()
+
+		response = self.client.get(cart.get_read_url())
+		self.assertRedirects(response, reverse('home:cart-active'), fetch_redirect_response=False)
+		self.assertNotIn(Cart.SESSION_KEY, self.client.session)
+
 
 class TestCartRead(BaseTestCase):
 	def setUp(self):
@@ -62,8 +84,20 @@ class TestCartRead(BaseTestCase):
 			creator=self.superuser,
 			updater=self.superuser,
 		)
+		self.product3 = Product.objects.create(
+			name='p3',
+			description='description3',
+			price=30,
+			status=Product.ACTIVE,
+			stock=30,
+			stripe_product_id='...',
+			stripe_price_id='...',
+			creator=self.superuser,
+			updater=self.superuser,
+		)
 		self.product1.create_stripe_product_and_price_objs()
 		self.product2.create_stripe_product_and_price_objs()
+		self.product3.create_stripe_product_and_price_objs()
 
 	def _create_cart_and_cartitems_valid(self, user):
 		self._create_products()
@@ -78,7 +112,7 @@ class TestCartRead(BaseTestCase):
 		)
 		self.cartitem2 = CartItem.objects.create(
 			cart=cart,
-			product=self.product1,
+			product=self.product3,
 			original_price=0,
 			quantity=5,
 			creator=user,
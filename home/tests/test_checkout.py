@@ -1,9 +1,11 @@
 from django.shortcuts import reverse
 from django.urls import resolve
+from django.test import override_settings
 from senior_project import constants
+from senior_project.fake_stripe import make_checkout_session_completed_event, get_signed_event
 from senior_project.utils import get_allowed_cities
 from home.tests.base import BaseTestCase
-from home.models import Product, Cart, ShippingAddress
+from home.models import Product, Cart, ShippingAddress, StripeEvent
 from home.forms import ShippingAddressForm
 from home.views import checkout
 
@@ -228,20 +230,92 @@ class TestPaymentSuccess(CheckoutBaseTestCase):
 		response = self.client.get(self.url)
 		self.assertEqual(response.status_code, 403)
 
-	def test_get_request_valid(self):
+	def test_get_request_processing(self):
+		"""Until stripe's webhook event is processed, the page shows the payment is processing."""
 		self.client.login(username=self.user1.username, password=self.password)
 		response = self.client.get(self.url)
 		self.assertEqual(resolve(self.url).func, checkout.payment_success)
-		self.assertRedirects(response, self.cart.get_order().get_read_url(), status_code=302, target_status_code=200)
+		self.assertTemplateUsed(response, 'home/checkout/payment_processing.html')
+		self.assertContains(response, 'url=?refreshes=1')
+		self.assertFalse(self.cart.has_order())
+
+	def test_get_request_pending(self):
+		"""The page stops refreshing after PAYMENT_PROCESSING_MAX_REFRESHES, and says the payment is pending."""
+		self.client.login(username=self.user1.username, password=self.password)
+		response = self.client.get(self.url, {'refreshes': constants.PAYMENT_PROCESSING_MAX_REFRESHES})
+		self.assertTemplateUsed(response, 'home/checkout/payment_processing.html')
+		self.assertNotContains(response, 'http-equiv="refresh"')
+		self.assertContains(response, 'Your payment is still pending')
 
-	def test_get_request_invalid(self):
-		"""On a get request, if a cart has an order associated with it, /payment-success/ should return a 403."""
+	def test_get_request_valid(self):
+		"""Once the order is created, the page redirects to it."""
 		self.client.login(username=self.user1.username, password=self.password)
-		self.cart.create_order()
+		order = self.cart.complete_purchase()
+		response = self.client.get(self.url)
+		self.assertRedirects(response, order.get_read_url(), status_code=302, target_status_code=200)
+		self.assertNotEqual(self.client.session[Cart.SESSION_KEY], self.cart.pk)
+
+	def test_get_request_other_user(self):
+		self.client.login(username=self.user2.username, password=self.password)
 		response = self.client.get(self.url)
 		self.assertEqual(response.status_code, 403)
 
 
+@override_settings(STRIPE_WEBHOOK_SECRET='whsec_test')
+class TestStripeWebhook(BaseTestCase):
+	def setUp(self):
+		super().setUp()
+		self.url = reverse('home:stripe-webhook')
+		self.cart = Cart.get_active_cart_or_create_new_cart(self.user1)
+		self.event = make_checkout_session_completed_event(self.cart.uuid)
+
+	def _post_event(self, event, secret=None):
+		payload, signature = get_signed_event(event, secret)
+		return self.client.post(self.url, data=payload, content_type='application/json', HTTP_STRIPE_SIGNATURE=signature)
+
+	def test_event_saved(self):
+		response = self._post_event(self.event)
+		self.assertEqual(response.status_code, 200)
+		stripe_event = StripeEvent.objects.get()
+		self.assertEqual(stripe_event.stripe_id, self.event['id'])
+		self.assertEqual(stripe_event.status, StripeEvent.PENDING)
+		# The order is made by the worker, not the webhook
+		self.assertFalse(self.cart.has_order())
+
+	def test_event_saved_once(self):
+		"""Stripe can send the same event more than once."""
+		self._post_event(self.event)
+		response = self._post_event(self.event)
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(StripeEvent.objects.count(), 1)
+
+	def test_invalid_signature(self):
+		response = self._post_event(self.event, secret='whsec_wrong')
+		self.assertEqual(response.status_code, 400)
+		self.assertFalse(StripeEvent.objects.exists())
+
+	def test_no_secret(self):
+		with self.settings(STRIPE_WEBHOOK_SECRET=''):
+			response = self._post_event(self.event, secret='')
+		self.assertEqual(response.status_code, 400)
+
+	def test_async_payment_succeeded_event_saved(self):
+		event = make_checkout_session_completed_event(self.cart.uuid, event_type=StripeEvent.CHECKOUT_SESSION_ASYNC_PAYMENT_SUCCEEDED)
+		response = self._post_event(event)
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(StripeEvent.objects.get().type, StripeEvent.CHECKOUT_SESSION_ASYNC_PAYMENT_SUCCEEDED)
+
+	def test_unhandled_event_type(self):
+		self.event['type'] = 'customer.created'
+		response = self._post_event(self.event)
+		self.assertEqual(response.status_code, 200)
+		self.assertFalse(StripeEvent.objects.exists())
+
+	def test_get_request(self):
+		response = self.client.get(self.url)
+		self.assertEqual(response.status_code, 405)
+
+
 class TestPaymentCanceled(CheckoutBaseTestCase):
 	def setUp(self):
 		super().setUp()
@@ -1,19 +1,30 @@
 from django.test import RequestFactory
+from django.contrib.messages.storage.fallback import FallbackStorage
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
 from django.http import HttpResponse
 from django.core import mail
+from django.core.management import call_command
+from django.db import connection, transaction, IntegrityError
+from django.test.utils import CaptureQueriesContext
 from django.core.files import File
 from django.shortcuts import reverse
+from django.utils import timezone
 from io import StringIO
+from unittest import mock
+from datetime import timedelta
 from home.tests.base import BaseTestCase
-from home.models import Product, ProductImage, ShippingAddress, Cart, CartItem, Order, OrderHistory
+from home.models import Product, ProductImage, ShippingAddress, Cart, CartItem, StockReservation, Order, OrderHistory, OrderDailyStats, QueuedEmail, StripeEvent
 from blog.models import Post
-from senior_project.exceptions import MoreThanOneActiveCartError, MoreThanOneCartItemError
+from users.models import DemoAccountLease
+from senior_project.exceptions import MoreThanOneActiveCartError, NotEnoughStockError
 from senior_project.utils import get_full_url
-from senior_project.constants import MONTHS
+from senior_project.fake_stripe import make_checkout_session_completed_event
+from senior_project.constants import MONTHS, EMAIL_MAX_ATTEMPTS, EMAIL_RETRY_BACKOFF_SECONDS, EMAIL_LEASE_SECONDS, DEMO_ACCOUNT_LEASE_MINUTES, STRIPE_EVENT_MAX_ATTEMPTS, STRIPE_EVENT_RETRY_BACKOFF_SECONDS, STRIPE_EVENT_LEASE_SECONDS
 import csv
 import environ
 import stripe
+import uuid
 
 
 env = environ.Env(
@@ -180,14 +191,6 @@ class TestProductModelMethods(BaseTestCase):
 			creator=self.superuser,
 			updater=self.superuser,
 		)
-		self.cartitem6 = CartItem.objects.create(
-			cart=self.active_cart2,
-			product=self.product2,
-			original_price=0,
-			quantity=5,
-			creator=self.superuser,
-			updater=self.superuser,
-		)
 		self.order1 = Order.objects.create(
 			cart=self.inactive_cart1,
 			total_price=10,
@@ -247,17 +250,67 @@ class TestProductModelMethods(BaseTestCase):
 		self.product2.delete_images()
 		self.assertEqual(self.product2.get_images().count(), 0)
 
+	def test_get_first_image_url(self):
+		self.assertEqual(self.product1.get_first_image_url(), self.product1_image1.image.url)
+		self.assertIsNone(self.product2.get_first_image_url())
+
+		# The next image becomes the primary image when the primary image is deleted
+		self.product1_image1.delete()
+		self.product1.refresh_from_db()
+		self.assertEqual(self.product1.primary_image, self.product1_image2)
+		self.assertEqual(self.product1.get_first_image_url(), self.product1_image2.image.url)
+
 	def test_get_active_products(self):
 		self.assertEqual(Product.get_active_products().count(), 2)
 
+		# The primary image is fetched with the products, and its variants in 1 more query
+		with self.assertNumQueries(2):
+			image_urls = [product.get_first_image_url() for product in Product.get_active_products()]
+		self.assertIn(self.product1_image1.image.url, image_urls)
+
+	def test_get_catalog_page(self):
+		# Walk every page one product at a time
+		products, next_cursor = Product.get_catalog_page(page_size=1)
+		self.assertEqual(products, [self.product2])
+		products, next_cursor = Product.get_catalog_page(cursor=next_cursor, page_size=1)
+		self.assertEqual(products, [self.product1])
+		self.assertIsNone(next_cursor)
+
+		# Filters
+		self.assertEqual(Product.get_catalog_page(min_price=6)[0], [self.product2])
+		self.assertEqual(Product.get_catalog_page(max_price=6)[0], [self.product1])
+		self.product1.stock = 0
+		self.product1.save()
+		self.assertEqual(Product.get_catalog_page(in_stock=True)[0], [self.product2])
+
+		with self.assertRaises(ValueError):
+			Product.get_catalog_page(cursor='invalid')
+
 	def test_get_top_10_selling_products(self):
-		product_names, total_solds = Product.get_top_10_selling_products()
+		# The cart items were created without a purchase, count them
+		Product.reconcile_units_sold()
+		with self.assertNumQueries(1):
+			product_names, total_solds = Product.get_top_10_selling_products()
 		self.assertEqual(product_names, [self.product1.name, self.product2.name, self.inactive_product1.name, self.inactive_product2.name])
 		self.assertEqual(total_solds, [20, 10, 0, 0])
 
+	def test_reconcile_units_sold(self):
+		drift = Product.reconcile_units_sold(fix=False)
+		self.assertEqual([(product.pk, saved, recalculated) for product, saved, recalculated in drift], [(self.product1.pk, 0, 20), (self.product2.pk, 0, 10)])
+		self.product1.refresh_from_db()
+		self.assertEqual(self.product1.units_sold, 0)
+
+		out = StringIO()
+		call_command('reconcile_units_sold', stdout=out)
+		self.assertIn('2 products with the wrong units_sold fixed.', out.getvalue())
+		self.product1.refresh_from_db()
+		self.assertEqual(self.product1.units_sold, 20)
+		self.assertEqual(Product.reconcile_units_sold(), [])
+
 	def test_add_product_to_cart(self):
-		with self.assertRaises(MoreThanOneCartItemError):
-			self.product2.add_product_to_cart(self.superuser, self.active_cart2, 10)
+		# A Cart cannot have more than 1 CartItem of the same product
+		with self.assertRaises(IntegrityError), transaction.atomic():
+			CartItem.objects.create(cart=self.active_cart2, product=self.product2, quantity=5, creator=self.superuser, updater=self.superuser)
 
 		initial_count = CartItem.objects.all().count()
 		self.product1.add_product_to_cart(self.superuser, self.active_cart3, 10)
@@ -266,6 +319,12 @@ class TestProductModelMethods(BaseTestCase):
 		cartitem = self.product1.add_product_to_cart(self.superuser, self.active_cart1, 10)
 		self.assertEqual(cartitem.quantity, 15)
 
+		# Adding to an existing CartItem is a single UPDATE plus reading the CartItem back
+		with self.assertNumQueries(2):
+			cartitem = self.product1.add_product_to_cart(self.superuser, self.active_cart1, 1)
+		self.assertEqual(cartitem.quantity, 16)
+		self.assertEqual(CartItem.objects.filter(cart=self.active_cart1, product=self.product1).count(), 1)
+
 	def test_get_associated_orders(self):
 		self.assertEqual(self.product1.get_associated_orders().first(), self.order1)
 
@@ -450,7 +509,15 @@ class TestCartModelMethods(BaseTestCase):
 		self.assertFalse(self.active_cart.is_empty())
 
 	def test_get_total_cart_price(self):
-		self.assertEqual(75, self.active_cart.get_total_cart_price())
+		with self.assertNumQueries(1):
+			self.assertEqual(75, self.active_cart.get_total_cart_price())
+		self.assertEqual(0, self.empty_cart.get_total_cart_price())
+
+	def test_get_cartitems(self):
+		# The products are fetched with the CartItems
+		with self.assertNumQueries(1):
+			totals = [cart_item.get_total_price() for cart_item in self.active_cart.get_cartitems()]
+		self.assertEqual(75, sum(totals))
 
 	def test_get_active_cart_or_create_new_cart(self):
 		with self.assertRaises(MoreThanOneActiveCartError):
@@ -469,7 +536,8 @@ class TestCartModelMethods(BaseTestCase):
 		self.assertFalse(Cart.objects.filter(creator=self.superuser, status=Cart.ACTIVE))
 
 	def test_set_original_price_for_all_cart_items(self):
-		self.active_cart.set_original_price_for_all_cart_items()
+		with self.assertNumQueries(1):
+			self.active_cart.set_original_price_for_all_cart_items()
 		cartitems = self.active_cart.get_cartitems()
 		self.assertTrue(cartitems[0].original_price == 5.00)
 		self.assertTrue(cartitems[1].original_price == 10.00)
@@ -487,6 +555,79 @@ class TestCartModelMethods(BaseTestCase):
 		self.assertTrue(stock_limit)
 		self.assertTrue(inactive_product)
 
+	def test_handle_cart_purchase_last_units(self):
+		"""2 carts buy the last units of a product, the second cart can't oversell it."""
+		request = self.factory.get('/fake-path/')
+		request.session = {}
+		request._messages = FallbackStorage(request)
+		self.product1.stock = 5
+		self.product1.save()
+		carts = []
+		for user in [self.user1, self.user2]:
+			cart = Cart.objects.create(status=Cart.ACTIVE, creator=user, updater=user)
+			self.product1.add_product_to_cart(user, cart, 4)
+			carts.append(cart)
+
+		order1 = carts[0].create_order()
+		# Select the cart items, lock the products, sum other carts' reservations, then 1 update for all products
+		# and 1 delete for the cart's reservations (plus the savepoint queries)
+		with self.assertNumQueries(7):
+			carts[0].handle_cart_purchase(request, order1)
+		self.product1.refresh_from_db()
+		self.assertEqual(self.product1.stock, 1)
+		self.assertTrue(self.product1.is_active())
+		self.assertFalse(order1.has_errors)
+		self.assertEqual(self.product1.units_sold, 4)
+
+		order2 = carts[1].create_order()
+		carts[1].handle_cart_purchase(request, order2)
+		self.product1.refresh_from_db()
+		order2.refresh_from_db()
+		self.assertEqual(self.product1.stock, 0)
+		self.assertEqual(self.product1.stock_overflow, 3)
+		self.assertTrue(self.product1.is_inactive())
+		self.assertTrue(order2.has_errors)
+		self.assertEqual(QueuedEmail.objects.filter(subject='Order ERROR').count(), 1)
+
+	def test_reserve_stock(self):
+		expires_at = self.active_cart.reserve_stock()
+		self.assertGreater(expires_at, timezone.now())
+		self.assertEqual(StockReservation.objects.filter(cart=self.active_cart).count(), 2)
+		# Reserving again replaces the cart's reservations
+		self.active_cart.reserve_stock()
+		self.assertEqual(StockReservation.objects.filter(cart=self.active_cart).count(), 2)
+
+		# The cart's own reservations don't reduce its available stock, other carts see less stock
+		self.assertEqual(self.product1.get_available_stock(exclude_cart=self.active_cart), 10)
+		self.assertEqual(self.product1.get_available_stock(), 5)
+		self.assertEqual(self.cartitem1.get_available_stock(), 10)
+
+		self.active_cart.release_stock()
+		self.assertFalse(StockReservation.objects.filter(cart=self.active_cart).exists())
+		self.assertEqual(self.product1.get_available_stock(), 10)
+
+	def test_reserve_stock_conflict(self):
+		"""A cart can't reserve units that another cart has reserved."""
+		self.active_cart.reserve_stock()
+		cart = Cart.objects.create(status=Cart.ACTIVE, creator=self.user1, updater=self.user1)
+		self.product1.add_product_to_cart(self.user1, cart, 6)
+		with self.assertRaises(NotEnoughStockError):
+			cart.reserve_stock()
+		self.assertFalse(StockReservation.objects.filter(cart=cart).exists())
+
+		cartitem = cart.get_cartitems().get()
+		self.assertEqual(cartitem.available_stock, 5)
+		self.assertTrue(cartitem.is_quantity_gt_stock())
+		self.assertTrue(cart.has_out_of_stock_or_inactive_products()[0])
+
+	def test_expired_reservations(self):
+		"""Expired reservations don't hold stock and are deleted by delete_expired_reservations()."""
+		self.active_cart.reserve_stock()
+		StockReservation.objects.filter(cart=self.active_cart).update(expires_at=timezone.now())
+		self.assertEqual(self.product1.get_available_stock(), 10)
+		self.assertEqual(StockReservation.delete_expired_reservations(), 2)
+		self.assertFalse(StockReservation.objects.exists())
+
 	def test_get_payment_success_and_payment_cancel_url(self):
 		returned_success_url, returned_canceled_url = self.active_cart.get_payment_success_and_payment_cancel_url()
 		expected_success_url = get_full_url(f'/checkout/payment-success/{self.active_cart.uuid}/')
@@ -672,8 +813,8 @@ class TestOrderModelMethods(BaseTestCase):
 			updater=self.superuser,
 		)
 		self.cartitem3 = CartItem.objects.create(
-			cart=self.cart2,
-			product=self.product2,
+			cart=self.cart3,
+			product=self.product1,
 			original_price=3,
 			quantity=3,
 			creator=self.superuser,
@@ -790,20 +931,46 @@ class TestOrderModelMethods(BaseTestCase):
 		# Header
 		self.assertEqual(reader[0], ['Order ID\tOrder date\tOrder total price\tOrder status\tUser email\tShipping address\tOrdered products'])
 
+	def test_get_export_rows(self):
+		# 1 query for the orders and 1 for their cart items and products, then 1 for the OrderHistory
+		with self.assertNumQueries(3):
+			rows = list(Order.get_export_rows())
+		self.assertEqual(len(rows), Order.objects.count() + OrderHistory.objects.count() + 1)
+		self.assertEqual(rows[1][0], self.order1.pk)
+		self.assertEqual(rows[1][4], self.order1.creator.email)
+		self.assertEqual(rows[1][6], [cart_item.product.name for cart_item in self.order1.cart.get_cartitems().order_by('pk')])
+
 	def test_get_users_orders(self):
 		self.assertEqual(Order.get_users_orders(self.superuser).count(), 5)
 
 	def test_send_order_confirmation_email(self):
-		with self.assertRaises(Exception):
-			self.order1.send_order_confirmation_email()
-			self.assertEqual(len(mail.outbox), 1)
-			self.assertEqual(mail.outbox[0].subject, 'Order Confirmation')
-			self.assertIn(mail.outbox[0].body, '<html><head></head><body><h2>Thanks for your order!</h2><p>Order confirmation page')
+		self.order1.send_order_confirmation_email()
+		# The email is queued, not sent during the request
+		self.assertEqual(len(mail.outbox), 0)
+		QueuedEmail.send_queued_emails()
+		self.assertEqual(len(mail.outbox), 1)
+		self.assertEqual(mail.outbox[0].subject, 'Order Confirmation')
+		self.assertEqual(mail.outbox[0].to, [self.superuser.email])
+		self.assertIn('Thanks for your order!', mail.outbox[0].alternatives[0][0])
 
 	def test_get_year_months_total_orders(self):
-		months, months_order_totals = Order.get_year_months_total_orders(self.order1.created_at.year)
+		with self.assertNumQueries(1):
+			months, months_order_totals = Order.get_year_months_total_orders(self.order1.created_at.year)
 		self.assertEqual(months, MONTHS)
 		self.assertIn(5, months_order_totals)
+		self.assertEqual(len(months_order_totals), 12)
+		self.assertEqual(sum(months_order_totals), 5)
+
+		# A year without orders is all 0s
+		months, months_order_totals = Order.get_year_months_total_orders(self.order1.created_at.year - 1)
+		self.assertEqual(months_order_totals, [0] * 12)
+
+	def test_get_total_year_users(self):
+		with self.assertNumQueries(1):
+			months, month_user_counts = User.get_total_year_users(self.superuser.date_joined.year)
+		self.assertEqual(months, MONTHS)
+		self.assertEqual(month_user_counts[timezone.localtime(self.superuser.date_joined).month - 1], User.objects.count())
+		self.assertEqual(sum(month_user_counts), User.objects.count())
 
 	def test_get_years_with_orders(self):
 		self.assertEqual(Order.get_years_with_orders().first(), self.order1.created_at.year)
@@ -982,15 +1149,7 @@ class TestCheckoutModelMethods(BaseTestCase):
 			cart=self.cart,
 			product=self.product1,
 			original_price=0,
-			quantity=5,
-			creator=self.superuser,
-			updater=self.superuser,
-		)
-		self.cartitem2 = CartItem.objects.create(
-			cart=self.cart,
-			product=self.product1,
-			original_price=0,
-			quantity=5,
+			quantity=10,
 			creator=self.superuser,
 			updater=self.superuser,
 		)
@@ -1017,20 +1176,20 @@ class TestCheckoutModelMethods(BaseTestCase):
 		self.assertNotEqual(self.product2.stripe_price_id, '')
 
 		# Attempt to retrieve stripe product
-		p1 = stripe.Product.retrieve(self.product1.stripe_product_id)
-		p2 = stripe.Product.retrieve(self.product2.stripe_product_id)
+		p1 = self.stripe_gateway.objects[self.product1.stripe_product_id]
+		p2 = self.stripe_gateway.objects[self.product2.stripe_product_id]
 
 		# Check if name was assigned correctly
-		self.assertEqual(p1.name, self.product1.name)
-		self.assertEqual(p2.name, self.product2.name)
+		self.assertEqual(p1['name'], self.product1.name)
+		self.assertEqual(p2['name'], self.product2.name)
 
 		# Attempt to retrieve stripe price
-		price1 = stripe.Price.retrieve(self.product1.stripe_price_id)
-		price2 = stripe.Price.retrieve(self.product2.stripe_price_id)
+		price1 = self.stripe_gateway.objects[self.product1.stripe_price_id]
+		price2 = self.stripe_gateway.objects[self.product2.stripe_price_id]
 
 		# Check if the price was assigned correctly
-		self.assertEqual(price1.unit_amount/100, self.product1.price)
-		self.assertEqual(price2.unit_amount/100, self.product2.price)
+		self.assertEqual(price1['unit_amount']/100, self.product1.price)
+		self.assertEqual(price2['unit_amount']/100, self.product2.price)
 
 	def test_update_stripe_product_and_price_objs(self):
 		# Change the product name and price
@@ -1043,25 +1202,25 @@ class TestCheckoutModelMethods(BaseTestCase):
 		self.product2.update_stripe_product_and_price_objs()
 
 		# Attempt to retrieve stripe product
-		p1 = stripe.Product.retrieve(self.product1.stripe_product_id)
-		p2 = stripe.Product.retrieve(self.product2.stripe_product_id)
+		p1 = self.stripe_gateway.objects[self.product1.stripe_product_id]
+		p2 = self.stripe_gateway.objects[self.product2.stripe_product_id]
 
 		# Check if name was assigned correctly
-		self.assertEqual(self.product1.name, p1.name)
-		self.assertEqual(self.product2.name, p2.name)
+		self.assertEqual(self.product1.name, p1['name'])
+		self.assertEqual(self.product2.name, p2['name'])
 
 		# Attempt to retrieve stripe price
-		price1 = stripe.Price.retrieve(self.product1.stripe_price_id)
-		price2 = stripe.Price.retrieve(self.product2.stripe_price_id)
+		price1 = self.stripe_gateway.objects[self.product1.stripe_price_id]
+		price2 = self.stripe_gateway.objects[self.product2.stripe_price_id]
 
 		# Check if the price was assigned correctly
-		self.assertEqual(price1.unit_amount / 100, 100)
-		self.assertEqual(price2.unit_amount / 100, 200)
+		self.assertEqual(price1['unit_amount'] / 100, 100)
+		self.assertEqual(price2['unit_amount'] / 100, 200)
 
 	def test_create_stripe_checkout_session(self):
 		self.cart.create_stripe_checkout_session()
-		sessions = stripe.checkout.Session.list(limit=1)
-		actual_url = sessions.data[0].success_url
+		session = [obj for obj in self.stripe_gateway.objects.values() if obj['object'] == 'checkout.session'][-1]
+		actual_url = session['success_url']
 		expected_url = get_full_url(reverse('home:payment-success', kwargs={'cart_uuid': self.cart.uuid}))
 		self.assertEqual(actual_url, expected_url)
 
@@ -1071,8 +1230,7 @@ class TestCheckoutModelMethods(BaseTestCase):
 		self.cart.handle_cart_purchase(request, order)
 		# Product 1: price=5, stock=10
 		# Product 2: price=10, stock=10
-		# CartItem 1: quantity=5, product=p1
-		# CartItem 2: quantity=5, product=p1
+		# CartItem 1: quantity=10, product=p1
 		# CartItem 3: quantity=8, product=p2
 		# Product 1: total=50, stock=0
 		# Product 2: total=80, stock=2
@@ -1087,6 +1245,412 @@ class TestCheckoutModelMethods(BaseTestCase):
 		stripe_product_id = self.product1.stripe_product_id
 		self.product1.delete_product_and_set_stripe_product_as_inactive()
 
-		stripe_product_id_status = stripe.Product.retrieve(stripe_product_id)
+		stripe_product_id_status = self.stripe_gateway.objects[stripe_product_id]
 		self.assertEqual(Product.objects.all().count(), initial_count-1)
-		self.assertFalse(stripe_product_id_status.active)
+		self.assertFalse(stripe_product_id_status['active'])
+
+
+class TestOrderDailyStatsModelMethods(BaseTestCase):
+	def setUp(self):
+		super().setUp()
+		self.product = Product.objects.create(
+			name='p1',
+			description='description1',
+			price=5,
+			status=Product.ACTIVE,
+			stock=10,
+			stripe_product_id='...',
+			stripe_price_id='...',
+			creator=self.superuser,
+			updater=self.superuser,
+		)
+		self.cart1 = Cart.objects.create(status=Cart.INACTIVE, creator=self.user1, updater=self.user1)
+		self.cart2 = Cart.objects.create(status=Cart.INACTIVE, creator=self.user1, updater=self.user1)
+		self.product.add_product_to_cart(self.user1, self.cart1, 2)
+		self.product.add_product_to_cart(self.user1, self.cart2, 3)
+		self.order1 = self.cart1.create_order()
+		self.order2 = self.cart2.create_order()
+		self.today = timezone.localdate()
+
+	def _get_stats(self, status=Order.PLACED, date=None):
+		return OrderDailyStats.objects.get(date=date or self.today, status=status)
+
+	def test_order_created(self):
+		stats = self._get_stats()
+		self.assertEqual(stats.order_count, 2)
+		self.assertEqual(stats.revenue, 25)
+		self.assertEqual(stats.units, 5)
+
+	def test_order_status_changed(self):
+		self.order1.status = Order.SHIPPED
+		self.order1.save()
+		self.assertEqual(self._get_stats().order_count, 1)
+		shipped = self._get_stats(Order.SHIPPED)
+		self.assertEqual(shipped.order_count, 1)
+		self.assertEqual(shipped.revenue, 10)
+		self.assertEqual(shipped.units, 2)
+
+		# Saving without changes doesn't count the order twice
+		self.order1.save()
+		self.assertEqual(self._get_stats(Order.SHIPPED).order_count, 1)
+
+	def test_order_date_changed(self):
+		self.order1.created_at = timezone.now() - timedelta(days=3)
+		self.order1.save()
+		self.assertEqual(self._get_stats().order_count, 1)
+		self.assertEqual(self._get_stats(date=timezone.localdate(self.order1.created_at)).order_count, 1)
+
+	def test_order_deleted(self):
+		# Deleting the cart deletes the order
+		self.cart1.delete()
+		stats = self._get_stats()
+		self.assertEqual(stats.order_count, 1)
+		self.assertEqual(stats.units, 3)
+
+	def test_rebuild(self):
+		self.order1.status = Order.CANCELED
+		self.order1.save()
+		expected = list(OrderDailyStats.objects.filter(order_count__gt=0).order_by('status').values('date', 'status', 'order_count', 'revenue', 'units'))
+		OrderDailyStats.objects.all().delete()
+
+		self.assertEqual(OrderDailyStats.rebuild(), 2)
+		rebuilt = list(OrderDailyStats.objects.order_by('status').values('date', 'status', 'order_count', 'revenue', 'units'))
+		self.assertEqual(rebuilt, expected)
+
+	def test_get_daily_order_counts(self):
+		self.order1.status = Order.CANCELED
+		self.order1.save()
+		with self.assertNumQueries(1):
+			daily_order_counts = list(OrderDailyStats.get_daily_order_counts())
+		self.assertEqual(daily_order_counts, [{'date': self.today, 'order_count': 2}])
+
+
+class TestQueuedEmailModelMethods(BaseTestCase):
+	def setUp(self):
+		super().setUp()
+		self.email1 = QueuedEmail.queue_mail('Subject 1', 'Message 1', env('ADMIN_EMAIL'), ['example@example.com'])
+		self.email2 = QueuedEmail.queue_mail('Subject 2', 'Message 2', env('ADMIN_EMAIL'), ['example@example.com'], html_message='<p>Message 2</p>')
+
+	def test_queue_mail(self):
+		self.assertEqual(self.email1.status, QueuedEmail.PENDING)
+		self.assertEqual(self.email1.recipient_list, ['example@example.com'])
+		self.assertEqual(len(mail.outbox), 0)
+
+	def test_queue_mail_rolled_back(self):
+		"""An email queued in a transaction that rolls back is never sent."""
+		with self.assertRaises(IntegrityError):
+			with transaction.atomic():
+				QueuedEmail.queue_mail('Subject 3', 'Message 3', env('ADMIN_EMAIL'), ['example@example.com'])
+				raise IntegrityError
+		self.assertFalse(QueuedEmail.objects.filter(subject='Subject 3').exists())
+
+	def test_send_queued_emails(self):
+		self.assertEqual(QueuedEmail.send_queued_emails(), (2, 0))
+		self.assertEqual(len(mail.outbox), 2)
+		self.assertEqual(mail.outbox[1].alternatives, [('<p>Message 2</p>', 'text/html')])
+		self.email1.refresh_from_db()
+		self.assertEqual(self.email1.status, QueuedEmail.SENT)
+		self.assertIsNotNone(self.email1.sent_at)
+
+		# Sent emails aren't sent again
+		self.assertEqual(QueuedEmail.send_queued_emails(), (0, 0))
+		self.assertEqual(len(mail.outbox), 2)
+
+	def test_send_queued_emails_batch_size(self):
+		self.assertEqual(QueuedEmail.send_queued_emails(batch_size=1), (1, 0))
+		self.assertEqual(mail.outbox[0].subject, 'Subject 1')
+
+	def test_send_queued_emails_retry(self):
+		with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError('SMTP error')):
+			self.assertEqual(QueuedEmail.send_queued_emails(), (0, 2))
+		self.email1.refresh_from_db()
+		self.assertEqual(self.email1.status, QueuedEmail.PENDING)
+		self.assertEqual(self.email1.attempts, 1)
+		self.assertIn('SMTP error', self.email1.last_error)
+		self.assertGreater(self.email1.next_attempt_at, timezone.now() + timedelta(seconds=EMAIL_RETRY_BACKOFF_SECONDS - 5))
+
+		# Not retried before next_attempt_at
+		self.assertEqual(QueuedEmail.send_queued_emails(), (0, 0))
+		QueuedEmail.objects.update(next_attempt_at=timezone.now())
+		self.assertEqual(QueuedEmail.send_queued_emails(), (2, 0))
+
+	def test_send_queued_emails_max_attempts(self):
+		with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError('SMTP error')):
+			for i in range(EMAIL_MAX_ATTEMPTS):
+				QueuedEmail.objects.update(next_attempt_at=timezone.now())
+				QueuedEmail.send_queued_emails()
+		self.email1.refresh_from_db()
+		self.assertEqual(self.email1.status, QueuedEmail.FAILED)
+		self.assertEqual(self.email1.attempts, EMAIL_MAX_ATTEMPTS)
+
+		QueuedEmail.objects.update(next_attempt_at=timezone.now())
+		self.assertEqual(QueuedEmail.send_queued_emails(), (0, 0))
+
+	def test_send_queued_emails_lease(self):
+		"""Emails being sent are leased, another worker doesn't send them."""
+		other_worker_results = []
+
+		def send_messages(messages):
+			other_worker_results.append(QueuedEmail.send_queued_emails())
+			return len(messages)
+
+		with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=send_messages):
+			self.assertEqual(QueuedEmail.send_queued_emails(), (2, 0))
+		self.assertEqual(other_worker_results, [(0, 0), (0, 0)])
+
+	def test_send_queued_emails_saved_one_at_a_time(self):
+		"""If the worker dies, the emails it already sent stay sent and the others are sent after the lease."""
+		with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=[1, SystemExit]):
+			with self.assertRaises(SystemExit):
+				QueuedEmail.send_queued_emails()
+		self.email1.refresh_from_db()
+		self.email2.refresh_from_db()
+		self.assertEqual(self.email1.status, QueuedEmail.SENT)
+		self.assertEqual(self.email2.status, QueuedEmail.PENDING)
+		self.assertGreater(self.email2.next_attempt_at, timezone.now() + timedelta(seconds=EMAIL_LEASE_SECONDS - 5))
+
+	def test_send_queued_emails_connection_error(self):
+		"""The lease is released when the SMTP connection can't be opened."""
+		with mock.patch('django.core.mail.backends.locmem.EmailBackend.open', side_effect=OSError('Connection refused')):
+			with self.assertRaises(OSError):
+				QueuedEmail.send_queued_emails()
+		self.assertEqual(QueuedEmail.send_queued_emails(), (2, 0))
+
+	def test_send_queued_emails_command(self):
+		out = StringIO()
+		call_command('send_queued_emails', stdout=out)
+		self.assertEqual(len(mail.outbox), 2)
+		self.assertIn('Sent 2 emails, 0 failed.', out.getvalue())
+
+
+class TestUserModelMethods(BaseTestCase):
+	def test_group_checks_share_one_query(self):
+		user = User.objects.get(pk=self.superuser.pk)
+		with self.assertNumQueries(1):
+			self.assertTrue(user.in_admin_group())
+			self.assertFalse(user.is_demo_account())
+			self.assertTrue(user.in_admin_group())
+			self.assertEqual(user.get_group_names(), frozenset(['ADMIN']))
+
+	def test_is_demo_account(self):
+		Group.objects.create(name='CUSTOMER').user_set.add(self.user2)
+		user2 = User.objects.get(pk=self.user2.pk)
+		self.assertTrue(user2.is_demo_account())
+		self.assertFalse(user2.in_admin_group())
+		self.assertFalse(self.user1.is_demo_account())
+
+	def test_cache_cleared_when_groups_change(self):
+		admin_group = Group.objects.get(name='ADMIN')
+		self.assertFalse(self.user1.in_admin_group())
+		self.user1.groups.add(admin_group)
+		self.assertTrue(self.user1.in_admin_group())
+		self.user1.groups.remove(admin_group)
+		self.assertFalse(self.user1.in_admin_group())
+
+	def test_cache_cleared_by_refresh_from_db(self):
+		self.assertFalse(self.user1.in_admin_group())
+		Group.objects.get(name='ADMIN').user_set.add(self.user1)
+		self.user1.refresh_from_db()
+		self.assertTrue(self.user1.in_admin_group())
+
+	def test_one_group_query_per_request(self):
+		"""The admin check, the navbar and the page all use the same group names query."""
+		self._superuser_login()
+		with CaptureQueriesContext(connection) as queries:
+			response = self.client.get(reverse('home:report-list'))
+		self.assertEqual(response.status_code, 200)
+		group_queries = [query for query in queries.captured_queries if '"auth_group"' in query['sql']]
+		self.assertEqual(len(group_queries), 1)
+
+
+class TestDemoAccountLeaseModelMethods(BaseTestCase):
+	def setUp(self):
+		super().setUp()
+		self.customer_group = Group.objects.create(name='CUSTOMER')
+		self.customer1 = User.objects.create_user(username='Customer 1', email='example@example.com', password=self.password)
+		self.customer2 = User.objects.create_user(username='Customer 2', email='example@example.com', password=self.password)
+		self.customer1.last_login = timezone.now() - timedelta(hours=2)
+		self.customer1.save()
+		self.customer_group.user_set.add(self.customer1, self.customer2)
+
+	def test_leases_created_when_added_to_group(self):
+		leases = DemoAccountLease.objects.filter(group='CUSTOMER')
+		self.assertEqual(set(leases.values_list('user', flat=True)), {self.customer1.pk, self.customer2.pk})
+		# The superuser is in the ADMIN group, but it's not a demo account
+		self.assertFalse(DemoAccountLease.objects.filter(group='ADMIN').exists())
+
+	def test_lease_deleted_when_removed_from_group(self):
+		self.customer2.groups.remove(self.customer_group)
+		self.assertFalse(DemoAccountLease.objects.filter(user=self.customer2).exists())
+		self.customer_group.user_set.clear()
+		self.assertFalse(DemoAccountLease.objects.exists())
+
+	def test_claim(self):
+		"""Each account is lent to 1 visitor, starting with the account whose lease expired first."""
+		self.assertEqual(DemoAccountLease.claim('CUSTOMER'), self.customer1)
+		self.assertEqual(DemoAccountLease.claim('CUSTOMER'), self.customer2)
+		self.assertIsNone(DemoAccountLease.claim('CUSTOMER'))
+
+		lease = DemoAccountLease.objects.get(user=self.customer1)
+		self.assertAlmostEqual(lease.expires_at, timezone.now() + timedelta(minutes=DEMO_ACCOUNT_LEASE_MINUTES), delta=timedelta(seconds=10))
+
+	def test_claim_expired_lease(self):
+		DemoAccountLease.claim('CUSTOMER')
+		DemoAccountLease.claim('CUSTOMER')
+		DemoAccountLease.objects.filter(user=self.customer2).update(expires_at=timezone.now() - timedelta(minutes=1))
+		self.assertEqual(DemoAccountLease.claim('CUSTOMER'), self.customer2)
+
+	def test_release(self):
+		DemoAccountLease.claim('CUSTOMER')
+		DemoAccountLease.claim('CUSTOMER')
+		DemoAccountLease.release(self.customer2)
+		self.assertEqual(DemoAccountLease.claim('CUSTOMER'), self.customer2)
+
+	def test_get_available_count(self):
+		self.assertEqual(DemoAccountLease.get_available_count('CUSTOMER'), 2)
+		# Cached
+		with self.assertNumQueries(0):
+			self.assertEqual(DemoAccountLease.get_available_count('CUSTOMER'), 2)
+		# Claiming and releasing clear the cache
+		DemoAccountLease.claim('CUSTOMER')
+		self.assertEqual(DemoAccountLease.get_available_count('CUSTOMER'), 1)
+		DemoAccountLease.release(self.customer1)
+		self.assertEqual(DemoAccountLease.get_available_count('CUSTOMER'), 2)
+
+	def test_create_leases_recent_login(self):
+		"""An account that logged in recently stays leased until DEMO_ACCOUNT_LEASE_MINUTES after its last login."""
+		customer3 = User.objects.create_user(username='Customer 3', email='example@example.com', password=self.password)
+		customer3.last_login = timezone.now() - timedelta(minutes=10)
+		customer3.save()
+		customer3.groups.add(self.customer_group)
+		lease = DemoAccountLease.objects.get(user=customer3)
+		self.assertEqual(lease.expires_at, customer3.last_login + timedelta(minutes=DEMO_ACCOUNT_LEASE_MINUTES))
+		self.assertEqual(DemoAccountLease.create_leases('CUSTOMER'), 0)
+
+
+class TestStripeEventModelMethods(BaseTestCase):
+	def setUp(self):
+		super().setUp()
+		self.product = Product.objects.create(
+			name='p1',
+			description='description1',
+			price=5,
+			status=Product.ACTIVE,
+			stock=10,
+			stripe_product_id='...',
+			stripe_price_id='...',
+			creator=self.superuser,
+			updater=self.superuser,
+		)
+		self.cart = Cart.get_active_cart_or_create_new_cart(self.user1)
+		self.product.add_product_to_cart(self.user1, self.cart, 4)
+		self.cart.reserve_stock()
+
+	def test_store_event(self):
+		event = make_checkout_session_completed_event(self.cart.uuid)
+		stripe_event, created = StripeEvent.store_event(event)
+		self.assertTrue(created)
+		self.assertEqual(stripe_event.type, StripeEvent.CHECKOUT_SESSION_COMPLETED)
+		_, created = StripeEvent.store_event(event)
+		self.assertFalse(created)
+
+	def test_process_pending_events(self):
+		StripeEvent.store_event(make_checkout_session_completed_event(self.cart.uuid))
+		self.assertEqual(StripeEvent.process_pending_events(), (1, 0))
+
+		order = self.cart.get_order()
+		self.cart.refresh_from_db()
+		self.product.refresh_from_db()
+		self.assertEqual(order.total_price, 20)
+		self.assertTrue(self.cart.is_inactive())
+		self.assertEqual(self.product.stock, 6)
+		self.assertEqual(self.cart.cartitem_set.get().original_price, 5)
+		self.assertFalse(StockReservation.objects.filter(cart=self.cart).exists())
+		self.assertTrue(QueuedEmail.objects.filter(subject='Order Confirmation').exists())
+		self.assertEqual(StripeEvent.objects.get().status, StripeEvent.PROCESSED)
+		# Nothing left to process
+		self.assertEqual(StripeEvent.process_pending_events(), (0, 0))
+
+	def test_duplicate_events_create_1_order(self):
+		"""2 events for the same checkout session (ex: resent with a new ID) still only create 1 order."""
+		StripeEvent.store_event(make_checkout_session_completed_event(self.cart.uuid))
+		StripeEvent.store_event(make_checkout_session_completed_event(self.cart.uuid))
+		self.assertEqual(StripeEvent.process_pending_events(), (2, 0))
+		self.assertEqual(Order.objects.filter(cart=self.cart).count(), 1)
+		self.product.refresh_from_db()
+		self.assertEqual(self.product.stock, 6)
+
+	def test_unpaid_session(self):
+		StripeEvent.store_event(make_checkout_session_completed_event(self.cart.uuid, payment_status='unpaid'))
+		self.assertEqual(StripeEvent.process_pending_events(), (1, 0))
+		self.assertFalse(self.cart.has_order())
+
+	def test_async_payment_succeeded(self):
+		"""A session paid later is completed unpaid, then the order is made when the payment succeeds."""
+		StripeEvent.store_event(make_checkout_session_completed_event(self.cart.uuid, payment_status='unpaid'))
+		StripeEvent.store_event(make_checkout_session_completed_event(
+			self.cart.uuid,
+			event_type=StripeEvent.CHECKOUT_SESSION_ASYNC_PAYMENT_SUCCEEDED,
+		))
+		self.assertEqual(StripeEvent.process_pending_events(), (2, 0))
+		self.assertTrue(self.cart.has_order())
+		self.assertEqual(StripeEvent.objects.filter(status=StripeEvent.PROCESSED).count(), 2)
+
+	def test_no_payment_required(self):
+		StripeEvent.store_event(make_checkout_session_completed_event(self.cart.uuid, payment_status='no_payment_required'))
+		self.assertEqual(StripeEvent.process_pending_events(), (1, 0))
+		self.assertTrue(self.cart.has_order())
+
+	def test_failed_event(self):
+		"""The failed event is retried later, the rest of the batch is still processed."""
+		StripeEvent.store_event(make_checkout_session_completed_event(uuid.uuid4()))
+		StripeEvent.store_event(make_checkout_session_completed_event(self.cart.uuid))
+		self.assertEqual(StripeEvent.process_pending_events(), (1, 1))
+		self.assertTrue(self.cart.has_order())
+
+		failed_event = StripeEvent.objects.get(status=StripeEvent.PENDING)
+		self.assertEqual(failed_event.attempts, 1)
+		self.assertIn('DoesNotExist', failed_event.last_error)
+		self.assertGreater(failed_event.next_attempt_at, timezone.now() + timedelta(seconds=STRIPE_EVENT_RETRY_BACKOFF_SECONDS - 10))
+		# Not retried until next_attempt_at
+		self.assertEqual(StripeEvent.process_pending_events(), (0, 0))
+
+		failed_event.attempts = STRIPE_EVENT_MAX_ATTEMPTS - 1
+		failed_event.next_attempt_at = timezone.now()
+		failed_event.save()
+		self.assertEqual(StripeEvent.process_pending_events(), (0, 1))
+		failed_event.refresh_from_db()
+		self.assertEqual(failed_event.status, StripeEvent.FAILED)
+
+	def test_events_leased(self):
+		"""Events being processed are leased, another worker doesn't process them."""
+		StripeEvent.store_event(make_checkout_session_completed_event(self.cart.uuid))
+		other_worker_results = []
+		process = StripeEvent.process
+
+		def process_and_check_other_worker(event):
+			other_worker_results.append(StripeEvent.process_pending_events())
+			process(event)
+
+		with mock.patch.object(StripeEvent, 'process', process_and_check_other_worker):
+			self.assertEqual(StripeEvent.process_pending_events(), (1, 0))
+		self.assertEqual(other_worker_results, [(0, 0)])
+
+	def test_events_saved_one_at_a_time(self):
+		"""If the worker dies, the events it already processed stay processed and the others are processed after the lease."""
+		StripeEvent.store_event(make_checkout_session_completed_event(self.cart.uuid))
+		StripeEvent.store_event(make_checkout_session_completed_event(self.cart.uuid))
+		with mock.patch.object(StripeEvent, 'process', side_effect=[None, SystemExit]):
+			with self.assertRaises(SystemExit):
+				StripeEvent.process_pending_events()
+		first_event, second_event = StripeEvent.objects.order_by('pk')
+		self.assertEqual(first_event.status, StripeEvent.PROCESSED)
+		self.assertEqual(second_event.status, StripeEvent.PENDING)
+		self.assertGreater(second_event.next_attempt_at, timezone.now() + timedelta(seconds=STRIPE_EVENT_LEASE_SECONDS - 10))
+
+	def test_process_stripe_events_command(self):
+		StripeEvent.store_event(make_checkout_session_completed_event(self.cart.uuid))
+		out = StringIO()
+		call_command('process_stripe_events', stdout=out)
+		self.assertIn("Processed 1 events, 0 failed.", out.getvalue())
+		self.assertTrue(self.cart.has_order())
@@ -3,14 +3,37 @@ from django.template import Context, Template
 from django.utils import timezone
 from django.http import HttpResponse
 from django.conf import settings
+from django.shortcuts import reverse
 from django.core.files import File
+from django.core.files.base import ContentFile
 from django.contrib.sites.shortcuts import get_current_site
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.management import call_command
+from django.test import override_settings
+from io import StringIO
 from senior_project import utils
+from senior_project.stripe_gateway import StripeGateway, FakeStripeGateway, RequestThrottle, get_stripe_gateway
+from senior_project.stripe_catalog import get_catalog_changes, sync_stripe_catalog
+from senior_project.exceptions import ErrorCreatingAStripeProduct, ErrorDeletingFiles
+from senior_project.storage import delete_files, get_s3_client
+from senior_project.images import make_image_variants, clean_image
+from PIL import Image
+from storages.backends.s3 import S3Storage
+from botocore.stub import Stubber
+from django.core.files.storage import default_storage
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 from home.tests.base import BaseTestCase
-from home.models import Product, ProductImage, Cart
+from home.models import Product, ProductImage, ProductImageVariant, Cart, QueuedEmail
 from blog.models import Post
 import datetime
+import io
+import json
 import requests
+import stripe
+import threading
+import time
 
 
 class TestUtilityFunctions(BaseTestCase):
@@ -37,6 +60,50 @@ class TestUtilityFunctions(BaseTestCase):
 		self.assertEqual(['sacramento', 'los angeles'], utils.get_allowed_cities('sacramento,los angeles'))
 
 
+@override_settings(DEMO_ACCOUNTS_ALERT_THRESHOLD=0, DEMO_ACCOUNTS_ALERT_SECONDS=60 * 60)
+class TestDemoAccountAlerts(BaseTestCase):
+	def setUp(self):
+		super().setUp()
+		customer = get_user_model().objects.create_user(username='Customer 1', email='example@example.com', password=self.password)
+		Group.objects.create(name='CUSTOMER').user_set.add(customer)
+
+	def _get_alerts(self):
+		return QueuedEmail.objects.filter(subject="SP: Demo Users")
+
+	def test_no_alert_above_threshold(self):
+		# 0 admins are available, set the threshold below that
+		with self.settings(DEMO_ACCOUNTS_ALERT_THRESHOLD=-1):
+			self.assertFalse(utils.email_num_dummy_users())
+		self.assertFalse(self._get_alerts().exists())
+
+	def test_alert(self):
+		self.assertTrue(utils.email_num_dummy_users())
+		self.assertEqual(self._get_alerts().get().message, "0/0 admins are available. 1/1 customers are available.")
+
+	def test_one_alert_per_window(self):
+		self.assertTrue(utils.email_num_dummy_users())
+		self.assertFalse(utils.email_num_dummy_users())
+
+		# The alert was sent within the window
+		self._get_alerts().update(status=QueuedEmail.SENT, sent_at=timezone.now() - datetime.timedelta(minutes=30))
+		self.assertFalse(utils.email_num_dummy_users())
+
+		# The window is over
+		self._get_alerts().update(sent_at=timezone.now() - datetime.timedelta(minutes=61))
+		self.assertTrue(utils.email_num_dummy_users())
+		self.assertEqual(self._get_alerts().count(), 2)
+
+	def test_login_page_does_not_alert(self):
+		response = self.client.get(reverse('account_login'))
+		self.assertEqual(response.status_code, 200)
+		self.assertFalse(self._get_alerts().exists())
+
+	def test_check_demo_accounts_command(self):
+		out = StringIO()
+		call_command('check_demo_accounts', stdout=out)
+		self.assertIn("the admin was emailed", out.getvalue())
+		self.assertEqual(self._get_alerts().count(), 1)
+
 class TestDecorators(BaseTestCase):
 	def setUp(self):
 		super().setUp()
@@ -93,17 +160,22 @@ class TestTemplateTags(BaseTestCase):
 		# Create a fake request
 		request = self.factory.get('/fake-path/')
 		request.user = self.user1
+		request.session = {}
 
 		# Creates a fake template that uses the tag
 		template = Template('{% load tags %} {% cart_url %}')
 
-		# Renders the template with the given context.
+		# Nothing cached yet, so it links to the page that finds the active cart, without creating a cart
 		rendered_template = template.render(Context({'request': request}))
+		self.assertIn(reverse('home:cart-active'), rendered_template)
+		self.assertFalse(Cart.objects.filter(creator=self.user1).exists())
 
-		# Get the expected cart url
-		expected_url = Cart.get_active_cart_or_create_new_cart(request.user).get_read_url()
+		# Get the expected cart url, this caches the cart ID in the session
+		expected_url = Cart.get_active_cart_or_create_new_cart(request.user, request.session).get_read_url()
 
-		# Assert that the template contains the url
+		# Assert that the template contains the url, without querying the DB
+		with self.assertNumQueries(0):
+			rendered_template = template.render(Context({'request': request}))
 		self.assertIn(expected_url, rendered_template)
 
 
@@ -140,7 +212,560 @@ class TestAWSFunctionality(BaseTestCase):
 		self.assertIn("amazonaws.com", self.image_url)
 
 	def test_get_image_after_product_deletion(self):
-		self.product1.delete_images()
+		with self.captureOnCommitCallbacks(execute=True):
+			self.product1.delete_images()
 		self.product1.delete()
 		r = requests.get(self.image_url)
 		self.assertEqual(404, r.status_code)
+
+
+class TestBulkImageDeletion(BaseTestCase):
+	def setUp(self):
+		super().setUp()
+		self.product1 = self._create_product('p1', images=2)
+		self.product2 = self._create_product('p2', images=1)
+
+	def _create_product(self, name, images):
+		product = Product.objects.create(
+			name=name,
+			description='description',
+			price=5,
+			status=Product.ACTIVE,
+			stock=10,
+			stripe_product_id='...',
+			stripe_price_id='...',
+			creator=self.superuser,
+			updater=self.superuser,
+		)
+		with open('static/images/for_testing/dummy_image1.jpg', 'rb') as f:
+			content = f.read()
+		product.save_images([ContentFile(content, name='dummy_image1.jpg') for _ in range(images)])
+		product.refresh_from_db()
+		return product
+
+	def test_delete_images(self):
+		names = [image.image.name for image in self.product1.get_images()]
+		names += [variant.file.name for variant in ProductImageVariant.objects.filter(image__product=self.product1)]
+		# The same number of queries for any number of images
+		with self.assertNumQueries(9), self.captureOnCommitCallbacks(execute=True):
+			self.product1.delete_images()
+		self.assertFalse(self.product1.get_images().exists())
+		self.product1.refresh_from_db()
+		self.assertIsNone(self.product1.primary_image)
+		for name in names:
+			self.assertFalse(default_storage.exists(name))
+		# Other products keep their images
+		self.assertEqual(self.product2.get_images().count(), 1)
+		self.assertTrue(default_storage.exists(self.product2.primary_image.image.name))
+
+	def test_primary_image_deleted(self):
+		"""The product's next image becomes its primary image."""
+		first_image, second_image = self.product1.get_images().order_by('pk')
+		ProductImage.bulk_delete(ProductImage.objects.filter(pk=first_image.pk))
+		self.product1.refresh_from_db()
+		self.assertEqual(self.product1.primary_image, second_image)
+
+	def test_delete_files_failed(self):
+		"""The rows are still deleted, the error is logged instead of raised."""
+		error = ErrorDeletingFiles([{'Key': 'a.jpg', 'Code': 'AccessDenied', 'Message': 'Access Denied'}])
+		with mock.patch('home.models.delete_files', side_effect=error), self.assertLogs('home.models', 'ERROR'):
+			with self.captureOnCommitCallbacks(execute=True):
+				self.product1.delete_images()
+		self.assertFalse(self.product1.get_images().exists())
+
+	def test_delete_data(self):
+		call_command('delete_data', stdout=StringIO())
+		self.assertFalse(Product.objects.exists())
+		self.assertFalse(ProductImage.objects.exists())
+
+	def _get_stubbed_s3(self):
+		storage = S3Storage(bucket_name='bucket', access_key='key', secret_key='secret', region_name='us-east-1', endpoint_url=None)
+		client = get_s3_client(storage)
+		stubber = Stubber(client)
+		stubber.activate()
+		self.addCleanup(stubber.deactivate)
+		return storage, client, stubber
+
+	def test_delete_files_s3_batches(self):
+		storage, client, stubber = self._get_stubbed_s3()
+		for keys in [['a.jpg', 'b.jpg'], ['c.jpg']]:
+			stubber.add_response(
+				'delete_objects',
+				{},
+				{'Bucket': 'bucket', 'Delete': {'Objects': [{'Key': key} for key in keys], 'Quiet': True}},
+			)
+		requests_sent = delete_files(['a.jpg', 'b.jpg', '', 'c.jpg'], storage=storage, client=client, batch_size=2, workers=1)
+		self.assertEqual(requests_sent, 2)
+		stubber.assert_no_pending_responses()
+
+	def test_delete_files_s3_errors(self):
+		storage, client, stubber = self._get_stubbed_s3()
+		errors = [{'Key': 'a.jpg', 'Code': 'AccessDenied', 'Message': 'Access Denied'}]
+		stubber.add_response('delete_objects', {'Errors': errors})
+		with self.assertRaises(ErrorDeletingFiles) as cm:
+			delete_files(['a.jpg', 'b.jpg'], storage=storage, client=client)
+		self.assertEqual(cm.exception.errors, errors)
+
+
+class TestProductImageVariants(BaseTestCase):
+	def setUp(self):
+		super().setUp()
+		self.product = Product.objects.create(
+			name='p1',
+			description='description',
+			price=5,
+			status=Product.ACTIVE,
+			stock=10,
+			stripe_product_id='...',
+			stripe_price_id='...',
+			creator=self.superuser,
+			updater=self.superuser,
+		)
+		# dummy_image1.jpg is 640x439
+		with open('static/images/for_testing/dummy_image1.jpg', 'rb') as f:
+			self.product.save_images([File(f)])
+		self.image = self.product.get_images().get()
+
+	def test_variants_created_on_upload(self):
+		variants = self.image.variants.order_by('width', 'format')
+		self.assertEqual(
+			[(variant.width, variant.height, variant.format) for variant in variants],
+			[(300, 206, 'JPEG'), (300, 206, 'WEBP'), (600, 412, 'JPEG'), (600, 412, 'WEBP')],
+		)
+		for variant in variants:
+			with variant.file.open('rb'), Image.open(variant.file) as image:
+				self.assertEqual(image.format, variant.format)
+				self.assertEqual(image.size, (variant.width, variant.height))
+			self.assertLess(variant.file.size, self.image.image.size)
+
+	def _list_files(self):
+		return set(default_storage.listdir('product_images/')[1]) | set(default_storage.listdir('product_images/variants/')[1])
+
+	def test_save_images(self):
+		with open('static/images/for_testing/dummy_image2.jpg', 'rb') as f:
+			content = f.read()
+		# Files with the same name are uploaded at the same time
+		images = self.product.save_images([ContentFile(content, name='same.jpg') for _ in range(3)])
+		self.assertEqual(len({image.image.name for image in images}), 3)
+		for image in images:
+			self.assertTrue(default_storage.exists(image.image.name))
+			self.assertEqual(image.variants.count(), 4)
+		self.assertEqual(self.product.get_images().count(), 4)
+		# The primary image didn't change
+		self.product.refresh_from_db()
+		self.assertEqual(self.product.primary_image, self.image)
+
+	def test_save_images_same_root(self):
+		"""Files with the same name but different extensions don't have the same variant names."""
+		with open('static/images/for_testing/dummy_image2.jpg', 'rb') as f:
+			jpeg = f.read()
+		png = io.BytesIO()
+		Image.new('RGB', (400, 100)).save(png, format='PNG')
+		images = self.product.save_images([ContentFile(jpeg, name='photo.jpg'), ContentFile(png.getvalue(), name='photo.png')])
+		variants = ProductImageVariant.objects.filter(image__in=images)
+		self.assertEqual(len({variant.file.name for variant in variants}), len(variants))
+		for variant in variants:
+			root = 'photo_jpg_' if variant.image_id == images[0].pk else 'photo_png_'
+			self.assertTrue(variant.file.name.startswith(f'product_images/variants/{root}{variant.width}'))
+			with variant.file.open('rb'), Image.open(variant.file) as image:
+				self.assertEqual(image.size, (variant.width, variant.height))
+
+	def test_save_images_failed_upload(self):
+		"""Nothing is saved and the uploaded files are deleted."""
+		files = self._list_files()
+		with open('static/images/for_testing/dummy_image2.jpg', 'rb') as f:
+			content = f.read()
+		with self.assertRaises(OSError):
+			self.product.save_images([ContentFile(content, name='image.jpg'), ContentFile(b'not an image', name='broken.jpg')])
+		self.assertEqual(self.product.get_images().count(), 1)
+		self.assertEqual(self._list_files(), files)
+
+	def test_delete_images_keep(self):
+		with open('static/images/for_testing/dummy_image2.jpg', 'rb') as f:
+			new_images = self.product.save_images([File(f)])
+		self.product.delete_images(keep=new_images)
+		self.assertEqual(list(self.product.get_images()), new_images)
+		self.product.refresh_from_db()
+		self.assertEqual(self.product.primary_image, new_images[0])
+
+	def test_make_image_variants(self):
+		original = Image.new('RGBA', (200, 100))
+		exif = original.getexif()
+		exif[0x010F] = 'Camera maker'
+		file = io.BytesIO()
+		original.save(file, format='PNG', exif=exif)
+
+		# Widths larger than the image aren't made, the image's own width is used instead
+		variants = make_image_variants(file, widths=[300, 600], formats=['JPEG'])
+		self.assertEqual([(variant['width'], variant['height']) for variant in variants], [(200, 100)])
+		with Image.open(io.BytesIO(variants[0]['content'])) as image:
+			self.assertEqual(len(image.getexif()), 0)
+		self.assertEqual(file.tell(), 0)
+
+	def test_make_image_variants_transparent(self):
+		"""Transparent pixels are white, not black."""
+		original = Image.new('RGBA', (100, 100), (0, 0, 0, 0))
+		original.paste((255, 0, 0, 255), (0, 0, 50, 100))
+		file = io.BytesIO()
+		original.save(file, format='PNG')
+
+		for variant in make_image_variants(file, widths=[100]):
+			with Image.open(io.BytesIO(variant['content'])) as image:
+				image = image.convert('RGB')
+				self.assertTrue(all(value > 245 for value in image.getpixel((75, 50))), variant['format'])
+				red, green, blue = image.getpixel((25, 50))
+				self.assertTrue(red > 245 and green < 10 and blue < 10, variant['format'])
+
+	def test_clean_image(self):
+		original = Image.new('RGB', (4000, 1500))
+		exif = original.getexif()
+		exif[0x010F] = 'Camera maker'
+		exif[0x0112] = 6  # Orientation: rotated 90 degrees
+		file = io.BytesIO()
+		original.save(file, format='JPEG', exif=exif)
+
+		with Image.open(io.BytesIO(clean_image(file))) as image:
+			self.assertEqual(image.format, 'JPEG')
+			# Rotated, then made as wide as the largest variant
+			self.assertEqual(image.size, (1200, 3200))
+			self.assertEqual(len(image.getexif()), 0)
+		self.assertEqual(file.tell(), 0)
+
+	def test_save_images_cleans_original(self):
+		original = Image.new('RGB', (2000, 1000))
+		exif = original.getexif()
+		exif[0x8825] = {1: 'N'}  # GPS info
+		file = io.BytesIO()
+		original.save(file, format='JPEG', exif=exif)
+		images = self.product.save_images([ContentFile(file.getvalue(), name='gps.jpg')])
+		image = ProductImage.objects.get(pk=images[0].pk)
+		with image.image.open('rb'), Image.open(image.image) as stored:
+			self.assertEqual(stored.size, (1200, 600))
+			self.assertEqual(len(stored.getexif()), 0)
+
+	def test_get_srcsets(self):
+		srcsets = self.image.get_srcsets()
+		webp_300, webp_600 = self.image.variants.filter(format=ProductImageVariant.WEBP).order_by('width')
+		self.assertEqual(srcsets['WEBP'], f"{webp_300.file.url} 300w, {webp_600.file.url} 600w")
+		self.assertIn('JPEG', srcsets)
+
+	def test_srcset_rendered(self):
+		for url in [reverse('home:home'), self.product.get_read_url()]:
+			response = self.client.get(url)
+			self.assertContains(response, f'srcset="{self.image.get_srcsets()["WEBP"]}"')
+			self.assertContains(response, f'src="{self.image.image.url}"')
+
+	def test_make_image_variants_command(self):
+		ProductImageVariant.objects.all().delete()
+		out = StringIO()
+		call_command('make_image_variants', stdout=out)
+		self.assertIn("Made the variants of 1 product images.", out.getvalue())
+		self.assertEqual(self.image.variants.count(), 4)
+
+
+class StubStripeHandler(BaseHTTPRequestHandler):
+	"""A local stand in for the Stripe API. Fails the next `failures` requests with a 500."""
+	protocol_version = 'HTTP/1.1'  # keep connections open, like stripe
+	requests = []
+	failures = 0
+
+	def do_POST(self):
+		self.rfile.read(int(self.headers.get('Content-Length', 0)))
+		StubStripeHandler.requests.append((self.path, self.headers.get('Idempotency-Key'), self.client_address[1]))
+		if StubStripeHandler.failures:
+			StubStripeHandler.failures -= 1
+			status, body = 500, {'error': {'type': 'api_error', 'message': 'Something went wrong.'}}
+		else:
+			status, body = 200, {'id': 'prod_stub', 'object': 'product', 'name': 'p1'}
+		body = json.dumps(body).encode()
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+
+class TestStripeGateway(BaseTestCase):
+	def setUp(self):
+		super().setUp()
+		self.gateway = self.stripe_gateway
+		self.product = Product.objects.create(
+			name='p1',
+			description='description1',
+			price=5,
+			status=Product.ACTIVE,
+			stock=10,
+			stripe_product_id='...',
+			stripe_price_id='...',
+			creator=self.superuser,
+			updater=self.superuser,
+		)
+
+	def test_get_stripe_gateway(self):
+		self.assertIsInstance(self.gateway, FakeStripeGateway)
+		self.assertIs(get_stripe_gateway(), self.gateway)
+
+	def test_idempotency_key(self):
+		product1 = self.gateway.create_product('p1', 'https://example.com/', idempotency_key='key1')
+		product2 = self.gateway.create_product('p1', 'https://example.com/', idempotency_key='key1')
+		self.assertEqual(product1.id, product2.id)
+		self.assertEqual(len(self.gateway.objects), 1)
+		with self.assertRaises(stripe.error.IdempotencyError):
+			self.gateway.create_product('p2', 'https://example.com/', idempotency_key='key1')
+
+	def test_retries(self):
+		self.gateway.errors = [stripe.error.APIConnectionError('Connection reset.'), stripe.error.APIError('Server error.')]
+		product = self.gateway.create_product('p1', 'https://example.com/', idempotency_key='key1')
+		self.assertEqual(product.name, 'p1')
+		# Every attempt sent the same key
+		self.assertEqual([call[3] for call in self.gateway.calls], ['key1'] * 3)
+		metrics = self.gateway.get_metrics()['product.create']
+		self.assertEqual((metrics['calls'], metrics['retries'], metrics['errors']), (1, 2, 0))
+
+	def test_retries_run_out(self):
+		self.gateway.errors = [stripe.error.RateLimitError('Too many requests.')] * (self.gateway.max_retries + 1)
+		with self.assertRaises(stripe.error.RateLimitError):
+			self.gateway.create_product('p1', 'https://example.com/', idempotency_key='key1')
+		self.assertEqual(len(self.gateway.calls), self.gateway.max_retries + 1)
+		self.assertEqual(self.gateway.get_metrics()['product.create']['errors'], 1)
+
+	def test_invalid_request_not_retried(self):
+		with self.assertRaises(stripe.error.InvalidRequestError):
+			self.gateway.retrieve_price('price_missing')
+		self.assertEqual(len(self.gateway.calls), 1)
+
+	def test_create_stripe_product_and_price_objs(self):
+		self.product.create_stripe_product_and_price_objs()
+		stripe_product = self.gateway.objects[self.product.stripe_product_id]
+		stripe_price = self.gateway.objects[self.product.stripe_price_id]
+		self.assertEqual(stripe_product['name'], 'p1')
+		self.assertEqual(stripe_price['unit_amount'], 500)
+		self.assertEqual(stripe_price['product'], stripe_product['id'])
+		self.assertEqual(self.gateway.calls[0][3], self.product.get_stripe_idempotency_key('create'))
+
+	def test_create_stripe_product_and_price_objs_error(self):
+		self.gateway.errors = [stripe.error.AuthenticationError('Invalid API key.')]
+		with self.assertRaises(ErrorCreatingAStripeProduct):
+			self.product.create_stripe_product_and_price_objs()
+		self.assertFalse(Product.objects.filter(pk=self.product.pk).exists())
+
+	def test_update_stripe_product_and_price_objs(self):
+		self.product.create_stripe_product_and_price_objs()
+		old_price_id = self.product.stripe_price_id
+		self.product.name = 'p2'
+		self.product.price = 7
+		self.product.update_stripe_product_and_price_objs()
+
+		stripe_product = self.gateway.objects[self.product.stripe_product_id]
+		self.assertEqual(stripe_product['name'], 'p2')
+		self.assertNotEqual(self.product.stripe_price_id, old_price_id)
+		self.assertEqual(stripe_product['default_price'], self.product.stripe_price_id)
+		self.assertEqual(self.gateway.objects[self.product.stripe_price_id]['unit_amount'], 700)
+		self.assertFalse(self.gateway.objects[old_price_id]['active'])
+
+		# Changing the price back creates another price
+		self.product.price = 5
+		self.product.update_stripe_product_and_price_objs()
+		self.assertNotEqual(self.product.stripe_price_id, old_price_id)
+		self.assertEqual(self.gateway.objects[self.product.stripe_price_id]['unit_amount'], 500)
+
+	def test_update_stripe_product_and_price_objs_requests(self):
+		"""An unchanged price is 1 request, a changed price is 3, the price is never retrieved from stripe."""
+		self.product.create_stripe_product_and_price_objs()
+		self.assertEqual(self.product.stripe_unit_amount, 500)
+		self.gateway.calls.clear()
+		self.product.name = 'p2'
+		self.product.update_stripe_product_and_price_objs()
+		self.assertEqual([(method, url) for method, url, params, key in self.gateway.calls], [('post', f'/v1/products/{self.product.stripe_product_id}')])
+
+		self.gateway.calls.clear()
+		self.product.price = 7
+		self.product.update_stripe_product_and_price_objs()
+		self.assertEqual([method for method, url, params, key in self.gateway.calls], ['post'] * 3)
+		self.assertEqual(self.gateway.calls[1][2], {'default_price': self.product.stripe_price_id, 'name': 'p2', 'url': utils.get_full_url(self.product.get_read_url())})
+		self.product.refresh_from_db()
+		self.assertEqual(self.product.stripe_unit_amount, 700)
+
+	def test_update_stripe_product_and_price_objs_unknown_unit_amount(self):
+		"""Products synced before stripe_unit_amount existed retrieve the price once."""
+		self.product.create_stripe_product_and_price_objs()
+		Product.objects.filter(pk=self.product.pk).update(stripe_unit_amount=None)
+		self.product.refresh_from_db()
+		self.product.update_stripe_product_and_price_objs()
+		self.assertEqual(self.gateway.calls[-2][:2], ('get', f'/v1/prices/{self.product.stripe_price_id}'))
+		self.product.refresh_from_db()
+		self.assertEqual(self.product.stripe_unit_amount, 500)
+
+	def test_delete_product_and_set_stripe_product_as_inactive(self):
+		self.product.create_stripe_product_and_price_objs()
+		stripe_product_id = self.product.stripe_product_id
+		self.product.delete_product_and_set_stripe_product_as_inactive()
+		self.assertFalse(self.gateway.objects[stripe_product_id]['active'])
+		self.assertFalse(Product.objects.filter(pk=self.product.pk).exists())
+
+	def test_create_stripe_checkout_session(self):
+		self.product.create_stripe_product_and_price_objs()
+		cart = Cart.get_active_cart_or_create_new_cart(self.user1)
+		self.product.add_product_to_cart(self.user1, cart, 2)
+		url = cart.create_stripe_checkout_session(timezone.now() + datetime.timedelta(minutes=35))
+		session = next(obj for obj in self.gateway.objects.values() if obj['object'] == 'checkout.session')
+		self.assertEqual(url, session['url'])
+		self.assertEqual(session['client_reference_id'], str(cart.uuid))
+		self.assertEqual(session['line_items'], [{'price': self.product.stripe_price_id, 'quantity': 2}])
+
+
+class TestSyncStripeCatalog(BaseTestCase):
+	def setUp(self):
+		super().setUp()
+		self.gateway = self.stripe_gateway
+		self.products = [
+			Product.objects.create(
+				name=f'p{i}',
+				description='description',
+				price=5 + i,
+				status=Product.ACTIVE,
+				stock=10,
+				creator=self.superuser,
+				updater=self.superuser,
+			)
+			for i in range(5)
+		]
+
+	def _sync(self, **kwargs):
+		kwargs.setdefault('requests_per_second', 1000)
+		return sync_stripe_catalog(**kwargs)
+
+	def test_create(self):
+		changes, errors = self._sync()
+		self.assertEqual(len(changes['create']), 5)
+		self.assertEqual(errors, [])
+		for product in Product.objects.all():
+			self.assertEqual(self.gateway.objects[product.stripe_product_id]['name'], product.name)
+			self.assertEqual(self.gateway.objects[product.stripe_price_id]['unit_amount'], product.get_stripe_unit_amount())
+
+		# Nothing left to sync
+		changes = get_catalog_changes(self.gateway)
+		self.assertEqual(changes, {'create': [], 'reactivate': [], 'update_price': [], 'deactivate': []})
+
+	def test_reactivate(self):
+		"""An inactive stripe product is reactivated, creating it again would get the inactive product back."""
+		self._sync()
+		product = Product.objects.get(name='p1')
+		self.gateway.modify_product(product.stripe_product_id, active=False)
+
+		changes, errors = self._sync()
+		self.assertEqual(changes['create'], [])
+		self.assertEqual([p.pk for p in changes['reactivate']], [product.pk])
+		self.assertTrue(self.gateway.objects[product.stripe_product_id]['active'])
+		self.assertEqual(get_catalog_changes(self.gateway)['reactivate'], [])
+
+	def test_update_price_and_deactivate(self):
+		self._sync()
+		product = Product.objects.get(name='p1')
+		old_price_id = product.stripe_price_id
+		Product.objects.filter(pk=product.pk).update(price=20)
+		deleted_stripe_product_id = Product.objects.get(name='p2').stripe_product_id
+		Product.objects.filter(name='p2').delete()
+		# Another site's stripe product isn't deactivated
+		other_site_product = self.gateway.create_product('other', 'https://example.org/product/1/', idempotency_key='other')
+
+		changes, errors = self._sync()
+		self.assertEqual([p.pk for p in changes['update_price']], [product.pk])
+		self.assertEqual(changes['deactivate'], [deleted_stripe_product_id])
+		product.refresh_from_db()
+		self.assertNotEqual(product.stripe_price_id, old_price_id)
+		self.assertEqual(self.gateway.objects[product.stripe_price_id]['unit_amount'], 2000)
+		self.assertFalse(self.gateway.objects[old_price_id]['active'])
+		self.assertFalse(self.gateway.objects[deleted_stripe_product_id]['active'])
+		self.assertTrue(self.gateway.objects[other_site_product.id]['active'])
+
+	def test_dry_run(self):
+		changes, errors = self._sync(dry_run=True)
+		self.assertEqual(len(changes['create']), 5)
+		self.assertEqual(self.gateway.objects, {})
+
+	def test_failed_change(self):
+		"""A failed change doesn't stop the others, the next sync retries it."""
+		self.gateway.max_retries = 0
+		# The 2 list requests work, then the first create fails
+		self.gateway.errors = [None, None, stripe.error.AuthenticationError('Invalid API key.')]
+		changes, errors = self._sync(workers=1)
+		self.assertEqual(len(errors), 1)
+		self.assertEqual(Product.objects.exclude(stripe_product_id='').count(), 4)
+
+		changes, errors = self._sync()
+		self.assertEqual(len(changes['create']), 1)
+		self.assertEqual(errors, [])
+
+	def test_workers_run_concurrently(self):
+		self.gateway.latency = 0.05
+		start = time.perf_counter()
+		self._sync(workers=10)
+		# 2 list requests, then 5 creates of 2 requests each
+		self.assertLess(time.perf_counter() - start, 0.05 * 10)
+
+	def test_shared_gateway_not_throttled(self):
+		"""The sync throttles a copy of the gateway, other code using get_stripe_gateway() isn't throttled."""
+		throttled_gateway = self.gateway.with_throttle(RequestThrottle(rate=1))
+		self.assertIsNone(self.gateway.throttle)
+		product = throttled_gateway.create_product('p1', 'https://example.com/', idempotency_key='key1')
+		# The copy shares the stripe objects
+		self.assertIn(product.id, self.gateway.objects)
+
+		with mock.patch.object(RequestThrottle, 'wait') as wait:
+			self._sync()
+			list(self.gateway.list_products())
+		self.assertEqual(wait.call_count, 2 + 5 * 2)
+
+	def test_throttle(self):
+		throttle = RequestThrottle(rate=100)
+		start = time.perf_counter()
+		for _ in range(11):
+			throttle.wait()
+		self.assertGreaterEqual(time.perf_counter() - start, 0.1)
+		throttle.slow_down()
+		self.assertEqual(throttle.rate, 50)
+
+	def test_command(self):
+		out = StringIO()
+		call_command('sync_stripe_catalog', '--dry-run', stdout=out)
+		self.assertIn("Products to create: 5.", out.getvalue())
+		call_command('sync_stripe_catalog', '--requests-per-second=1000', stdout=out)
+		self.assertIn("Created 5 products, reactivated 0 products, updated 0 prices and deactivated 0 stripe products.", out.getvalue())
+
+
+class TestStripeGatewayHTTP(BaseTestCase):
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubStripeHandler)
+		cls.server.daemon_threads = True
+		threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.server.shutdown()
+		cls.server.server_close()
+		super().tearDownClass()
+
+	def setUp(self):
+		super().setUp()
+		StubStripeHandler.requests = []
+		StubStripeHandler.failures = 0
+		self.gateway = StripeGateway(api_key='sk_test_stub', api_base=f'http://127.0.0.1:{self.server.server_address[1]}', retry_backoff=0)
+
+	def test_retry_sends_same_idempotency_key(self):
+		StubStripeHandler.failures = 1
+		product = self.gateway.create_product('p1', 'https://example.com/', idempotency_key='product-1-create')
+		self.assertEqual(product.id, 'prod_stub')
+		self.assertEqual([request[1] for request in StubStripeHandler.requests], ['product-1-create'] * 2)
+
+	def test_connection_reused(self):
+		self.gateway.create_product('p1', 'https://example.com/', idempotency_key='key1')
+		self.gateway.modify_product('prod_stub', name='p2')
+		client_ports = {request[2] for request in StubStripeHandler.requests}
+		self.assertEqual(len(client_ports), 1)
+		self.assertEqual(self.gateway.get_metrics()['product.modify']['calls'], 1)
@@ -2,12 +2,18 @@ from django.core import mail
 from django.urls import resolve
 from django.shortcuts import reverse
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
 from django.forms.fields import Field
-from home.models import Product
+from django.core.files import File
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from senior_project.utils import encode_cursor
+from home.models import Product, ProductImage
 from home.views import views
 from home.tests.base import BaseTestCase
 from users.forms import DeleteUserForm
 from users.views import delete_user
+from users.models import DemoAccountLease
 import environ
 
 
@@ -64,6 +70,38 @@ class TestDeleteUser(BaseTestCase):
 		self.assertEqual(response.status_code, 200)
 
 
+class TestDemoAccountLogin(BaseTestCase):
+	def setUp(self):
+		super().setUp()
+		self.customer = User.objects.create_user(username='Customer 1', email='example@example.com', password=self.password)
+		Group.objects.create(name='CUSTOMER').user_set.add(self.customer)
+		self.url = reverse('users:login-as-customer')
+
+	def test_login_as_customer(self):
+		response = self.client.get(self.url)
+		self.assertRedirects(response, reverse('home:home'), fetch_redirect_response=False)
+		self.assertEqual(int(self.client.session['_auth_user_id']), self.customer.pk)
+		self.assertEqual(DemoAccountLease.get_available_count('CUSTOMER'), 0)
+
+	def test_all_accounts_in_use(self):
+		"""The next visitor isn't given the same account."""
+		self.client.get(self.url)
+		self.client.logout()
+		DemoAccountLease.claim('CUSTOMER')
+		response = self.client.get(self.url)
+		self.assertRedirects(response, reverse('account_login'), fetch_redirect_response=False)
+		self.assertNotIn('_auth_user_id', self.client.session)
+
+	def test_logout_releases_lease(self):
+		self.client.get(self.url)
+		self.client.post(reverse('account_logout'))
+		self.assertEqual(DemoAccountLease.get_available_count('CUSTOMER'), 1)
+
+	def test_login_page_available_counts(self):
+		response = self.client.get(reverse('account_login'))
+		self.assertEqual(response.context['num_available_customer_users'], 1)
+		self.assertEqual(response.context['num_available_admin_users'], 0)
+
 # You need to be logged in to view the page
 class TestContactPage(BaseTestCase):
 	def setUp(self):
@@ -150,3 +188,52 @@ class TestHomePage(BaseTestCase):
 
 		for product in context['products']:
 			self.assertEqual(product.status, Product.ACTIVE)
+
+	def test_query_count_does_not_grow_with_products(self):
+		with CaptureQueriesContext(connection) as initial_queries:
+			self.client.get(self.url)
+
+		for i in range(3):
+			product = Product.objects.create(
+				name=f'p{i}',
+				description='description1',
+				price=10,
+				status=Product.ACTIVE,
+				stock=2,
+				stripe_product_id='...',
+				stripe_price_id='...',
+				creator=self.superuser,
+				updater=self.superuser,
+			)
+			with open('static/images/for_testing/dummy_image1.jpg', 'rb') as f1:
+				ProductImage.objects.create(product=product, image=File(f1), creator=self.superuser, updater=self.superuser)
+
+		with CaptureQueriesContext(connection) as queries:
+			response = self.client.get(self.url)
+
+		self.assertEqual(len(response.context['products']), 5)
+		# 1 more query for the primary images' variants, which isn't needed when no product has an image
+		self.assertEqual(len(queries), len(initial_queries) + 1)
+		for image in ProductImage.objects.all():
+			self.assertIn(image.image.url, response.content.decode())
+
+	def test_filters(self):
+		response = self.client.get(self.url, {'min_price': 15})
+		self.assertEqual(response.context['products'], [self.active_product2])
+		self.assertIsNone(response.context['next_cursor'])
+
+	def test_load_more(self):
+		url = reverse('home:home-load-more')
+		cursor = encode_cursor(self.active_product2.created_at, self.active_product2.pk)
+		response = self.client.get(url, {'cursor': cursor})
+		data = response.json()
+
+		self.assertEqual(resolve(url).func, views.home_load_more)
+		self.assertEqual(response.status_code, 200)
+		self.assertIn(self.active_product1.get_read_url(), data['html'])
+		self.assertNotIn(self.active_product2.get_read_url(), data['html'])
+		self.assertIsNone(data['next_cursor'])
+
+	def test_load_more_invalid_cursor(self):
+		response = self.client.get(reverse('home:home-load-more'), {'cursor': 'invalid'})
+		self.assertEqual(response.status_code, 400)
@@ -1,13 +1,23 @@
 from django.shortcuts import reverse
 from django.test import RequestFactory
 from django.urls import resolve
-from senior_project.utils import get_table_data
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.core import mail
+from senior_project.utils import get_table_data, get_reports_cache_version, invalidate_reports_cache
+from senior_project.constants import REPORT_PAGE_SIZE
+from senior_project.api_status import get_api_status
 from home.tests.base import BaseTestCase
 from home.models import Product, Cart, Order
 from home.views import reports
 from blog.models import Post
 from html.parser import HTMLParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from datetime import datetime
+import socketserver
+import threading
+import time
+import json
 import warnings
 
 warnings.filterwarnings(
@@ -106,7 +116,8 @@ class TestReportOrders(ReportBaseTestCase):
 		self.client.login(username=self.superuser.username, password=self.password)
 		self._create_orders(3)
 		request = self.factory.get('/dummy-url/', {"status": Order.PLACED, "order_by": "asc"})
-		orders, order_by = get_table_data(request, Order)
+		table = get_table_data(request, Order, REPORT_PAGE_SIZE)
+		orders, order_by = table['objects'], table['order_by']
 
 		self.assertEqual(len(orders), 2)
 		self.assertEqual(order_by, 'asc')
@@ -114,6 +125,31 @@ class TestReportOrders(ReportBaseTestCase):
 		for order in orders:
 			self.assertEqual(order.status, Order.PLACED)
 
+	def test_view_queries(self):
+		"""The user emails are loaded with the orders, not 1 query per order."""
+		self._superuser_login()
+		self._create_orders(1)
+		with CaptureQueriesContext(connection) as queries:
+			self.client.get(self.url)
+		self._create_orders(4)
+		with self.assertNumQueries(len(queries)):
+			r = self.client.get(self.url)
+		self.assertEqual(len(r.context['orders']), 5)
+
+	def test_pagination(self):
+		self._superuser_login()
+		orders = self._create_orders(3)
+		first_page = get_table_data(self.factory.get('/dummy-url/', {'sort_by': 'created_at'}), Order, 2)
+		self.assertEqual(first_page['objects'], [orders['order3'], orders['order2']])
+		self.assertIn('sort_by=created_at', first_page['next_page'])
+		# created_at is null=True, but it's always set so it uses keyset pagination
+		self.assertIn('cursor=', first_page['next_page'])
+		self.assertNotIn('page=', first_page['next_page'])
+
+		second_page = get_table_data(self.factory.get(f"/dummy-url/?{first_page['next_page']}"), Order, 2)
+		self.assertEqual(second_page['objects'], [orders['order1']])
+		self.assertIsNone(second_page['next_page'])
+
 
 class TestReportProducts(ReportBaseTestCase):
 	def setUp(self):
@@ -155,7 +191,8 @@ class TestReportProducts(ReportBaseTestCase):
 		self.client.login(username=self.superuser.username, password=self.password)
 		self._create_products(3)
 		request = self.factory.get('/dummy-url/', {"status": Product.ACTIVE, "order_by": "asc"})
-		products, order_by = get_table_data(request, Product)
+		table = get_table_data(request, Product, REPORT_PAGE_SIZE)
+		products, order_by = table['objects'], table['order_by']
 
 		self.assertEqual(len(products), 2)
 		self.assertEqual(order_by, 'asc')
@@ -202,7 +239,8 @@ class TestReportBlogs(ReportBaseTestCase):
 		self.client.login(username=self.superuser.username, password=self.password)
 		self._create_posts(3)
 		request = self.factory.get('/dummy-url/', {"status": Post.ACTIVE, "order_by": "asc"})
-		posts, order_by = get_table_data(request, Post)
+		table = get_table_data(request, Post, REPORT_PAGE_SIZE)
+		posts, order_by = table['objects'], table['order_by']
 
 		self.assertEqual(len(posts), 2)
 		self.assertEqual(order_by, 'asc')
@@ -221,6 +259,98 @@ class TestReportCharts(ReportBaseTestCase):
 	def test_access(self):
 		self._test_access(self.url1)
 
+	def _get_num_queries(self, url, data=None):
+		with CaptureQueriesContext(connection) as queries:
+			response = self.client.get(url, data)
+		return response, len(queries)
+
+	def test_cached(self):
+		"""The chart data is cached until an order changes."""
+		self.client.login(username=self.superuser.username, password=self.password)
+		self._create_orders(1)
+		response, uncached_num_queries = self._get_num_queries(self.url1)
+		response, cached_num_queries = self._get_num_queries(self.url1)
+		self.assertLess(cached_num_queries, uncached_num_queries)
+		self.assertEqual(sum(response.context['order_counts']), 1)
+
+		with self.captureOnCommitCallbacks(execute=True):
+			self._create_orders(1)
+		response = self.client.get(self.url1)
+		self.assertEqual(sum(response.context['order_counts']), 2)
+
+	def test_invalidated_after_commit(self):
+		"""The cache isn't invalidated before the change commits, a request could cache the old data again."""
+		version = get_reports_cache_version()
+		with self.captureOnCommitCallbacks(execute=True):
+			invalidate_reports_cache()
+			self.assertEqual(get_reports_cache_version(), version)
+		self.assertNotEqual(get_reports_cache_version(), version)
+
+	def test_cache_invalidated_by_purchase(self):
+		"""The top selling products chart changes after a purchase, units_sold is updated without signals."""
+		self.client.login(username=self.superuser.username, password=self.password)
+		product = Product.objects.create(
+			name='p1',
+			description='description1',
+			price=5,
+			status=Product.ACTIVE,
+			stock=10,
+			stripe_product_id='...',
+			stripe_price_id='...',
+			creator=self.superuser,
+			updater=self.superuser,
+		)
+		cart = Cart.get_active_cart_or_create_new_cart(self.user1)
+		product.add_product_to_cart(self.user1, cart, 3)
+		response = self.client.get(self.url1)
+		self.assertEqual(response.context['product_order_counts'], [0])
+
+		with self.captureOnCommitCallbacks(execute=True):
+			cart.complete_purchase()
+		response = self.client.get(self.url1)
+		self.assertEqual(response.context['product_order_counts'], [3])
+
+	def test_cache_invalidated_by_product_changes(self):
+		"""The top selling products chart shows new, renamed and deleted products."""
+		self.client.login(username=self.superuser.username, password=self.password)
+		response = self.client.get(self.url1)
+		self.assertEqual(response.context['product_names'], [])
+
+		with self.captureOnCommitCallbacks(execute=True):
+			product = Product.objects.create(
+				name='p1',
+				description='description1',
+				price=5,
+				status=Product.ACTIVE,
+				stock=10,
+				stripe_product_id='...',
+				stripe_price_id='...',
+				creator=self.superuser,
+				updater=self.superuser,
+			)
+		response = self.client.get(self.url1)
+		self.assertEqual(response.context['product_names'], ['p1'])
+
+		with self.captureOnCommitCallbacks(execute=True):
+			product.name = 'p2'
+			product.save()
+		response = self.client.get(self.url1)
+		self.assertEqual(response.context['product_names'], ['p2'])
+
+		with self.captureOnCommitCallbacks(execute=True):
+			product.delete()
+		response = self.client.get(self.url1)
+		self.assertEqual(response.context['product_names'], [])
+
+	def test_update_chart_data_cached(self):
+		self.client.login(username=self.superuser.username, password=self.password)
+		url = reverse('home:report-update-total-users-chart-data')
+		year = self.user1.date_joined.year
+		response, uncached_num_queries = self._get_num_queries(url, {'users_year': year})
+		response, cached_num_queries = self._get_num_queries(url, {'users_year': year})
+		self.assertEqual(cached_num_queries, uncached_num_queries - 1)
+		self.assertEqual(sum(response.json()['users_values']), 3)
+
 
 class TestReportExport(ReportBaseTestCase):
 	def setUp(self):
@@ -255,7 +385,8 @@ class TestReportExportDownload(ReportBaseTestCase):
 	def test_empty_export(self):
 		self._superuser_login()
 		r = self.client.get(self.url)
-		content = r.content.decode()
+		self.assertTrue(r.streaming)
+		content = b''.join(r.streaming_content).decode()
 		header = """Order ID\tOrder date\tOrder total price\tOrder status\tUser email\tShipping address\tOrdered products\r\n"""
 		self.assertIn(header, content)
 		self.assertEqual(r['Content-Type'], 'text/tsv')
@@ -267,7 +398,7 @@ class TestReportExportDownload(ReportBaseTestCase):
 		self._superuser_login()
 		self._create_orders(2)
 		r = self.client.get(self.url)
-		content = r.content.decode()
+		content = b''.join(r.streaming_content).decode()
 		find = f"""Order ID\tOrder date\tOrder total price\tOrder status\tUser email\tShipping address\tOrdered products\r\n1\t2023-12-08 20:12:12.012000+00:00\t10.00\tPlaced\t{self.superuser.email}\t\t[]\r\n2\t2023-12-08 20:12:12.012000+00:00\t10.00\tCanceled\t{self.superuser.email}\t\t[]\r\n"""
 
 		self.assertIn(find, content)
@@ -277,11 +408,75 @@ class TestReportExportDownload(ReportBaseTestCase):
 		self.assertEqual(r.status_code, 200)
 
 
+class StubAPIHandler(BaseHTTPRequestHandler):
+	"""A local stand in for the S3 and Stripe APIs."""
+	requests = []
+
+	def do_GET(self):
+		StubAPIHandler.requests.append(self.path)
+		if self.path.startswith('/v1/balance'):
+			body = json.dumps({'object': 'balance', 'available': [], 'pending': [], 'livemode': False}).encode()
+			content_type = 'application/json'
+		else:  # S3 list_buckets
+			body = b'<?xml version="1.0" encoding="UTF-8"?><ListAllMyBucketsResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/"><Buckets></Buckets></ListAllMyBucketsResult>'
+			content_type = 'application/xml'
+		self.send_response(200)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+
+class StubSMTPHandler(socketserver.StreamRequestHandler):
+	"""A local stand in for the SendGrid SMTP server. Waits `delay` seconds before greeting."""
+	delay = 0
+
+	def handle(self):
+		time.sleep(self.delay)
+		self.wfile.write(b'220 stub ESMTP\r\n')
+		for line in self.rfile:
+			command = line.strip().upper()
+			if command.startswith(b'QUIT'):
+				self.wfile.write(b'221 Bye\r\n')
+				break
+			self.wfile.write(b'250 OK\r\n')
+
+
 class TestReportAPIStatus(ReportBaseTestCase):
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		cls.api_server = ThreadingHTTPServer(('127.0.0.1', 0), StubAPIHandler)
+		cls.smtp_server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), StubSMTPHandler)
+		cls.smtp_server.daemon_threads = True
+		for server in [cls.api_server, cls.smtp_server]:
+			threading.Thread(target=server.serve_forever, daemon=True).start()
+
+	@classmethod
+	def tearDownClass(cls):
+		for server in [cls.api_server, cls.smtp_server]:
+			server.shutdown()
+			server.server_close()
+		super().tearDownClass()
+
 	def setUp(self):
 		super().setUp()
 		self.url = reverse('home:report-api-status')
 		self.parser = HTMLParser()
+		StubAPIHandler.requests = []
+		StubSMTPHandler.delay = 0
+		api_url = f'http://127.0.0.1:{self.api_server.server_address[1]}'
+		stub_settings = self.settings(
+			AWS_S3_ENDPOINT_URL=api_url,
+			STRIPE_API_BASE=api_url,
+			EMAIL_HOST='127.0.0.1',
+			EMAIL_PORT=self.smtp_server.server_address[1],
+		)
+		stub_settings.enable()
+		self.addCleanup(stub_settings.disable)
 
 	def test_access(self):
 		self._test_access(self.url)
@@ -295,6 +490,36 @@ class TestReportAPIStatus(ReportBaseTestCase):
 		self.assertEqual(resolve(self.url).func, reports.report_api_status)
 		self.assertTemplateUsed(r, 'home/reports/api_status.html')
 		self.assertEqual(r.status_code, 200)
+		# No email is sent
+		self.assertEqual(len(mail.outbox), 0)
+
+	def test_cached(self):
+		api_status = get_api_status()
+		self.assertTrue(all(status['working'] for status in api_status.values()))
+		self.assertEqual(len(StubAPIHandler.requests), 2)
+
+		self.assertEqual(get_api_status(), api_status)
+		self.assertEqual(len(StubAPIHandler.requests), 2)
+
+		get_api_status(use_cache=False)
+		self.assertEqual(len(StubAPIHandler.requests), 4)
+
+	def test_timeout(self):
+		"""A slow API fails its check without slowing down the others."""
+		StubSMTPHandler.delay = 2
+		start = time.perf_counter()
+		api_status = get_api_status(timeout=0.5, use_cache=False)
+		self.assertLess(time.perf_counter() - start, 1.5)
+		self.assertFalse(api_status['sendgrid']['working'])
+		self.assertIsNotNone(api_status['sendgrid']['error'])
+		self.assertTrue(api_status['aws']['working'])
+		self.assertTrue(api_status['stripe']['working'])
+
+	def test_not_working(self):
+		with self.settings(EMAIL_PORT=1):
+			api_status = get_api_status(use_cache=False)
+		self.assertFalse(api_status['sendgrid']['working'])
+		self.assertIn('Error', api_status['sendgrid']['error'])
 
 
 class TestTableDataUtilFunction(BaseTestCase):
@@ -323,7 +548,8 @@ class TestTableDataUtilFunction(BaseTestCase):
 		self.client.login(username=self.superuser.username, password=self.password)
 		self._create_products(2)
 		request = self.factory.get('/dummy-url/')
-		products, order_by = get_table_data(request, Product)
+		table = get_table_data(request, Product, REPORT_PAGE_SIZE)
+		products, order_by = table['objects'], table['order_by']
 
 		self.assertEqual(len(products), 2)
 		self.assertEqual(order_by, 'desc')  # Default order_by
@@ -332,9 +558,42 @@ class TestTableDataUtilFunction(BaseTestCase):
 		self.client.login(username=self.superuser.username, password=self.password)
 		self._create_products(3)
 		request = self.factory.get('/dummy-url/', {"status": Product.ACTIVE, "order_by": "asc"})
-		products, order_by = get_table_data(request, Product)
+		table = get_table_data(request, Product, REPORT_PAGE_SIZE)
+		products, order_by = table['objects'], table['order_by']
 
 		self.assertEqual(len(products), 2)
 		self.assertEqual(products[0].name, "p1")
 		self.assertEqual(products[1].name, "p3")
 		self.assertEqual(order_by, 'asc')
+
+	def test_sort_by_not_allowed(self):
+		"""Only the fields in REPORT_SORT_FIELDS can be sorted by."""
+		self._create_products(2)
+		table = get_table_data(self.factory.get('/dummy-url/', {'sort_by': 'stripe_price_id'}), Product, REPORT_PAGE_SIZE)
+		self.assertEqual(table['sort_by'], 'pk')
+		self.assertEqual([product.name for product in table['objects']], ['p2', 'p1'])
+
+	def test_status_and_sort(self):
+		self._create_products(5)
+		table = get_table_data(self.factory.get('/dummy-url/', {'status': Product.ACTIVE, 'sort_by': 'stock', 'order_by': 'desc'}), Product, 2)
+		self.assertEqual([product.name for product in table['objects']], ['p5', 'p3'])
+		self.assertIn(f'status={Product.ACTIVE}', table['next_page'])
+
+		table = get_table_data(self.factory.get(f"/dummy-url/?{table['next_page']}"), Product, 2)
+		self.assertEqual([product.name for product in table['objects']], ['p1'])
+
+	def test_nullable_sort_by(self):
+		"""Fields that can be empty are paginated by page number."""
+		self._create_products(3)
+		table = get_table_data(self.factory.get('/dummy-url/', {'sort_by': 'estimated_delivery_date'}), Product, 2)
+		self.assertEqual(len(table['objects']), 2)
+		self.assertIn('page=2', table['next_page'])
+
+		table = get_table_data(self.factory.get(f"/dummy-url/?{table['next_page']}"), Product, 2)
+		self.assertEqual(len(table['objects']), 1)
+		self.assertIsNone(table['next_page'])
+
+	def test_invalid_cursor(self):
+		self._create_products(2)
+		table = get_table_data(self.factory.get('/dummy-url/', {'cursor': 'invalid'}), Product, REPORT_PAGE_SIZE)
+		self.assertEqual(len(table['objects']), 2)
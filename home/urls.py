@@ -4,6 +4,7 @@ from home.views import views, products, carts, checkout, orders, reports
 app_name = 'home'
 urlpatterns = [
 	path('', views.home, name='home'),
+	path('load-more/', views.home_load_more, name='home-load-more'),
 	path('contact/', views.contact, name='contact'),
 
 	# Products
@@ -13,6 +14,7 @@ urlpatterns = [
 	path('product/delete/<int:pk>/', products.product_delete, name='product-delete'),
 
 	# Carts
+	path('cart/', carts.cart_active, name='cart-active'),
 	path('cart/<int:pk>/', carts.cart_read, name='cart-read'),  # also acts as cart/update/
 	path('cart/delete/<int:pk>/', carts.cart_delete, name='cart-delete'),
 
@@ -21,6 +23,7 @@ urlpatterns = [
 	path('checkout/proceed-to-stripe/', checkout.proceed_to_stripe, name='proceed-to-stripe'),
 	path('checkout/payment-success/<uuid:cart_uuid>/', checkout.payment_success, name='payment-success'),
 	path('checkout/payment-cancel/', checkout.payment_cancel, name='payment-cancel'),
+	path('checkout/stripe-webhook/', checkout.stripe_webhook, name='stripe-webhook'),
 
 	# Orders
 	path('order/list/', orders.order_list, name='order-list'),
@@ -7,12 +7,23 @@ from home.models import Product, Cart, CartItem
 from home.forms import CartItemForm
 
 
+@login_required
+def cart_active(request):
+	"""Redirects to the user's active cart. Used by the navbar when the active cart's ID isn't cached yet."""
+	cart = Cart.get_active_cart_or_create_new_cart(request.user, request.session)
+	return redirect(cart.get_read_url())
+
+
 @login_required
 def cart_read(request, pk):
 	cart = get_object_or_404(Cart, pk=pk)
 
 	access = cart.not_creator_or_inactive_cart(request.user)
 	if access:
+		# The navbar linked to a cart that's no longer active, find the active cart instead
+		if Cart.get_cached_active_cart_id(request.session) == cart.pk:
+			Cart.clear_cached_active_cart_id(request.session)
+			return redirect('home:cart-active')
 		return HttpResponseForbidden()
 
 	# A set of CartItem forms
@@ -25,7 +36,7 @@ def cart_read(request, pk):
 		for form in formset:
 			if form.is_valid():
 				if form.instance.is_quantity_gt_stock():
-					form.add_error('quantity', f"Only {form.instance.product.stock} items of {form.instance.product.name} in stock!")
+					form.add_error('quantity', f"Only {form.instance.get_available_stock()} items of {form.instance.product.name} in stock!")
 
 		# If all CartItem forms are valid
 		if formset.is_valid():
@@ -46,8 +57,9 @@ def cart_read(request, pk):
 		# Compare each cart item quantity to product stock
 		for form in formset:
 			if form.instance.is_quantity_gt_stock():
-				messages.warning(request, f"Quantity adjusted for {form.instance.product.name}. Only {form.instance.product.stock} items available. Reduced items from {form.instance.quantity} to {form.instance.product.stock}.")
-				form.instance.quantity = form.instance.product.stock
+				available_stock = form.instance.get_available_stock()
+				messages.warning(request, f"Quantity adjusted for {form.instance.product.name}. Only {available_stock} items available. Reduced items from {form.instance.quantity} to {available_stock}.")
+				form.instance.quantity = available_stock
 				form.instance.save()
 			if form.instance.is_quantity_zero():
 				messages.warning(request, f"{form.instance.product.name} product removed. A cart cannot contain an item with 0 quantity.")
@@ -83,6 +95,7 @@ def cart_delete(request, pk):
 
 	if request.method == "POST":
 		cart.delete()
+		Cart.clear_cached_active_cart_id(request.session)
 		return redirect(Product.get_list_url())
 
 	context = {
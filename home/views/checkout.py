@@ -1,10 +1,17 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
-from django.http import HttpResponseForbidden
-from home.models import Product, Cart
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseBadRequest
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from home.models import Product, Cart, StripeEvent
 from home.forms import ShippingAddressForm
 from senior_project.utils import login_required, get_allowed_cities
+from senior_project.exceptions import NotEnoughStockError, ErrorCreatingStripeCheckoutSession
+from senior_project.constants import STRIPE_SESSION_EXPIRY_MARGIN_MINUTES, PAYMENT_PROCESSING_REFRESH_SECONDS, PAYMENT_PROCESSING_MAX_REFRESHES
+from datetime import timedelta
 import environ
+import json
 import stripe
 
 env = environ.Env(
@@ -17,7 +24,7 @@ stripe.api_key = env('STRIPE_SECRET_KEY')
 
 @login_required
 def shipping_info(request):
-	cart = Cart.get_active_cart_or_create_new_cart(request.user)
+	cart = Cart.get_active_cart_or_create_new_cart(request.user, request.session)
 	access = cart.not_creator_or_inactive_cart(request.user)
 	last_shipping_address = request.user.get_last_shipping_address()
 	if access:
@@ -50,7 +57,7 @@ def shipping_info(request):
 
 @login_required
 def proceed_to_stripe(request):
-	cart = Cart.get_active_cart_or_create_new_cart(request.user)
+	cart = Cart.get_active_cart_or_create_new_cart(request.user, request.session)
 
 	access = cart.not_creator_or_inactive_cart(request.user)
 	if access:
@@ -65,7 +72,18 @@ def proceed_to_stripe(request):
 		return render(request, 'home/checkout/no_shipping_info.html')
 
 	if request.method == 'POST':
-		checkout_session_url = cart.create_stripe_checkout_session()
+		# Hold the stock while the user pays, so other users can't buy the same units
+		try:
+			reservation_expires_at = cart.reserve_stock()
+		except NotEnoughStockError:
+			return render(request, 'home/carts/cart_errors.html', context={'cart': cart, 'stock_limit': True, 'inactive_product': False})
+		# The stripe session expires before the reservation, so a payment can't finish after the stock is released
+		session_expires_at = reservation_expires_at - timedelta(minutes=STRIPE_SESSION_EXPIRY_MARGIN_MINUTES)
+		try:
+			checkout_session_url = cart.create_stripe_checkout_session(session_expires_at)
+		except ErrorCreatingStripeCheckoutSession:
+			cart.release_stock()
+			raise
 		return redirect(checkout_session_url, code=303)
 	else:
 		return render(request, 'home/checkout/proceed_to_stripe.html')
@@ -73,24 +91,56 @@ def proceed_to_stripe(request):
 
 @login_required
 def payment_success(request, cart_uuid):
+	"""
+	Stripe redirects the user here after they pay. The order is made by the process_stripe_events command when stripe
+	sends the paid checkout session webhook event, this page shows that it's processing until then. The page refreshes
+	itself PAYMENT_PROCESSING_MAX_REFRESHES times, then says the payment is pending since some payment methods take days.
+	"""
 	cart = get_object_or_404(Cart, uuid=cart_uuid)
-	access = cart.not_creator_or_inactive_cart(request.user)
-	if access:
-		return HttpResponseForbidden()
-	if cart.has_order():  # they already ordered, don't let them order again
-		cart.set_cart_as_inactive(request.user)
+	if cart.creator != request.user:
 		return HttpResponseForbidden()
-	order = cart.create_order()
-	cart.handle_cart_purchase(request, order)
-	cart.set_original_price_for_all_cart_items()
-	order.send_order_confirmation_email()
-	cart.set_cart_as_inactive(request.user)
-	Cart.get_active_cart_or_create_new_cart(request.user)
+	order = cart.get_order()
+	if order is None:
+		try:
+			refreshes = int(request.GET.get('refreshes', 0))
+		except ValueError:
+			refreshes = 0
+		context = {
+			'cart': cart,
+			'refresh_seconds': PAYMENT_PROCESSING_REFRESH_SECONDS,
+			'next_refresh': refreshes + 1 if refreshes < PAYMENT_PROCESSING_MAX_REFRESHES else None,
+		}
+		return render(request, 'home/checkout/payment_processing.html', context)
+	# The paid cart is inactive, cache the user's new active cart
+	Cart.get_active_cart_or_create_new_cart(request.user, request.session)
 	if request.user.is_demo_account():
 		messages.info(request, 'You will not receive an order confirmation email because you are using a demo account.')
 	return redirect(order.get_read_url())
 
 
+@csrf_exempt
+@require_POST
+def stripe_webhook(request):
+	"""
+	Receives stripe webhook events. The event's signature is verified, then the event is saved to be processed by the
+	process_stripe_events command. Responds quickly, stripe retries the event if it doesn't get a 2xx response.
+	"""
+	# Without a secret any signature would be accepted
+	if not settings.STRIPE_WEBHOOK_SECRET:
+		return HttpResponseBadRequest()
+	try:
+		stripe.Webhook.construct_event(request.body, request.headers.get('Stripe-Signature', ''), settings.STRIPE_WEBHOOK_SECRET)
+	except (ValueError, stripe.error.SignatureVerificationError):
+		return HttpResponseBadRequest()
+
+	event = json.loads(request.body)
+	if event['type'] in StripeEvent.HANDLED_TYPES:
+		StripeEvent.store_event(event)
+	return HttpResponse(status=200)
+
+
 @login_required
 def payment_cancel(request):
+	# The user left stripe without paying, release their cart's stock for other users
+	Cart.get_active_cart_or_create_new_cart(request.user, request.session).release_stock()
 	return render(request, 'home/checkout/payment_cancel.html')
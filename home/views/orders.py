@@ -1,9 +1,8 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.core.mail import send_mail
 from django.http import HttpResponseForbidden
 from django.contrib import messages
 from senior_project.utils import login_required, get_full_url
-from home.models import Order
+from home.models import Order, QueuedEmail
 from home.forms import OrderForm
 import environ
 
@@ -35,7 +34,7 @@ def order_confirmation(request, order_uuid):
 				else:
 					messages.info(request, "An email was sent to update the customer about their order changes.")
 				# Send email regardless for tracking purposes
-				send_mail(f"Updates to your order", f"Changes have been made to your order, view them here -> {url}", env('ADMIN_EMAIL'), [order.creator.email])
+				QueuedEmail.queue_mail(f"Updates to your order", f"Changes have been made to your order, view them here -> {url}", env('ADMIN_EMAIL'), [order.creator.email])
 				return redirect(order.get_read_url())
 		else:
 			form = OrderForm(instance=order)
@@ -49,7 +49,7 @@ def product_read(request, pk):
 			form = QuantityForm(request.POST)
 			if form.is_valid():
 				quantity = form.cleaned_data['quantity']
-				cart = Cart.get_active_cart_or_create_new_cart(request.user)
+				cart = Cart.get_active_cart_or_create_new_cart(request.user, request.session)
 				product.add_product_to_cart(request.user, cart, quantity)
 				return redirect(cart.get_read_url())
 		else:
@@ -76,12 +76,11 @@ def product_update(request, pk):
 			# Update stripe stuff
 			updated_product.update_stripe_product_and_price_objs()
 
-			# Delete previous product images if they uploaded new images
-			if request.FILES.getlist('image'):
-				updated_product.delete_images()
-
-			# Save new images
-			updated_product.save_images(request.FILES.getlist('image'))
+			# Save new images, then delete the previous product images if they uploaded new images.
+			# The previous images are kept if an upload fails.
+			new_images = updated_product.save_images(request.FILES.getlist('image'))
+			if new_images:
+				updated_product.delete_images(keep=new_images)
 
 			messages.success(request, f'Successfully updated product: {updated_product.name}')
 			return redirect(Product.get_list_url())
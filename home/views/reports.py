@@ -1,16 +1,15 @@
 from django.shortcuts import render
 from django.utils import timezone
-from django.core.mail import send_mail
-from django.db.models.functions import TruncDate
-from django.db.models import Count
-from django.http import HttpResponse, JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
+from django.db.models import Prefetch
 from django.contrib.auth import get_user_model
-from senior_project.utils import superuser_or_admin_required, get_table_data
-from home.models import Product, Order
+from senior_project.utils import superuser_or_admin_required, get_table_data, Echo, get_cached_report_data
+from home.models import Product, CartItem, Order, OrderDailyStats
+from senior_project.constants import REPORT_PAGE_SIZE
+from senior_project.api_status import get_api_status
 from blog.models import Post
 import json
-import boto3
-import stripe
+import csv
 import environ
 
 env = environ.Env(
@@ -28,40 +27,44 @@ def report_list(request):
 
 @superuser_or_admin_required
 def report_orders(request):
-	data = get_table_data(request, Order)
-	return render(request, 'home/reports/orders.html', {'orders': data[0], 'order_by': data[1], 'order_model': Order})
+	orders = Order.objects.select_related('creator')
+	table = get_table_data(request, Order, REPORT_PAGE_SIZE, orders)
+	return render(request, 'home/reports/orders.html', {'orders': table['objects'], 'table': table, 'order_model': Order})
 
 
 @superuser_or_admin_required
 def report_products(request):
-	data = get_table_data(request, Product)
-	return render(request, 'home/reports/products.html', {'products': data[0], 'order_by': data[1], 'product_model': Product})
+	# The orders of each product, for the "Associated Orders" column
+	ordered_cart_items = CartItem.objects.filter(cart__order__isnull=False).select_related('cart__order').order_by('cart__order__pk')
+	products = Product.objects.prefetch_related(Prefetch('cartitem_set', queryset=ordered_cart_items, to_attr='ordered_cart_items'))
+	table = get_table_data(request, Product, REPORT_PAGE_SIZE, products)
+	return render(request, 'home/reports/products.html', {'products': table['objects'], 'table': table, 'product_model': Product})
 
 
 @superuser_or_admin_required
 def report_blogs(request):
-	data = get_table_data(request, Post)
-	return render(request, 'home/reports/blogs.html', {'posts': data[0], 'order_by': data[1], 'post_model': Post})
+	table = get_table_data(request, Post, REPORT_PAGE_SIZE)
+	return render(request, 'home/reports/blogs.html', {'posts': table['objects'], 'table': table, 'post_model': Post})
 
 
-@superuser_or_admin_required
-def report_charts(request):
-	current_year = timezone.now().year
+def get_charts_data(current_year):
+	"""
+	Gets the data for every chart on /report/charts/.
+	@param current_year: the year the monthly user and order charts are for.
+	@return: a dictionary of chart data.
+	"""
+	orders_by_date = OrderDailyStats.get_daily_order_counts()
 
-	orders_by_date = Order.objects.annotate(date_only=TruncDate('created_at')).values('date_only').annotate(
-		order_count=Count('id')).order_by('date_only')
-
-	# dates = [obj['date_only'] for obj in orders_by_date]
-	dates = [order['date_only'].strftime('%Y-%m-%d') for order in orders_by_date]
+	dates = [order['date'].strftime('%Y-%m-%d') for order in orders_by_date]
 	order_counts = [obj['order_count'] for obj in orders_by_date]
 
 	# Total users data
 	users = User.get_total_year_users(current_year)
-	years_with_users = User.get_years_with_users()
+	years_with_users = list(User.get_years_with_users())
 
 	# Total orders data
 	orders = Order.get_year_months_total_orders(current_year)
-	years_with_orders = Order.get_years_with_orders()
+	years_with_orders = list(Order.get_years_with_orders())
 
 	# Order status data
 	order_statuses = list(Order.get_order_statuses())
@@ -70,7 +73,7 @@ def report_charts(request):
 	# Top selling products data
 	product_names, product_order_counts = Product.get_top_10_selling_products()
 
-	context = {
+	return {
 		'dates': dates,
 		'order_counts': order_counts,
 		'user_months': users[0],
@@ -84,6 +87,13 @@ def report_charts(request):
 		'product_names': product_names,
 		'product_order_counts': product_order_counts,
 	}
+
+
+@superuser_or_admin_required
+def report_charts(request):
+	current_year = timezone.now().year
+	# Cached until an order, cart item or user changes, see home/signals.py
+	context = get_cached_report_data('charts', current_year, lambda: get_charts_data(current_year))
 	return render(request, 'home/reports/charts.html', context)
 
 
@@ -94,7 +104,7 @@ def update_total_orders_chart_data(request):
 		months = None
 		months_order_totals = None
 	else:
-		months, months_order_totals = Order.get_year_months_total_orders(year)
+		months, months_order_totals = get_cached_report_data('orders', year, lambda: Order.get_year_months_total_orders(year))
 	return JsonResponse({
 		'orders_labels': months,
 		'orders_values': months_order_totals,
@@ -108,7 +118,7 @@ def update_total_users_chart_data(request):
 		months = None
 		months_user_totals = None
 	else:
-		months, months_user_totals = User.get_total_year_users(year)
+		months, months_user_totals = get_cached_report_data('users', year, lambda: User.get_total_year_users(year))
 	return JsonResponse({
 		'users_labels': months,
 		'users_values': months_user_totals,
@@ -122,48 +132,16 @@ def report_export(request):
 
 @superuser_or_admin_required
 def report_export_download(request):
-	# Create the HttpResponse object with the appropriate headers for CSV.
-	response = HttpResponse(content_type='text/tsv')
+	# Stream the TSV file row by row, so the download starts right away and the file isn't buffered in memory.
+	writer = csv.writer(Echo(), delimiter='\t')
+	response = StreamingHttpResponse((writer.writerow(row) for row in Order.get_export_rows()), content_type='text/tsv')
 	response['Content-Disposition'] = 'attachment; filename="report.tsv"'
-	Order.get_export_data(response)
 	return response
 
 @superuser_or_admin_required
 def report_api_status(request):
-	context = {
-		'aws': False,
-		'stripe': False,
-		'sendgrid': False,
-	}
-
-	# Check AWS S3
-	try:
-		s3 = boto3.client('s3')
-		# Here you can do a simple operation like listing the buckets
-		s3.list_buckets()
-		context['aws'] = True
-	except Exception as e:
-		pass
-
-	# Check Stripe
-	try:
-		# Retrieve balance (a simple call to check if API is up and running)
-		stripe.Balance.retrieve()
-		context['stripe'] = True
-	except Exception as e:
-		pass
-
-	# Check SendGrid
-	try:
-		send_mail(
-			'SendGrid SMTP Test',
-			'Testing SendGrid SMTP as requested.',
-			env('ADMIN_EMAIL'),
-			[env('ADMIN_EMAIL')],
-			fail_silently=False,
-		)
-		context['sendgrid'] = True
-	except Exception as e:
-		pass
-
-	return render(request, 'home/reports/api_status.html', context)
\ No newline at end of file
+	# ?refresh=1 checks the APIs again instead of showing the cached results
+	api_status = get_api_status(use_cache=request.GET.get('refresh') != '1')
+	context = {name: status['working'] for name, status in api_status.items()}
+	context['api_status'] = api_status
+	return render(request, 'home/reports/api_status.html', context)
@@ -1,8 +1,9 @@
-from django.core.mail import send_mail
 from django.shortcuts import redirect, render, reverse
+from django.template.loader import render_to_string
+from django.http import JsonResponse
 from django.contrib import messages
-from home.forms import ContactForm
-from home.models import Product
+from home.forms import ContactForm, CatalogFilterForm
+from home.models import Product, QueuedEmail
 import environ
 
 env = environ.Env(
@@ -21,12 +22,29 @@ def contact(request):
 			email = form.cleaned_data['email']
 			subject = form.cleaned_data['subject']
 			message = form.cleaned_data['message']
-			send_mail("Contact form: " + subject, f" \nFrom: {email}\n\n" + message, env('ADMIN_EMAIL'), [env('ADMIN_EMAIL')])
+			QueuedEmail.queue_mail("Contact form: " + subject, f" \nFrom: {email}\n\n" + message, env('ADMIN_EMAIL'), [env('ADMIN_EMAIL')])
 			return redirect('home:home')
 	return render(request, 'home/contact.html')
 
 
 def home(request):
-	products = Product.get_active_products()
-	return render(request, 'home/home.html', {'products': products})
+	form = CatalogFilterForm(request.GET)
+	if form.is_valid():
+		products, next_cursor = Product.get_catalog_page(**form.cleaned_data)
+	else:
+		products, next_cursor = Product.get_catalog_page()
+	return render(request, 'home/home.html', {'products': products, 'next_cursor': next_cursor, 'form': form})
+
+
+def home_load_more(request):
+	"""Returns the next page of products for the home page's "Load more" button."""
+	form = CatalogFilterForm(request.GET)
+	if not form.is_valid():
+		return JsonResponse({'errors': form.errors}, status=400)
+	products, next_cursor = Product.get_catalog_page(**form.cleaned_data)
+	html = render_to_string('home/includes/product_cards.html', {'products': products}, request=request)
+	return JsonResponse({
+		'html': html,
+		'next_cursor': next_cursor,
+	})
 
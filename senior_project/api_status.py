@@ -0,0 +1,101 @@
+from django.conf import settings
+from django.core.cache import cache
+from concurrent.futures import ThreadPoolExecutor, wait
+from botocore.config import Config
+from senior_project.constants import API_STATUS_TIMEOUT_SECONDS, API_STATUS_CACHE_SECONDS
+import smtplib
+import time
+import boto3
+import stripe
+
+
+API_STATUS_CACHE_KEY = 'api_status'
+
+
+def check_aws(timeout):
+	"""
+	Checks AWS S3 by listing the buckets.
+	@param timeout: the connect and read timeout in seconds.
+	"""
+	config = Config(connect_timeout=timeout, read_timeout=timeout, retries={'max_attempts': 0})
+	s3 = boto3.client(
+		's3',
+		aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+		aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+		endpoint_url=settings.AWS_S3_ENDPOINT_URL,
+		config=config,
+	)
+	s3.list_buckets()
+
+
+def check_stripe(timeout):
+	"""
+	Checks Stripe by retrieving the account balance.
+	@param timeout: the request timeout in seconds.
+	"""
+	client = stripe.http_client.new_default_http_client(timeout=timeout)
+	requestor = stripe.api_requestor.APIRequestor(client=client, api_base=settings.STRIPE_API_BASE)
+	requestor.request('get', '/v1/balance')
+
+
+def check_sendgrid(timeout):
+	"""
+	Checks the SendGrid SMTP server with an EHLO and NOOP handshake, no email is sent.
+	@param timeout: the socket timeout in seconds.
+	"""
+	with smtplib.SMTP(settings.EMAIL_HOST, settings.EMAIL_PORT, timeout=timeout) as smtp:
+		smtp.ehlo()
+		code, message = smtp.noop()
+		if code != 250:
+			raise smtplib.SMTPResponseException(code, message)
+
+
+API_CHECKS = {
+	'aws': check_aws,
+	'stripe': check_stripe,
+	'sendgrid': check_sendgrid,
+}
+
+
+def timed_check(check, timeout):
+	"""
+	@return: a tuple of (the error, None if the check passed, the latency in milliseconds).
+	"""
+	start = time.perf_counter()
+	try:
+		check(timeout)
+		error = None
+	except Exception as e:
+		error = repr(e)
+	return error, round((time.perf_counter() - start) * 1000)
+
+
+def get_api_status(timeout=API_STATUS_TIMEOUT_SECONDS, use_cache=True):
+	"""
+	Checks every API in API_CHECKS at the same time.
+	A check that doesn't finish within the timeout fails, the page doesn't wait for it.
+	@param timeout: the max seconds to wait for the checks.
+	@param use_cache: if False, the cached results are ignored.
+	@return: a dictionary of {API name: {'working': bool, 'latency': milliseconds, 'error': string or None}}.
+	"""
+	if use_cache:
+		api_status = cache.get(API_STATUS_CACHE_KEY)
+		if api_status is not None:
+			return api_status
+
+	executor = ThreadPoolExecutor(max_workers=len(API_CHECKS))
+	futures = {name: executor.submit(timed_check, check, timeout) for name, check in API_CHECKS.items()}
+	wait(futures.values(), timeout=timeout)
+	# Don't wait for checks that timed out, they stop on their own socket timeouts
+	executor.shutdown(wait=False)
+
+	api_status = {}
+	for name, future in futures.items():
+		if future.done():
+			error, latency = future.result()
+		else:
+			error, latency = f"Timed out after {timeout} seconds", timeout * 1000
+		api_status[name] = {'working': error is None, 'latency': latency, 'error': error}
+
+	cache.set(API_STATUS_CACHE_KEY, api_status, API_STATUS_CACHE_SECONDS)
+	return api_status
@@ -4,6 +4,76 @@ from datetime import datetime
 
 YEAR = datetime.now().year
 
+# The number of products displayed on the home page before the user clicks "Load more"
+CATALOG_PAGE_SIZE = 30
+
+# How long a cart's stock is reserved while the user pays on stripe.
+# Stripe checkout sessions must last at least 30 minutes, the session expires STRIPE_SESSION_EXPIRY_MARGIN_MINUTES
+# before the reservation so a payment can't complete after its reservation is released.
+STOCK_RESERVATION_MINUTES = 40
+STRIPE_SESSION_EXPIRY_MARGIN_MINUTES = 5
+
+# Queued emails (see QueuedEmail), sent by the send_queued_emails command
+EMAIL_BATCH_SIZE = 50
+EMAIL_MAX_ATTEMPTS = 5
+# A failed email is retried after EMAIL_RETRY_BACKOFF_SECONDS, then doubles the wait after each failure
+EMAIL_RETRY_BACKOFF_SECONDS = 60
+# A batch is leased to 1 worker for EMAIL_LEASE_SECONDS while it's sent. If the worker dies, it's sent after the lease.
+EMAIL_LEASE_SECONDS = 5 * 60
+
+# Stripe API calls (see StripeGateway) time out after STRIPE_TIMEOUT_SECONDS. Calls that couldn't connect, were rate
+# limited or had a stripe server error are retried STRIPE_MAX_RETRIES times, waiting STRIPE_RETRY_BACKOFF_SECONDS
+# then twice as long after each retry.
+STRIPE_TIMEOUT_SECONDS = 10
+STRIPE_MAX_RETRIES = 2
+STRIPE_RETRY_BACKOFF_SECONDS = 0.5
+# The sync_stripe_catalog command calls stripe from STRIPE_SYNC_WORKERS threads, at most STRIPE_SYNC_REQUESTS_PER_SECOND
+# times a second in total. Stripe allows 25 requests a second in test mode and 100 in live mode.
+STRIPE_SYNC_WORKERS = 8
+STRIPE_SYNC_REQUESTS_PER_SECOND = 20
+
+# Stripe webhook events (see StripeEvent), processed by the process_stripe_events command
+STRIPE_EVENT_BATCH_SIZE = 50
+STRIPE_EVENT_MAX_ATTEMPTS = 5
+# A failed event is retried after STRIPE_EVENT_RETRY_BACKOFF_SECONDS, then doubles the wait after each failure
+STRIPE_EVENT_RETRY_BACKOFF_SECONDS = 60
+# A batch is leased to 1 worker for STRIPE_EVENT_LEASE_SECONDS while it's processed. If the worker dies, it's processed
+# after the lease.
+STRIPE_EVENT_LEASE_SECONDS = 5 * 60
+# The payment processing page checks for the order every PAYMENT_PROCESSING_REFRESH_SECONDS, at most
+# PAYMENT_PROCESSING_MAX_REFRESHES times. Then it says the payment is pending, some payment methods take days.
+PAYMENT_PROCESSING_REFRESH_SECONDS = 3
+PAYMENT_PROCESSING_MAX_REFRESHES = 20
+
+# The number of orders loaded at a time by the TSV export
+EXPORT_CHUNK_SIZE = 2000
+
+# The number of rows per page on the report tables (orders, products and blogs)
+REPORT_PAGE_SIZE = 50
+
+# The API status page (report_api_status) checks each API for at most API_STATUS_TIMEOUT_SECONDS, all at the same time.
+# The results are cached for API_STATUS_CACHE_SECONDS.
+API_STATUS_TIMEOUT_SECONDS = 5
+API_STATUS_CACHE_SECONDS = 60
+
+# A demo account (see DemoAccountLease) is leased to 1 visitor for DEMO_ACCOUNT_LEASE_MINUTES, or until they log out.
+# The number of available demo accounts shown on the login page is cached for DEMO_ACCOUNTS_CACHE_SECONDS.
+DEMO_ACCOUNT_LEASE_MINUTES = 60
+DEMO_ACCOUNTS_CACHE_SECONDS = 60
+
+# Images are deleted from S3 with DeleteObjects requests of S3_DELETE_BATCH_SIZE keys (S3's max is 1000),
+# S3_DELETE_WORKERS requests at a time. See delete_files().
+S3_DELETE_BATCH_SIZE = 1000
+S3_DELETE_WORKERS = 4
+
+# Uploaded product images get a copy in each format for each width (in pixels), see ProductImageVariant.
+# IMAGE_VARIANT_QUALITY is the lossy compression quality, 1 to 100.
+IMAGE_VARIANT_WIDTHS = [300, 600, 1200]
+IMAGE_VARIANT_FORMATS = ['WEBP', 'JPEG']
+IMAGE_VARIANT_QUALITY = 80
+# Product.save_images() uploads IMAGE_UPLOAD_WORKERS images at a time.
+IMAGE_UPLOAD_WORKERS = 5
+
 MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
 
 PRODUCT_FORM_ERROR1 = "Status must be set to 'inactive' if stock is 0."
@@ -10,14 +10,6 @@ class MoreThanOneActiveCartError(Exception):
 	pass
 
 
-class MoreThanOneCartItemError(Exception):
-	"""
-	A person can have only 1 cart. That cart can only have 1 cart item per product. There was probably an error with
-	deleting a cart item after the cart was deleted.
-	"""
-	pass
-
-
 class ErrorCreatingAStripeProduct(Exception):
 	"""
 	When an error occurs when creating a product on stripe.
@@ -52,3 +44,20 @@ class ErrorCreatingStripeCheckoutSession(Exception):
 class MultipleOrdersForCart(Exception):
 	"""A cart has multiple orders associated to it. It should only have 1 order at most associated with it."""
 	pass
+
+
+class NotEnoughStockError(Exception):
+	"""
+	When a cart's stock can't be reserved because a product doesn't have enough stock that isn't reserved by other carts.
+	"""
+	pass
+
+
+class ErrorDeletingFiles(Exception):
+	"""
+	When S3 couldn't delete some of the files in a delete_files() call.
+	The S3 errors, ex: [{'Key': ..., 'Code': ..., 'Message': ...}], are in the errors attribute.
+	"""
+	def __init__(self, errors):
+		self.errors = errors
+		super().__init__(f"{len(errors)} files couldn't be deleted.")
@@ -0,0 +1,62 @@
+from django.conf import settings
+import hashlib
+import hmac
+import json
+import time
+import uuid
+
+
+def make_checkout_session_completed_event(cart_uuid, amount_total=0, payment_status='paid', event_id=None, event_type='checkout.session.completed'):
+	"""
+	Makes a checkout.session.completed event like the one stripe sends when a cart is paid for.
+	Used by the tests and the send_fake_stripe_events command, so webhooks can be tested without stripe.
+	@param cart_uuid: the paid cart's UUID, stripe sends it back as the session's client_reference_id.
+	@param amount_total: the amount paid in cents.
+	@param payment_status: the session's payment status, 'paid', 'unpaid' or 'no_payment_required'.
+	@param event_id: the event ID. A new ID is made by default, pass the same ID to simulate stripe resending an event.
+	@param event_type: the event type. Ex: 'checkout.session.async_payment_succeeded', sent when an unpaid session
+		is paid later.
+	@return: the event as a dictionary.
+	"""
+	return {
+		'id': event_id or f'evt_fake_{uuid.uuid4().hex}',
+		'object': 'event',
+		'type': event_type,
+		'created': int(time.time()),
+		'livemode': False,
+		'data': {
+			'object': {
+				'id': f'cs_test_fake_{uuid.uuid4().hex}',
+				'object': 'checkout.session',
+				'mode': 'payment',
+				'client_reference_id': str(cart_uuid),
+				'payment_status': payment_status,
+				'amount_total': amount_total,
+				'currency': 'usd',
+			},
+		},
+	}
+
+
+def get_signature_header(payload, secret=None, timestamp=None):
+	"""
+	Signs a webhook payload the same way stripe does.
+	@param payload: the request body, a string.
+	@param secret: the webhook secret. STRIPE_WEBHOOK_SECRET by default.
+	@param timestamp: when the event was signed, in seconds since the epoch. Now by default.
+	@return: the Stripe-Signature header's value.
+	"""
+	secret = settings.STRIPE_WEBHOOK_SECRET if secret is None else secret
+	timestamp = int(time.time()) if timestamp is None else timestamp
+	signature = hmac.new(secret.encode(), f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+	return f't={timestamp},v1={signature}'
+
+
+def get_signed_event(event, secret=None):
+	"""
+	@param event: the event as a dictionary.
+	@param secret: the webhook secret. STRIPE_WEBHOOK_SECRET by default.
+	@return: a tuple of (request body, Stripe-Signature header) to post to the stripe_webhook view.
+	"""
+	payload = json.dumps(event)
+	return payload, get_signature_header(payload, secret)
@@ -0,0 +1,94 @@
+from PIL import Image, ImageOps
+from senior_project.constants import IMAGE_VARIANT_WIDTHS, IMAGE_VARIANT_FORMATS, IMAGE_VARIANT_QUALITY
+import io
+import os
+
+
+# Image format: file extension
+IMAGE_VARIANT_EXTENSIONS = {
+	'WEBP': 'webp',
+	'JPEG': 'jpg',
+}
+
+
+def make_image_variants(file, widths=IMAGE_VARIANT_WIDTHS, formats=IMAGE_VARIANT_FORMATS, quality=IMAGE_VARIANT_QUALITY):
+	"""
+	Makes smaller, compressed copies of an image for srcset attributes.
+	The copies are rotated like the EXIF orientation says and have no metadata (EXIF, GPS, ICC profiles).
+	Widths larger than the image are skipped, the image's own width is used if every width is larger.
+	@param file: the image file, ex: an uploaded file or a FieldFile. Read from the start and rewound afterwards.
+	@param widths: the widths in pixels. The height keeps the aspect ratio.
+	@param formats: Pillow format names. Ex: ['WEBP', 'JPEG']
+	@param quality: the lossy compression quality, 1 to 100.
+	@return: a list of dictionaries of {'width', 'height', 'format', 'content'}, content is the encoded bytes.
+	"""
+	file.seek(0)
+	with Image.open(file) as original:
+		image = ImageOps.exif_transpose(original)
+		# JPEG has no transparency, transparent pixels are made white instead of black.
+		# Copying the pixels into a new image also drops the metadata.
+		if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+			image = image.convert('RGBA')
+			background = Image.new('RGB', image.size, (255, 255, 255))
+			background.paste(image, mask=image.getchannel('A'))
+			image = background
+		else:
+			image = image.convert('RGB')
+	file.seek(0)
+
+	variant_widths = sorted({width for width in widths if width <= image.width}) or [image.width]
+
+	variants = []
+	for width in variant_widths:
+		height = max(1, round(image.height * width / image.width))
+		resized = image if width == image.width else image.resize((width, height), Image.LANCZOS)
+		for format in formats:
+			content = io.BytesIO()
+			resized.save(content, format=format, quality=quality, optimize=True)
+			variants.append({'width': width, 'height': height, 'format': format, 'content': content.getvalue()})
+	return variants
+
+
+def clean_image(file, max_width=max(IMAGE_VARIANT_WIDTHS), quality=IMAGE_VARIANT_QUALITY):
+	"""
+	Makes the copy of an uploaded image that is stored instead of the upload, since the original is public too.
+	The copy is rotated like the EXIF orientation says, has no metadata (EXIF, GPS, ICC profiles) and is at most
+	max_width wide. It keeps the image's format, so its file extension is still right.
+	@param file: the image file, ex: an uploaded file. Read from the start and rewound afterwards.
+	@param max_width: the max width in pixels, the largest variant's width by default. The height keeps the aspect ratio.
+	@param quality: the lossy compression quality, 1 to 100.
+	@return: the encoded bytes.
+	"""
+	file.seek(0)
+	with Image.open(file) as original:
+		# MPO is the JPEG format of some phone cameras, with a 2nd image Pillow doesn't need to keep
+		format = 'JPEG' if original.format == 'MPO' else original.format
+		image = ImageOps.exif_transpose(original)
+		image.load()
+	file.seek(0)
+
+	if image.width > max_width:
+		image = image.resize((max_width, max(1, round(image.height * max_width / image.width))), Image.LANCZOS)
+	# Some formats save the metadata left in info, such as PNG's ICC profile
+	image.info = {}
+	content = io.BytesIO()
+	image.save(content, format=format, quality=quality, optimize=True)
+	return content.getvalue()
+
+
+def get_image_variant_root(name):
+	"""
+	The original's extension is kept, so shirt.jpg and shirt.png don't have the same variant names.
+	@param name: the original image's file name. Ex: 'product_images/shirt.jpg'
+	@return: the start of the variants' file names. Ex: 'shirt_jpg'
+	"""
+	return os.path.basename(name).replace('.', '_')
+
+
+def get_image_variant_name(root, variant):
+	"""
+	@param root: the output of get_image_variant_root(). Ex: 'shirt_jpg'
+	@param variant: a dictionary from make_image_variants().
+	@return: the variant's file name. Ex: 'shirt_jpg_300.webp'
+	"""
+	return f"{root}_{variant['width']}.{IMAGE_VARIANT_EXTENSIONS[variant['format']]}"
@@ -1,5 +1,6 @@
 from pathlib import Path
 import django_heroku
+from boto3.s3.transfer import TransferConfig
 import environ
 import os
 
@@ -88,6 +89,19 @@ DATABASES = {
     }
 }
 
+# Local memory by default. Set CACHE_URL to share the cache between processes, ex: filecache:///tmp/senior_project_cache
+CACHES = {
+    'default': env.cache_url('CACHE_URL', default='locmemcache://'),
+}
+# How long the reports dashboard data is cached for. The cache is also cleared when orders or users change, but with
+# local memory caches that only clears the cache of the process that made the change.
+REPORTS_CACHE_SECONDS = 60 * 5
+
+# The check_demo_accounts command emails the admin when DEMO_ACCOUNTS_ALERT_THRESHOLD or fewer admin or customer demo
+# accounts are available, at most once every DEMO_ACCOUNTS_ALERT_SECONDS.
+DEMO_ACCOUNTS_ALERT_THRESHOLD = 2
+DEMO_ACCOUNTS_ALERT_SECONDS = env.int('DEMO_ACCOUNTS_ALERT_SECONDS', default=60 * 60)
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         "NAME": "django.contrib.auth.password_validation.UserAttributeSimilarityValidator",
@@ -162,6 +176,18 @@ AWS_SECRET_ACCESS_KEY = env('AWS_SECRET_ACCESS_KEY')
 AWS_STORAGE_BUCKET_NAME = env('AWS_STORAGE_BUCKET_NAME')
 AWS_S3_FILE_OVERWRITE = False
 AWS_DEFAULT_ACL = None
+# Files larger than multipart_threshold are uploaded in multipart_chunksize parts, max_concurrency parts at a time.
+# Product.save_images() already uploads several images at a time, so each upload uses fewer threads than the default 10.
+AWS_S3_TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024, max_concurrency=4)
+# Overrides the S3 and Stripe API URLs, such as with local stub servers. The real APIs are used by default.
+AWS_S3_ENDPOINT_URL = env('AWS_S3_ENDPOINT_URL', default=None)
+STRIPE_API_BASE = env('STRIPE_API_BASE', default=None)
+# Verifies that webhook events were sent by stripe, from the stripe dashboard's webhook endpoint (or stripe listen).
+# Required, orders are only made from webhook events.
+STRIPE_WEBHOOK_SECRET = env('STRIPE_WEBHOOK_SECRET')
+# The class that calls the Stripe API, see get_stripe_gateway(). Set to senior_project.stripe_gateway.FakeStripeGateway
+# to keep stripe objects in memory instead, such as for benchmarks.
+STRIPE_GATEWAY = env('STRIPE_GATEWAY', default='senior_project.stripe_gateway.StripeGateway')
 DEFAULT_FILE_STORAGE = 'storages.backends.s3.S3Storage'
 
 # django-crispy-forms settings
@@ -0,0 +1,54 @@
+from django.core.files.storage import default_storage
+from concurrent.futures import ThreadPoolExecutor
+from storages.backends.s3 import S3Storage
+from storages.utils import clean_name
+from senior_project.constants import S3_DELETE_BATCH_SIZE, S3_DELETE_WORKERS
+from senior_project.exceptions import ErrorDeletingFiles
+
+
+def get_s3_client(storage):
+	"""
+	@param storage: an S3Storage.
+	@return: the boto3 S3 client the storage uses. Thread safe, unlike the storage's boto3 resource.
+	"""
+	return storage.connection.meta.client
+
+
+def delete_files(names, storage=None, client=None, batch_size=S3_DELETE_BATCH_SIZE, workers=S3_DELETE_WORKERS):
+	"""
+	Deletes files from the storage.
+	On S3, the files are deleted with DeleteObjects requests of at most batch_size keys (S3's max is 1000),
+	sent from `workers` threads at the same time. Other storages delete the files 1 at a time.
+	@param names: the file names, as saved in a FileField. Ex: 'product_images/image.jpg'
+	@param storage: the storage the files are in, default_storage by default.
+	@param client: the boto3 S3 client, ex: one wrapped in a botocore Stubber for tests. get_s3_client() by default.
+	@param batch_size: the max number of keys per DeleteObjects request.
+	@param workers: the number of requests sent at the same time.
+	@return: the number of DeleteObjects requests sent. ErrorDeletingFiles() exception if some files weren't deleted.
+	"""
+	storage = storage or default_storage
+	names = [name for name in names if name]
+	if not isinstance(storage, S3Storage):
+		for name in names:
+			storage.delete(name)
+		return 0
+
+	client = client or get_s3_client(storage)
+	keys = [storage._normalize_name(clean_name(name)) for name in names]
+	batches = [keys[i:i + batch_size] for i in range(0, len(keys), batch_size)]
+
+	def delete_batch(batch):
+		response = client.delete_objects(
+			Bucket=storage.bucket_name,
+			Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True},
+		)
+		# Quiet mode only lists the keys that weren't deleted. A missing key isn't an error, like storage.delete()
+		return response.get('Errors', [])
+
+	errors = []
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		for batch_errors in executor.map(delete_batch, batches):
+			errors += batch_errors
+	if errors:
+		raise ErrorDeletingFiles(errors)
+	return len(batches)
@@ -0,0 +1,103 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from home.models import Product
+from senior_project.stripe_gateway import RequestThrottle, get_stripe_gateway
+from senior_project.utils import get_full_url
+from senior_project.constants import STRIPE_SYNC_WORKERS, STRIPE_SYNC_REQUESTS_PER_SECOND
+import stripe
+
+
+def get_catalog_changes(gateway):
+	"""
+	Compares the products with the products and active prices on stripe.
+	@param gateway: the StripeGateway.
+	@return: a dictionary of
+		- 'create': products that aren't on stripe.
+		- 'reactivate': products whose stripe product is inactive. They're reactivated instead of created again, a
+			create would send the same idempotency key and get the inactive product back.
+		- 'update_price': products whose price isn't their stripe price.
+		- 'deactivate': IDs of active stripe products that no product uses. Only stripe products whose URL is on this
+			site are included, so other sites using the same stripe account are left alone.
+	"""
+	remote_products = {product.id: product for product in gateway.list_products()}
+	remote_prices = {price.id: price for price in gateway.list_prices(active='true')}
+	site_url = get_full_url('/')
+
+	changes = {'create': [], 'reactivate': [], 'update_price': [], 'deactivate': []}
+	local_product_ids = set()
+	for product in Product.objects.order_by('pk'):
+		remote_product = remote_products.get(product.stripe_product_id)
+		if remote_product is None:
+			changes['create'].append(product)
+			continue
+		local_product_ids.add(product.stripe_product_id)
+		if not remote_product.active:
+			changes['reactivate'].append(product)
+		price = remote_prices.get(product.stripe_price_id)
+		if price is None or price.unit_amount != product.get_stripe_unit_amount():
+			changes['update_price'].append(product)
+
+	for stripe_product_id, remote_product in remote_products.items():
+		if (
+			remote_product.active
+			and stripe_product_id not in local_product_ids
+			and (remote_product.get('url') or '').startswith(site_url)
+		):
+			changes['deactivate'].append(stripe_product_id)
+	return changes
+
+
+def sync_stripe_catalog(workers=STRIPE_SYNC_WORKERS, requests_per_second=STRIPE_SYNC_REQUESTS_PER_SECOND, dry_run=False):
+	"""
+	Pushes the changes from get_catalog_changes() to stripe from a pool of threads, then saves the new stripe IDs with
+	1 bulk update. A failed change doesn't stop the others, running the sync again retries it.
+	@param workers: the number of threads calling stripe.
+	@param requests_per_second: the max number of stripe requests a second, for all threads.
+	@param dry_run: only find the changes.
+	@return: a tuple of (the changes, a list of (change, error) for the changes that failed).
+	"""
+	# A copy of the gateway is throttled, so other threads using get_stripe_gateway() aren't
+	gateway = get_stripe_gateway().with_throttle(RequestThrottle(requests_per_second))
+	changes = get_catalog_changes(gateway)
+	if dry_run:
+		return changes, []
+
+	# The threads only call stripe, the URLs are found here so the threads don't query the DB
+	site_url = get_full_url('')
+	urls = {product.pk: f'{site_url}{product.get_read_url()}' for product in changes['create']}
+
+	def create(product):
+		product.stripe_product_id, product.stripe_price_id = product.push_stripe_product_and_price(gateway, urls[product.pk])
+		product.stripe_unit_amount = product.get_stripe_unit_amount()
+		return product
+
+	def update_price(product):
+		product.stripe_price_id = product.push_stripe_price(gateway)
+		product.stripe_unit_amount = product.get_stripe_unit_amount()
+		return product
+
+	def reactivate(product):
+		gateway.modify_product(product.stripe_product_id, active=True)
+
+	def deactivate(stripe_product_id):
+		gateway.modify_product(stripe_product_id, active=False)
+
+	tasks = [(create, product) for product in changes['create']]
+	tasks += [(reactivate, product) for product in changes['reactivate']]
+	tasks += [(update_price, product) for product in changes['update_price']]
+	tasks += [(deactivate, stripe_product_id) for stripe_product_id in changes['deactivate']]
+
+	updated_products = []
+	errors = []
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		futures = {executor.submit(task, item): (task.__name__, item) for task, item in tasks}
+		for future in as_completed(futures):
+			try:
+				result = future.result()
+			except stripe.error.StripeError as e:
+				errors.append((futures[future], e))
+			else:
+				if isinstance(result, Product):
+					updated_products.append(result)
+
+	Product.objects.bulk_update(updated_products, ['stripe_product_id', 'stripe_price_id', 'stripe_unit_amount'], batch_size=500)
+	return changes, errors
@@ -0,0 +1,280 @@
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from senior_project.env_settings import env
+from senior_project.constants import STRIPE_TIMEOUT_SECONDS, STRIPE_MAX_RETRIES, STRIPE_RETRY_BACKOFF_SECONDS
+from urllib.parse import quote_plus
+import copy
+import itertools
+import threading
+import time
+import stripe
+
+
+# Errors that are worth retrying. Other errors, like an invalid request, fail the same way every time.
+RETRY_ERRORS = (stripe.error.APIConnectionError, stripe.error.RateLimitError, stripe.error.APIError)
+
+
+class RequestThrottle:
+	"""
+	Spaces out requests shared by several threads, so at most `rate` requests are sent per second.
+	The rate is halved (down to min_rate) each time stripe says it's being rate limited.
+	"""
+	def __init__(self, rate, min_rate=1):
+		self.rate = rate
+		self.min_rate = min_rate
+		self.next_request_at = time.monotonic()
+		self.lock = threading.Lock()
+
+	def wait(self):
+		"""Waits until it's this request's turn."""
+		with self.lock:
+			now = time.monotonic()
+			delay = self.next_request_at - now
+			self.next_request_at = max(self.next_request_at, now) + 1 / self.rate
+		if delay > 0:
+			time.sleep(delay)
+
+	def slow_down(self):
+		with self.lock:
+			self.rate = max(self.rate / 2, self.min_rate)
+
+
+class StripeGateway:
+	"""
+	Calls the Stripe API. Use get_stripe_gateway() instead of the stripe SDK's resources, it:
+	- Reuses HTTPS connections, the HTTP client keeps a requests session per thread.
+	- Times out every call, and retries calls that couldn't connect, were rate limited or had a stripe server error.
+	- Sends an idempotency key with create calls, so a retried create doesn't create 2 objects. The keys are made from
+		our object IDs by the caller. Modify calls aren't sent a key, they set the same values when they're retried.
+	- Records the latency of each operation, see get_metrics().
+	- Spaces out requests when given a RequestThrottle, see with_throttle().
+	Raises a stripe.error.StripeError if a call fails.
+	"""
+	def __init__(self, api_key=None, api_base=None, timeout=STRIPE_TIMEOUT_SECONDS, max_retries=STRIPE_MAX_RETRIES, retry_backoff=STRIPE_RETRY_BACKOFF_SECONDS):
+		self.api_key = api_key or env('STRIPE_SECRET_KEY')
+		self.api_base = api_base or settings.STRIPE_API_BASE
+		self.max_retries = max_retries
+		self.retry_backoff = retry_backoff
+		self.client = stripe.http_client.RequestsClient(timeout=timeout)
+		self.throttle = None
+		self.metrics = {}
+		self.metrics_lock = threading.Lock()
+
+	def send(self, method, url, params, idempotency_key):
+		"""
+		Sends 1 request to stripe.
+		@return: the response as a StripeObject.
+		"""
+		requestor = stripe.api_requestor.APIRequestor(key=self.api_key, client=self.client, api_base=self.api_base)
+		headers = {'Idempotency-Key': idempotency_key} if idempotency_key else None
+		response, api_key = requestor.request(method, url, params, headers)
+		return stripe.util.convert_to_stripe_object(response, api_key)
+
+	def request(self, operation, method, url, params=None, idempotency_key=None):
+		"""
+		Sends a request to stripe, retrying it at most max_retries times.
+		@param operation: the name the latency is recorded under. Ex: 'product.create'
+		@param method: 'get' or 'post'.
+		@param url: the API path. Ex: '/v1/products'
+		@param params: the request parameters.
+		@param idempotency_key: stripe only does the work for the first request with the key, later requests with the key
+			get the first response.
+		@return: the response as a StripeObject.
+		"""
+		start = time.perf_counter()
+		retries = 0
+		failed = False
+		try:
+			while True:
+				try:
+					if self.throttle:
+						self.throttle.wait()
+					return self.send(method, url, params or {}, idempotency_key)
+				except RETRY_ERRORS as e:
+					if self.throttle and isinstance(e, stripe.error.RateLimitError):
+						self.throttle.slow_down()
+					if retries >= self.max_retries:
+						raise
+					time.sleep(self.retry_backoff * 2 ** retries)
+					retries += 1
+		except Exception:
+			failed = True
+			raise
+		finally:
+			self.record(operation, time.perf_counter() - start, retries, failed)
+
+	def record(self, operation, seconds, retries, failed):
+		with self.metrics_lock:
+			metrics = self.metrics.setdefault(operation, {'calls': 0, 'errors': 0, 'retries': 0, 'total_seconds': 0, 'max_seconds': 0})
+			metrics['calls'] += 1
+			metrics['errors'] += int(failed)
+			metrics['retries'] += retries
+			metrics['total_seconds'] += seconds
+			metrics['max_seconds'] = max(metrics['max_seconds'], seconds)
+
+	def get_metrics(self):
+		"""
+		@return: a dictionary of {operation: {'calls', 'errors', 'retries', 'avg_seconds', 'max_seconds'}} for the calls
+			made by this process. The seconds include the retries.
+		"""
+		with self.metrics_lock:
+			return {
+				operation: {
+					'calls': metrics['calls'],
+					'errors': metrics['errors'],
+					'retries': metrics['retries'],
+					'avg_seconds': metrics['total_seconds'] / metrics['calls'],
+					'max_seconds': metrics['max_seconds'],
+				}
+				for operation, metrics in self.metrics.items()
+			}
+
+	def with_throttle(self, throttle):
+		"""
+		@param throttle: a RequestThrottle, shared by the threads that use the new gateway.
+		@return: a copy of the gateway that waits on the throttle before each request. It shares the HTTP client and
+			metrics with this gateway, so other code using this gateway isn't throttled.
+		"""
+		gateway = copy.copy(self)
+		gateway.throttle = throttle
+		return gateway
+
+	def list_all(self, operation, url, params=None):
+		"""
+		Yields every object in a stripe list, requesting 100 objects at a time.
+		@param params: the list's filters. Ex: {'active': 'true'}
+		"""
+		params = dict(params or {}, limit=100)
+		while True:
+			page = self.request(operation, 'get', url, params)
+			yield from page.data
+			if not page.has_more or not page.data:
+				return
+			params['starting_after'] = page.data[-1].id
+
+	def list_products(self, **params):
+		return self.list_all('product.list', '/v1/products', params)
+
+	def list_prices(self, **params):
+		return self.list_all('price.list', '/v1/prices', params)
+
+	def create_product(self, name, url, idempotency_key):
+		return self.request('product.create', 'post', '/v1/products', {'name': name, 'url': url}, idempotency_key)
+
+	def modify_product(self, product_id, **params):
+		return self.request('product.modify', 'post', f'/v1/products/{quote_plus(product_id)}', params)
+
+	def create_price(self, product_id, unit_amount, idempotency_key, currency='usd'):
+		params = {'product': product_id, 'unit_amount': unit_amount, 'currency': currency}
+		return self.request('price.create', 'post', '/v1/prices', params, idempotency_key)
+
+	def retrieve_price(self, price_id):
+		return self.request('price.retrieve', 'get', f'/v1/prices/{quote_plus(price_id)}')
+
+	def modify_price(self, price_id, **params):
+		return self.request('price.modify', 'post', f'/v1/prices/{quote_plus(price_id)}', params)
+
+	def create_checkout_session(self, idempotency_key, **params):
+		return self.request('checkout_session.create', 'post', '/v1/checkout/sessions', params, idempotency_key)
+
+
+class FakeStripeGateway(StripeGateway):
+	"""
+	An in-process stand in for stripe, for tests and benchmarks. Products, prices and checkout sessions are kept in
+	memory and idempotency keys work like they do on stripe. Retries and metrics work the same as StripeGateway.
+	errors: exceptions to raise instead of sending the next requests, ex: to test retries. None sends the request.
+	calls: the requests sent, as (method, url, params, idempotency_key) tuples.
+	latency: seconds each request takes, to make benchmarks behave more like stripe. Requests wait at the same time.
+	"""
+	# API path: (ID prefix, object name)
+	COLLECTIONS = {
+		'/v1/products': ('prod_fake', 'product'),
+		'/v1/prices': ('price_fake', 'price'),
+		'/v1/checkout/sessions': ('cs_test_fake', 'checkout.session'),
+	}
+
+	def __init__(self, api_key='sk_test_fake', retry_backoff=0, **kwargs):
+		super().__init__(api_key=api_key, retry_backoff=retry_backoff, **kwargs)
+		self.objects = {}
+		self.idempotent_responses = {}
+		self.errors = []
+		self.calls = []
+		self.ids = itertools.count(1)
+		self.latency = 0
+		self.lock = threading.Lock()
+
+	def send(self, method, url, params, idempotency_key):
+		if self.latency:
+			time.sleep(self.latency)
+		with self.lock:
+			self.calls.append((method, url, params, idempotency_key))
+			error = self.errors.pop(0) if self.errors else None
+			if error:
+				raise error
+			if idempotency_key in self.idempotent_responses:
+				key_params, response = self.idempotent_responses[idempotency_key]
+				if key_params != params:
+					raise stripe.error.IdempotencyError("Keys for idempotent requests can only be used with the same parameters they were first used with.")
+			else:
+				response = self.handle(method, url, params)
+				if idempotency_key:
+					self.idempotent_responses[idempotency_key] = (copy.deepcopy(params), copy.deepcopy(response))
+			return stripe.util.convert_to_stripe_object(copy.deepcopy(response), self.api_key)
+
+	def handle(self, method, url, params):
+		"""
+		Lists, creates, retrieves or modifies objects.
+		@return: the object or list as a dictionary.
+		"""
+		if url in self.COLLECTIONS and method == 'get':
+			object_name = self.COLLECTIONS[url][1]
+			objects = [obj for obj in self.objects.values() if obj['object'] == object_name]
+			if 'active' in params:
+				objects = [obj for obj in objects if str(obj['active']).lower() == str(params['active']).lower()]
+			if 'starting_after' in params:
+				ids = [obj['id'] for obj in objects]
+				objects = objects[ids.index(params['starting_after']) + 1:]
+			limit = int(params.get('limit', 10))
+			return {'object': 'list', 'url': url, 'data': objects[:limit], 'has_more': len(objects) > limit}
+
+		if url in self.COLLECTIONS and method == 'post':
+			prefix, object_name = self.COLLECTIONS[url]
+			obj = {'id': f'{prefix}_{next(self.ids)}', 'object': object_name, 'livemode': False, **params}
+			if object_name in ('product', 'price'):
+				obj['active'] = True
+			if object_name == 'checkout.session':
+				obj['url'] = f"https://checkout.stripe.com/c/pay/{obj['id']}"
+				obj['status'] = 'open'
+			self.objects[obj['id']] = obj
+			return obj
+
+		collection, _, object_id = url.rpartition('/')
+		if collection not in self.COLLECTIONS or object_id not in self.objects:
+			raise stripe.error.InvalidRequestError(f"No such object: '{object_id}'", 'id', http_status=404)
+		obj = self.objects[object_id]
+		if method == 'post':
+			obj.update(params)
+		return obj
+
+
+_gateway = None
+
+
+def get_stripe_gateway():
+	"""
+	@return: the STRIPE_GATEWAY class's instance, shared by the process so its HTTP connections are reused.
+	"""
+	global _gateway
+	if _gateway is None:
+		_gateway = import_string(settings.STRIPE_GATEWAY)()
+	return _gateway
+
+
+@receiver(setting_changed)
+def reset_stripe_gateway(setting, **kwargs):
+	"""Makes a new gateway when a test changes its settings."""
+	global _gateway
+	if setting in ('STRIPE_GATEWAY', 'STRIPE_API_BASE'):
+		_gateway = None
@@ -1,13 +1,19 @@
 from django.conf import settings
-from django.core.mail import send_mail
+from django.core.cache import cache
 from django.http import HttpResponseForbidden
 from django.utils import timezone
-from django.contrib.auth.models import Group
+from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
 from django.contrib.sites.models import Site
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import transaction
+from django.db.models import Count, Q
+from django.db.models.functions import ExtractMonth
 from functools import wraps
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
 from senior_project.env_settings import env
 import random
+import time
 
 
 def format_datetime(datetime_obj):
@@ -116,29 +122,191 @@ def get_domain():
 	return Site.objects.get(pk=settings.SITE_ID)
 
 
-def get_table_data(request, cls):
+def encode_cursor(value, pk):
 	"""
-	Gets a model's data that is to be displayed on /report/model_name/
+	Encodes the position of an object in a list ordered by (value, pk). Used for keyset pagination.
+	@param value: the object's value of the field the list is ordered by. Ex: created_at.
+	@param pk: the object's primary key.
+	@return: an URL safe string.
+	"""
+	value = value.isoformat() if hasattr(value, 'isoformat') else str(value)
+	return urlsafe_base64_encode(f"{value}|{pk}".encode())
+
+
+def decode_cursor(cursor, field=None):
+	"""
+	Decodes a cursor made by encode_cursor().
+	@param cursor: the cursor string.
+	@param field: the model field the list is ordered by, used to convert the value. A datetime by default.
+	@return: a tuple of (value, pk). Raises ValueError if the cursor is invalid.
+	"""
+	try:
+		value, pk = urlsafe_base64_decode(cursor).decode().rsplit('|', 1)
+		value = datetime.fromisoformat(value) if field is None else field.to_python(value)
+		return value, int(pk)
+	except (TypeError, UnicodeDecodeError, ValidationError) as e:
+		raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+class Echo:
+	"""
+	A file-like object that returns what's written to it instead of storing it.
+	Lets csv.writer() produce lines for a StreamingHttpResponse without buffering the whole file.
+	"""
+	def write(self, value):
+		return value
+
+
+def get_table_data(request, cls, page_size, queryset=None):
+	"""
+	Gets a page of a model's data that is to be displayed on /report/model_name/
+	The list can be filtered by status and sorted by one of cls.REPORT_SORT_FIELDS, the rest are ignored.
+	Sorting by a field that can't be empty uses keyset pagination (?cursor=), so every page is an index scan.
+	auto_now_add fields, like created_at, are always set so they're treated as not empty.
+	Sorting by a field that can be empty uses page numbers (?page=).
 	@param request: the incoming request.
 	@param cls: the Model class. Like Product, Order, Blog, etc.
-	@return: a tuple of (a QuerySet of Blog data, string order_by)
+	@param page_size: the number of objects per page.
+	@param queryset: the objects to list, such as with select_related() for the displayed relations. cls.objects by default.
+	@return: a dictionary of:
+		objects: a list of the objects on the page.
+		order_by: 'asc' or 'desc'.
+		sort_by: the field the objects are sorted by.
+		status: the status filter, None if not filtered.
+		next_page: the query string of the next page, None if it's the last page.
 	"""
 	sort_by = request.GET.get('sort_by')
-	order_by = request.GET.get('order_by', 'desc')
+	if sort_by not in cls.REPORT_SORT_FIELDS:
+		sort_by = 'pk'
+	order_by = 'asc' if request.GET.get('order_by') == 'asc' else 'desc'
 	status_filter = request.GET.get('status')
+	if status_filter == 'All':
+		status_filter = None
 
-	posts = cls.objects.all()
+	objects = cls.objects.all() if queryset is None else queryset
+	if status_filter is not None:
+		objects = objects.filter(status=status_filter)
 
-	if order_by == 'asc':
-		ordering = ''
+	ordering = '' if order_by == 'asc' else '-'
+	# Order by pk as well, so objects with the same value are always in the same order
+	objects = objects.order_by(f'{ordering}{sort_by}', f'{ordering}pk')
+
+	field = cls._meta.pk if sort_by == 'pk' else cls._meta.get_field(sort_by)
+	next_page = request.GET.copy()
+	next_page.pop('cursor', None)
+	next_page.pop('page', None)
+	# auto_now_add fields are null=True in this repo but always set, the filter is so the cursor never compares with NULL
+	use_cursor = not field.null or getattr(field, 'auto_now_add', False)
+	if use_cursor and field.null:
+		objects = objects.filter(**{f'{sort_by}__isnull': False})
+	if not use_cursor:
+		page = Paginator(objects, page_size).get_page(request.GET.get('page'))
+		rows = list(page)
+		if page.has_next():
+			next_page['page'] = page.next_page_number()
+		else:
+			next_page = None
 	else:
-		ordering = '-'
+		cursor = request.GET.get('cursor')
+		if cursor:
+			try:
+				value, pk = decode_cursor(cursor, field)
+			except ValueError:
+				pass  # An invalid cursor shows the first page
+			else:
+				lookup = 'gt' if order_by == 'asc' else 'lt'
+				objects = objects.filter(Q(**{f'{sort_by}__{lookup}': value}) | Q(**{sort_by: value, f'pk__{lookup}': pk}))
+		# Get 1 extra object to know if there's a next page
+		rows = list(objects[:page_size + 1])
+		if len(rows) > page_size:
+			rows = rows[:page_size]
+			next_page['cursor'] = encode_cursor(getattr(rows[-1], field.attname), rows[-1].pk)
+		else:
+			next_page = None
 
-	if status_filter is not None and status_filter != 'All':
-		posts = cls.objects.filter(status=status_filter)
-	elif sort_by:
-		posts = cls.objects.order_by(f'{ordering}{sort_by}')
-	return posts, order_by
+	return {
+		'objects': rows,
+		'order_by': order_by,
+		'sort_by': sort_by,
+		'status': status_filter,
+		'next_page': next_page.urlencode() if next_page is not None else None,
+	}
+
+
+def get_year_monthly_counts(queryset, date_field, year, total=None):
+	"""
+	Counts the objects in each month of a year, in 1 query.
+	@param queryset: the objects to count. Ex: Order.objects.all()
+	@param date_field: the name of the date or datetime field to group by. Ex: 'created_at'
+	@param year: the year.
+	@param total: the aggregate for each month, Count('pk') by default. Ex: Sum('order_count') for rollup tables.
+	@return: a list of 12 counts, 1 per month. Months without objects are 0.
+	"""
+	rows = queryset.filter(**{f'{date_field}__year': year}).annotate(month=ExtractMonth(date_field)).values('month').annotate(total=total or Count('pk')).order_by('month')
+	month_counts = [0] * 12
+	for row in rows:
+		month_counts[row['month'] - 1] = row['total'] or 0
+	return month_counts
+
+
+def get_local_date(value):
+	"""
+	@param value: a date, or a datetime. Naive datetimes are treated as being in the current timezone.
+	@return: the date in the current timezone.
+	"""
+	if not isinstance(value, datetime):
+		return value
+	if timezone.is_naive(value):
+		value = timezone.make_aware(value)
+	return timezone.localdate(value)
+
+
+REPORTS_CACHE_VERSION_KEY = 'reports:version'
+
+
+def get_reports_cache_version():
+	"""
+	@return: the current version of the reports dashboard cache keys.
+	"""
+	version = cache.get(REPORTS_CACHE_VERSION_KEY)
+	if version is None:
+		# Start from the current time, so keys cached before the version was evicted aren't reused
+		cache.add(REPORTS_CACHE_VERSION_KEY, time.time_ns(), timeout=None)
+		version = cache.get(REPORTS_CACHE_VERSION_KEY)
+	return version
+
+
+def invalidate_reports_cache():
+	"""
+	Bumps the reports dashboard cache version, so every cached report is recalculated.
+	The version is bumped after the current transaction commits. Otherwise another request could recalculate a report
+	from the data before the commit and cache it until REPORTS_CACHE_SECONDS.
+	@return: nothing.
+	"""
+	transaction.on_commit(bump_reports_cache_version)
+
+
+def bump_reports_cache_version():
+	"""
+	Bumps the reports dashboard cache version now, use invalidate_reports_cache() when data changes.
+	@return: nothing.
+	"""
+	try:
+		cache.incr(REPORTS_CACHE_VERSION_KEY)
+	except ValueError:  # the version isn't cached
+		get_reports_cache_version()
+
+
+def get_cached_report_data(name, year, get_data):
+	"""
+	Gets report data from the cache, or calculates and caches it.
+	@param name: the name of the data. Ex: 'charts'
+	@param year: the year the data is for.
+	@param get_data: a function that calculates the data. The result must be picklable, so no QuerySets.
+	@return: the data.
+	"""
+	key = f'reports:{get_reports_cache_version()}:{name}:{year}'
+	return cache.get_or_set(key, get_data, settings.REPORTS_CACHE_SECONDS)
 
 
 # Gets the time for 1 hour ago
@@ -147,33 +315,48 @@ def get_one_hour_ago():
 
 
 def get_num_available_dummy_users(group: str):
-	group = Group.objects.get(name=group)
-	users = group.user_set.filter(last_login__lte=get_one_hour_ago(), is_superuser=False).order_by('last_login')
-	return users.count()
+	"""
+	@param group: ADMIN or CUSTOMER
+	@return: the number of demo accounts in the group that aren't leased to anyone. Cached, see DemoAccountLease.
+	"""
+	from users.models import DemoAccountLease  # users.models imports this module
+	return DemoAccountLease.get_available_count(group)
 
 
 def get_dummy_user(group: str):
 	"""
-	Returns a dummy user.
-	Arranges the users based on their most recent login and attempts to get the user who logged in the longest time ago.
-	If the user who logged in the longest time ago last logged in an hour ago, then it will return None.
+	Leases a dummy user to the visitor, see DemoAccountLease.claim().
+	The user whose lease expired the longest time ago is returned. Concurrent visitors never get the same user.
 	:param group: ADMIN or CUSTOMER
-	:return: None or a User object.
+	:return: None (if every user in the group is leased) or a User object.
 	"""
-	group = Group.objects.get(name=group)
-	users = group.user_set.filter(is_superuser=False, last_login__lte=get_one_hour_ago()).order_by('last_login')
-	if users:
-		return users.first()
-	else:  # there are no users that were last logged in over an hour ago
-		return None
+	from users.models import DemoAccountLease  # users.models imports this module
+	return DemoAccountLease.claim(group)
 
 
 def email_num_dummy_users():
 	"""
-	Sends an email to the admin if the number of dummy users in use (ADMIN or CUSTOMER groups) is greater than 1.
+	Emails the admin if DEMO_ACCOUNTS_ALERT_THRESHOLD or fewer demo users (ADMIN or CUSTOMER groups) are available.
+	At most 1 email is sent every DEMO_ACCOUNTS_ALERT_SECONDS. Ran by the check_demo_accounts command, not by requests.
+	@return: True if an email was queued, False otherwise.
 	"""
-	if settings.DEBUG is False:  # if in production
-		num_admins_in_use = get_num_available_dummy_users("ADMIN")
-		num_customers_in_use = get_num_available_dummy_users("CUSTOMER")
-		if num_admins_in_use <= 2 or num_customers_in_use <= 2:
-			send_mail("SP: Demo Users", f"{num_admins_in_use}/5 admins are available. {num_customers_in_use}/5 customers are available.", env('ADMIN_EMAIL'), [env('ADMIN_EMAIL')])
+	from home.models import QueuedEmail  # home.models imports this module
+	from users.models import DemoAccountLease  # users.models imports this module
+	num_admins_available = get_num_available_dummy_users("ADMIN")
+	num_customers_available = get_num_available_dummy_users("CUSTOMER")
+	threshold = settings.DEMO_ACCOUNTS_ALERT_THRESHOLD
+	if num_admins_available > threshold and num_customers_available > threshold:
+		return False
+
+	# The last alert is found from the queued emails, so the limit holds across processes and restarts
+	subject = "SP: Demo Users"
+	window_start = timezone.now() - timedelta(seconds=settings.DEMO_ACCOUNTS_ALERT_SECONDS)
+	recent_alerts = QueuedEmail.objects.filter(subject=subject).filter(Q(status=QueuedEmail.PENDING) | Q(sent_at__gte=window_start))
+	if recent_alerts.exists():
+		return False
+
+	num_admins = DemoAccountLease.objects.filter(group="ADMIN").count()
+	num_customers = DemoAccountLease.objects.filter(group="CUSTOMER").count()
+	message = f"{num_admins_available}/{num_admins} admins are available. {num_customers_available}/{num_customers} customers are available."
+	QueuedEmail.queue_mail(subject, message, env('ADMIN_EMAIL'), [env('ADMIN_EMAIL')])
+	return True
@@ -1,10 +1,11 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from allauth.socialaccount.models import SocialAccount, SocialToken, SocialApp
-from .models import User
+from .models import User, DemoAccountLease
 
 
 admin.site.register(User, UserAdmin)
+admin.site.register(DemoAccountLease)
 admin.site.unregister(SocialAccount)
 admin.site.unregister(SocialToken)
 admin.site.unregister(SocialApp)
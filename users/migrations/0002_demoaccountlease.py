@@ -0,0 +1,49 @@
+# Generated by Django 4.2 on 2026-10-18 20:46
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils import timezone
+from datetime import timedelta
+
+
+def create_demo_account_leases(apps, schema_editor):
+    """Creates a lease for each existing demo account, the same as DemoAccountLease.create_leases()."""
+    User = apps.get_model('users', 'User')
+    DemoAccountLease = apps.get_model('users', 'DemoAccountLease')
+    now = timezone.now()
+    lease_length = timedelta(minutes=60)
+    leases = []
+    for group in ['ADMIN', 'CUSTOMER']:
+        for user in User.objects.filter(groups__name=group, is_superuser=False):
+            expires_at = user.last_login + lease_length if user.last_login else now
+            leases.append(DemoAccountLease(user=user, group=group, expires_at=expires_at))
+    DemoAccountLease.objects.bulk_create(leases, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DemoAccountLease',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('group', models.CharField(max_length=20)),
+                ('expires_at', models.DateTimeField()),
+            ],
+            options={
+                'verbose_name': 'Demo account lease',
+                'verbose_name_plural': 'Demo account leases',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='demoaccountlease',
+            index=models.Index(fields=['group', 'expires_at'], name='demo_lease_group_expires_idx'),
+        ),
+        migrations.RunPython(create_demo_account_leases, migrations.RunPython.noop),
+    ]
@@ -1,8 +1,13 @@
 from django.contrib.auth.models import AbstractUser, Group
+from django.core.cache import cache
+from django.db import models, transaction
 from django.db.models.functions import ExtractYear
 from django.shortcuts import reverse
-from senior_project.constants import MONTHS
+from django.utils import timezone
+from senior_project.constants import MONTHS, DEMO_ACCOUNT_LEASE_MINUTES, DEMO_ACCOUNTS_CACHE_SECONDS
+from senior_project.utils import get_year_monthly_counts
 from home.models import Order, ShippingAddress
+from datetime import timedelta
 
 
 class User(AbstractUser):
@@ -17,10 +22,7 @@ class User(AbstractUser):
 		@param year: the year.
 		@return: a tuple of (months, month_user_counts).
 		"""
-		month_user_counts = []
-		for i, month in enumerate(MONTHS):
-			total = cls.objects.filter(date_joined__year=year, date_joined__month=i + 1).count()
-			month_user_counts.append(total)
+		month_user_counts = get_year_monthly_counts(cls.objects.all(), 'date_joined', year)
 		return MONTHS, month_user_counts
 
 	@classmethod
@@ -47,12 +49,127 @@ class User(AbstractUser):
 		"""Returns true if a user has an order, false otherwise """
 		return Order.objects.filter(creator=self).count() > 0
 
+	def get_group_names(self):
+		"""
+		Gets the names of the groups the user is in. The names are fetched with 1 query the first time they're needed,
+		then kept on the user instance, so every permission check for request.user during a request shares that query.
+		The cache is cleared by users.signals.clear_group_names_cache when the user's groups change.
+		@return: a frozenset of group names.
+		"""
+		if not hasattr(self, '_group_names_cache'):
+			self._group_names_cache = frozenset(self.groups.values_list('name', flat=True))
+		return self._group_names_cache
+
+	def clear_group_names_cache(self):
+		self.__dict__.pop('_group_names_cache', None)
+
+	def refresh_from_db(self, *args, **kwargs):
+		super().refresh_from_db(*args, **kwargs)
+		self.clear_group_names_cache()
+
 	def in_admin_group(self):
-		return self.groups.filter(name="ADMIN").exists()
+		return 'ADMIN' in self.get_group_names()
 
 	def is_demo_account(self):
 		if self.is_superuser is False:
-			in_groups = self.groups.filter(name__in=['ADMIN', 'CUSTOMER']).exists()
+			in_groups = not self.get_group_names().isdisjoint(['ADMIN', 'CUSTOMER'])
 			return in_groups
 		else:
 			return False
+
+
+class DemoAccountLease(models.Model):
+	"""
+	Lends the demo accounts (the non superusers in the ADMIN and CUSTOMER groups) to 1 visitor at a time.
+	user: the demo account.
+	group: ADMIN or CUSTOMER, the group the account is lent out from.
+	expires_at: when the account can be lent to someone else.
+		- An account is available when its lease has expired. Logging out ends the lease early.
+	"""
+	SESSION_KEY = 'demo_account_lease'
+	GROUPS = ['ADMIN', 'CUSTOMER']
+
+	user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True)
+	group = models.CharField(max_length=20)
+	expires_at = models.DateTimeField()
+
+	def __str__(self):
+		return f"{self.user.username} ({self.group}), expires: {self.expires_at}"
+
+	@staticmethod
+	def get_available_count_cache_key(group):
+		return f'demo_accounts:available:{group}'
+
+	@classmethod
+	def get_available_count(cls, group):
+		"""
+		@param group: ADMIN or CUSTOMER
+		@return: the number of demo accounts in the group that can be leased. Cached for DEMO_ACCOUNTS_CACHE_SECONDS.
+		"""
+		return cache.get_or_set(
+			cls.get_available_count_cache_key(group),
+			lambda: cls.objects.filter(group=group, expires_at__lte=timezone.now()).count(),
+			DEMO_ACCOUNTS_CACHE_SECONDS,
+		)
+
+	@classmethod
+	def clear_available_count(cls, group):
+		cache.delete(cls.get_available_count_cache_key(group))
+
+	@classmethod
+	def claim(cls, group):
+		"""
+		Leases the demo account whose lease expired the longest time ago.
+		Leases locked by another visitor's claim are skipped instead of waited on, so 2 visitors never get the same account.
+		@param group: ADMIN or CUSTOMER
+		@return: the leased User, or None if every account in the group is leased.
+		"""
+		now = timezone.now()
+		with transaction.atomic():
+			lease = cls.objects.select_for_update(skip_locked=True, of=('self',)).select_related('user')\
+				.filter(group=group, expires_at__lte=now).order_by('expires_at').first()
+			if lease is None:
+				return None
+			lease.expires_at = now + timedelta(minutes=DEMO_ACCOUNT_LEASE_MINUTES)
+			lease.save(update_fields=['expires_at'])
+		cls.clear_available_count(group)
+		return lease.user
+
+	@classmethod
+	def release(cls, user):
+		"""
+		Ends the user's lease so the account can be lent out again.
+		@param user: the demo account.
+		"""
+		lease = cls.objects.filter(user=user).first()
+		if lease:
+			lease.expires_at = timezone.now()
+			lease.save(update_fields=['expires_at'])
+			cls.clear_available_count(lease.group)
+
+	@classmethod
+	def create_leases(cls, group):
+		"""
+		Creates a lease for each demo account in the group that doesn't have one.
+		Accounts that logged in within the last DEMO_ACCOUNT_LEASE_MINUTES stay leased until that time is up.
+		@param group: ADMIN or CUSTOMER
+		@return: the number of leases created.
+		"""
+		now = timezone.now()
+		lease_length = timedelta(minutes=DEMO_ACCOUNT_LEASE_MINUTES)
+		users = User.objects.filter(groups__name=group, is_superuser=False, demoaccountlease__isnull=True)
+		leases = [
+			cls(user=user, group=group, expires_at=user.last_login + lease_length if user.last_login else now)
+			for user in users
+		]
+		cls.objects.bulk_create(leases, ignore_conflicts=True)
+		cls.clear_available_count(group)
+		return len(leases)
+
+	class Meta:
+		verbose_name = 'Demo account lease'
+		verbose_name_plural = 'Demo account leases'
+		indexes = [
+			# Used by claim() and get_available_count()
+			models.Index(fields=['group', 'expires_at'], name='demo_lease_group_expires_idx'),
+		]
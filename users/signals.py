@@ -0,0 +1,55 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.contrib.auth.signals import user_logged_out
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
+from users.models import DemoAccountLease
+
+User = get_user_model()
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def clear_group_names_cache(sender, instance, action, reverse, **kwargs):
+	"""
+	Clears the cached group names when a user's groups change, so in_admin_group() and is_demo_account() see the change.
+	When the change is made from the group's side (group.user_set.add(user)) only the pks of the users are sent, so
+	user instances that are already loaded keep their cache until they're refreshed or the next request loads them again.
+	"""
+	if not action.startswith('post_'):
+		return
+	if not reverse:
+		instance.clear_group_names_cache()
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def update_demo_account_leases(sender, instance, action, reverse, pk_set, **kwargs):
+	"""
+	Adds users to the demo account pool when they're added to the ADMIN or CUSTOMER group, and removes them when they
+	leave it.
+	"""
+	if action not in ('post_add', 'post_remove', 'post_clear'):
+		return
+	if reverse:  # group.user_set changed
+		group_names = [instance.name]
+		user_ids = pk_set
+	else:  # user.groups changed
+		group_names = Group.objects.filter(pk__in=pk_set).values_list('name', flat=True) if pk_set else DemoAccountLease.GROUPS
+		user_ids = [instance.pk]
+	for group_name in set(group_names).intersection(DemoAccountLease.GROUPS):
+		if action == 'post_add':
+			DemoAccountLease.create_leases(group_name)
+		else:
+			leases = DemoAccountLease.objects.filter(group=group_name)
+			if user_ids is not None:
+				leases = leases.filter(user_id__in=user_ids)
+			leases.delete()
+			DemoAccountLease.clear_available_count(group_name)
+
+
+@receiver(user_logged_out)
+def release_demo_account_lease(sender, request, user, **kwargs):
+	"""
+	Ends the demo account's lease when the visitor it was lent to logs out.
+	"""
+	if user is not None and request is not None and request.session.get(DemoAccountLease.SESSION_KEY) == user.pk:
+		DemoAccountLease.release(user)
@@ -5,9 +5,10 @@ from django.contrib.auth import logout, get_user_model, login
 from django.conf import settings
 from django.utils.safestring import mark_safe
 from allauth.account.views import LoginView, PasswordChangeView, EmailView, PasswordResetView
-from senior_project.utils import login_required, get_dummy_user, logout_required, get_num_available_dummy_users, email_num_dummy_users
+from senior_project.utils import login_required, get_dummy_user, logout_required, get_num_available_dummy_users
 from home.models import Order, OrderHistory
 from users.forms import DeleteUserForm
+from users.models import DemoAccountLease
 
 User = get_user_model()
 
@@ -20,8 +21,6 @@ class CustomLoginView(LoginView):
         context['num_available_customer_users'] = get_num_available_dummy_users('CUSTOMER')
         if settings.DEBUG:
             context['debug'] = True
-        # Checks how many dummy accounts are in use
-        email_num_dummy_users()
         return context
 
 
@@ -58,8 +57,12 @@ def delete_user(request):
 @logout_required
 def login_as_admin(request):
     user = get_dummy_user("ADMIN")
+    if user is None:
+        messages.info(request, 'All of the admin demo accounts are in use, please try again later.')
+        return redirect('account_login')
     user.backend = 'django.contrib.auth.backends.ModelBackend'
     login(request, user)
+    request.session[DemoAccountLease.SESSION_KEY] = user.pk
     messages.info(request, mark_safe(f'You logged in as {user.username}. You may be logged out in an hour. As an admin, you can access <a href={reverse("home:report-charts")}>Reports</a>'))
     return redirect('home:home')
 
@@ -68,8 +71,12 @@ def login_as_admin(request):
 @logout_required
 def login_as_customer(request):
     user = get_dummy_user("CUSTOMER")
+    if user is None:
+        messages.info(request, 'All of the customer demo accounts are in use, please try again later.')
+        return redirect('account_login')
     user.backend = 'django.contrib.auth.backends.ModelBackend'
     login(request, user)
+    request.session[DemoAccountLease.SESSION_KEY] = user.pk
     messages.info(request, f'You logged in as {user.username}. You may be logged out in an hour.')
     return redirect('home:home')
 